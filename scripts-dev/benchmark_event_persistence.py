@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for the event creation and persistence path.
+
+Builds a homeserver against either a scratch SQLite database or a local
+(empty!) postgres database, generates a number of synthetic rooms with many
+members, and then grows a DAG in each room with several forward extremities
+per layer so that state resolution is exercised when persisting.
+
+It reports events/sec and latency percentiles for event creation, for
+EventsStore.persist_events, and for the _calculate_state_delta and
+_update_current_state_txn steps of the persistence path.
+
+Run from the root of the source tree, e.g.:
+
+    python scripts-dev/benchmark_event_persistence.py --rooms 5 --members 500
+
+    python scripts-dev/benchmark_event_persistence.py --database psycopg2 \\
+        --db-name synapse_bench --db-user synapse_user
+"""
+
+from __future__ import print_function
+
+import argparse
+import atexit
+import os
+import sys
+import tempfile
+import time
+
+from mock import Mock
+from signedjson.key import generate_signing_key
+from twisted.internet import defer, task
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from synapse.api.constants import EventTypes, Membership  # noqa: E402
+from synapse.server import HomeServer  # noqa: E402
+from synapse.storage.engines import create_engine  # noqa: E402
+from synapse.storage.prepare_database import prepare_database  # noqa: E402
+from synapse.util import Clock  # noqa: E402
+from synapse.util.async import concurrently_execute  # noqa: E402
+from synapse.util.logcontext import LoggingContext  # noqa: E402
+
+
+SERVER_NAME = "bench"
+
+
+class Samples(object):
+    """Collects latency samples (in seconds) for one stage of the benchmark.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.items = 0
+
+    def add(self, latency, items=1):
+        self.latencies.append(latency)
+        self.items += items
+
+    def percentile(self, pc):
+        if not self.latencies:
+            return 0
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(len(ordered) * pc / 100.0))
+        return ordered[idx]
+
+    def report(self, wall_clock=None):
+        total = sum(self.latencies)
+        elapsed = wall_clock if wall_clock is not None else total
+        rate = self.items / elapsed if elapsed else 0
+        print(
+            "%-28s n=%-7d items/s=%-9.1f p50=%-8.2f p90=%-8.2f p99=%-8.2f"
+            " max=%.2f (ms)" % (
+                self.name, len(self.latencies), rate,
+                self.percentile(50) * 1000,
+                self.percentile(90) * 1000,
+                self.percentile(99) * 1000,
+                max(self.latencies or [0]) * 1000,
+            )
+        )
+
+
+def time_deferred_method(obj, name, samples):
+    """Wraps a deferred-returning method on `obj` so that each call is
+    recorded in `samples`.
+    """
+    orig = getattr(obj, name)
+
+    @defer.inlineCallbacks
+    def wrapped(*args, **kwargs):
+        start = time.time()
+        res = yield orig(*args, **kwargs)
+        samples.add(time.time() - start)
+        defer.returnValue(res)
+
+    setattr(obj, name, wrapped)
+
+
+def time_method(obj, name, samples):
+    """Wraps a plain method on `obj` so that each call is recorded in
+    `samples`.
+    """
+    orig = getattr(obj, name)
+
+    def wrapped(*args, **kwargs):
+        start = time.time()
+        try:
+            return orig(*args, **kwargs)
+        finally:
+            samples.add(time.time() - start)
+
+    setattr(obj, name, wrapped)
+
+
+class BenchmarkHomeServer(HomeServer):
+    def get_db_conn(self, run_new_connection=True):
+        # Any param beginning with cp_ is a parameter for adbapi, and should
+        # not be passed to the database engine.
+        db_params = {
+            k: v for k, v in self.db_config.get("args", {}).items()
+            if not k.startswith("cp_")
+        }
+        db_conn = self.database_engine.module.connect(**db_params)
+
+        if run_new_connection:
+            self.database_engine.on_new_connection(db_conn)
+        return db_conn
+
+
+def setup_homeserver(args, **config_overrides):
+    """Builds a homeserver against the database given by the command line
+    arguments. Any keyword arguments are set on its config.
+    """
+    if args.database == "sqlite3":
+        path = args.db_name
+        if not path:
+            fd, path = tempfile.mkstemp(suffix=".db", prefix="synapse_bench_")
+            os.close(fd)
+            atexit.register(os.remove, path)
+        db_args = {
+            "database": path,
+            "cp_min": 1,
+            "cp_max": 1,
+            "check_same_thread": False,
+        }
+    else:
+        db_args = {
+            "database": args.db_name or "synapse_bench",
+            "user": args.db_user,
+            "password": args.db_password,
+            "host": args.db_host,
+            "cp_min": 5,
+            "cp_max": 10,
+        }
+
+    database_config = {"name": args.database, "args": db_args}
+    database_engine = create_engine(database_config)
+    database_config["args"]["cp_openfun"] = database_engine.on_new_connection
+
+    config = Mock()
+    config.signing_key = [generate_signing_key("bench")]
+    config.event_cache_size = 10000
+    config.server_name = SERVER_NAME
+    config.trusted_third_party_id_servers = []
+    config.room_invite_state_types = []
+    config.password_providers = []
+    config.worker_replication_url = ""
+    config.worker_app = None
+    config.email_enable_notifs = False
+    config.block_non_admin_invites = False
+    config.use_frozen_dicts = True
+    config.ldap_enabled = False
+    config.retention_policies = {}
+    config.sync_snapshots_enabled = False
+    config.sync_room_concurrency = 10
+    config.max_concurrent_long_polls = 0
+    config.federation_sender_instances = 1
+    config.worker_federation_sender_instance = 0
+    config.federation_client_pool_size = 5
+    config.federation_client_idle_timeout = 2 * 60 * 1000
+    config.federation_client_max_concurrent_requests = 0
+    config.federation_inbound_room_concurrency = 10
+    config.federation_inbound_max_transactions_per_origin = 10
+    config.gzip_responses = False
+    config.signature_verification_threads = 0
+    config.database_config = database_config
+
+    for name, value in config_overrides.items():
+        setattr(config, name, value)
+
+    hs = BenchmarkHomeServer(
+        SERVER_NAME,
+        db_config=database_config,
+        config=config,
+        version_string="Synapse/benchmark",
+        database_engine=database_engine,
+        clock=Clock(),
+        room_list_handler=object(),
+        tls_server_context_factory=Mock(),
+        http_client=None,
+    )
+
+    db_conn = hs.get_db_conn(run_new_connection=False)
+    prepare_database(db_conn, database_engine, config=config)
+    database_engine.on_new_connection(db_conn)
+    db_conn.commit()
+
+    hs.setup()
+    return hs
+
+
+class Benchmark(object):
+    def __init__(self, hs, args):
+        self.args = args
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.create_samples = Samples("create_event")
+        self.persist_samples = Samples("persist_events")
+        self.state_delta_samples = Samples("_calculate_state_delta")
+        self.update_state_samples = Samples("_update_current_state_txn")
+
+        time_deferred_method(
+            self.store, "_calculate_state_delta", self.state_delta_samples,
+        )
+        time_method(
+            self.store, "_update_current_state_txn", self.update_state_samples,
+        )
+
+    @defer.inlineCallbacks
+    def create_event(self, event_dict, prev_event_ids=None):
+        start = time.time()
+        builder = self.event_builder_factory.new(event_dict)
+        event, context = yield self.message_handler._create_new_client_event(
+            builder, prev_event_ids=prev_event_ids,
+        )
+        self.create_samples.add(time.time() - start)
+        defer.returnValue((event, context))
+
+    @defer.inlineCallbacks
+    def persist(self, events_and_contexts):
+        start = time.time()
+        yield self.store.persist_events(events_and_contexts)
+        self.persist_samples.add(time.time() - start, len(events_and_contexts))
+
+    @defer.inlineCallbacks
+    def send_state(self, room_id, sender, etype, state_key, content):
+        ev_ctx = yield self.create_event({
+            "type": etype,
+            "sender": sender,
+            "state_key": state_key,
+            "room_id": room_id,
+            "content": content,
+        })
+        yield self.persist([ev_ctx])
+        defer.returnValue(ev_ctx[0])
+
+    @defer.inlineCallbacks
+    def build_room(self, room_idx):
+        args = self.args
+        room_id = "!room%d:%s" % (room_idx, SERVER_NAME)
+        creator = "@creator%d:%s" % (room_idx, SERVER_NAME)
+
+        yield self.send_state(
+            room_id, creator, EventTypes.Create, "", {"creator": creator},
+        )
+        yield self.send_state(
+            room_id, creator, EventTypes.Member, creator,
+            {"membership": Membership.JOIN},
+        )
+        yield self.send_state(
+            room_id, creator, EventTypes.PowerLevels, "",
+            {"users": {creator: 100}, "users_default": 0},
+        )
+        yield self.send_state(
+            room_id, creator, EventTypes.JoinRules, "", {"join_rule": "public"},
+        )
+
+        members = [creator]
+        for i in range(args.members):
+            user_id = "@user%d_%d:%s" % (room_idx, i, SERVER_NAME)
+            yield self.send_state(
+                room_id, user_id, EventTypes.Member, user_id,
+                {"membership": Membership.JOIN},
+            )
+            members.append(user_id)
+
+        # Now grow the DAG. Each layer forks into `extremities` sibling events
+        # which all point at the previous layer's extremities, one of which is
+        # a state event, and which are persisted together.
+        extremities = yield self.store.get_latest_event_ids_in_room(room_id)
+        for depth in range(args.depth):
+            batch = []
+            for fork in range(args.extremities):
+                sender = members[(depth * args.extremities + fork) % len(members)]
+                if fork == 0 and args.extremities > 1:
+                    event_dict = {
+                        "type": EventTypes.Topic,
+                        "state_key": "",
+                        "content": {"topic": "topic %d" % (depth,)},
+                    }
+                else:
+                    event_dict = {
+                        "type": EventTypes.Message,
+                        "content": {"msgtype": "m.text", "body": "msg %d" % (depth,)},
+                    }
+                event_dict.update({"room_id": room_id, "sender": sender})
+                ev_ctx = yield self.create_event(
+                    event_dict, prev_event_ids=list(extremities),
+                )
+                batch.append(ev_ctx)
+
+            yield self.persist(batch)
+            extremities = [ev.event_id for ev, _ in batch]
+
+    @defer.inlineCallbacks
+    def run(self):
+        start = time.time()
+        yield concurrently_execute(
+            self.build_room, range(self.args.rooms), self.args.concurrency,
+        )
+        wall_clock = time.time() - start
+
+        print()
+        print(
+            "%d rooms, %d members, %d layers x %d extremities on %s in %.2fs" % (
+                self.args.rooms, self.args.members, self.args.depth,
+                self.args.extremities, self.args.database, wall_clock,
+            )
+        )
+        self.create_samples.report(wall_clock)
+        self.persist_samples.report(wall_clock)
+        self.state_delta_samples.report()
+        self.update_state_samples.report()
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    hs = setup_homeserver(args)
+    with LoggingContext("benchmark"):
+        yield Benchmark(hs, args).run()
+
+
+def add_database_arguments(parser):
+    """Adds the arguments used by setup_homeserver to an ArgumentParser.
+    """
+    parser.add_argument(
+        "--database", choices=["sqlite3", "psycopg2"], default="sqlite3",
+        help="The database engine to benchmark against",
+    )
+    parser.add_argument(
+        "--db-name",
+        help="Path of the SQLite database (defaults to a temporary file), or"
+        " the name of an empty postgres database",
+    )
+    parser.add_argument("--db-user", help="Postgres user")
+    parser.add_argument("--db-password", help="Postgres password")
+    parser.add_argument("--db-host", default="localhost", help="Postgres host")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark event creation and persistence",
+    )
+    add_database_arguments(parser)
+    parser.add_argument(
+        "--rooms", type=int, default=5, help="Number of rooms to create",
+    )
+    parser.add_argument(
+        "--members", type=int, default=100, help="Number of members per room",
+    )
+    parser.add_argument(
+        "--depth", type=int, default=50,
+        help="Number of layers of events to add to each room's DAG",
+    )
+    parser.add_argument(
+        "--extremities", type=int, default=3,
+        help="Number of forward extremities in each layer of the DAG",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=5,
+        help="Number of rooms to generate concurrently",
+    )
+
+    task.react(main, [parser.parse_args()])
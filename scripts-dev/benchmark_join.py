@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for joining a large room on another server.
+
+Builds a homeserver as benchmark_event_persistence.py does, generates a
+synthetic room with many members on a fake remote server, and then joins it.
+The make_join and send_join requests are answered from the synthetic room
+rather than over federation, so the benchmark measures only our handling of
+the send_join response.
+
+It reports the time taken to join, and the time spent checking signatures,
+running auth checks and persisting events along the way.
+
+Run from the root of the source tree, e.g.:
+
+    python scripts-dev/benchmark_join.py --members 30000
+
+    python scripts-dev/benchmark_join.py --database psycopg2 \\
+        --db-name synapse_bench --db-user synapse_user
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from mock import Mock
+from signedjson.key import generate_signing_key, get_verify_key
+from twisted.internet import defer, task
+
+from benchmark_event_persistence import (
+    Samples, add_database_arguments, setup_homeserver, time_deferred_method,
+    time_method,
+)
+
+from synapse.api.constants import EventTypes, Membership  # noqa: E402
+from synapse.crypto.event_signing import add_hashes_and_signatures  # noqa: E402
+from synapse.events.builder import EventBuilderFactory  # noqa: E402
+from synapse.util import Clock  # noqa: E402
+from synapse.util.logcontext import LoggingContext  # noqa: E402
+
+
+REMOTE_SERVER_NAME = "remote"
+
+
+class RemoteRoom(object):
+    """A synthetic room on the remote server, with a chain of membership
+    events.
+    """
+
+    def __init__(self, room_id, members):
+        self.room_id = room_id
+        self.signing_key = generate_signing_key("1")
+        self.builder_factory = EventBuilderFactory(Clock(), REMOTE_SERVER_NAME)
+
+        self.state = {}
+        self.auth_chain = {}
+        self.last_event = None
+
+        creator = "@creator:%s" % (REMOTE_SERVER_NAME,)
+        self.create_event = self.add_state(
+            EventTypes.Create, "", creator, {"creator": creator},
+        )
+        self.creator_join = self.add_state(
+            EventTypes.Member, creator, creator, {"membership": Membership.JOIN},
+        )
+        self.power_levels = self.add_state(
+            EventTypes.PowerLevels, "", creator,
+            {"users": {creator: 100}, "users_default": 0},
+        )
+        self.join_rules = self.add_state(
+            EventTypes.JoinRules, "", creator, {"join_rule": "public"},
+        )
+
+        for i in range(members):
+            user_id = "@user%d:%s" % (i, REMOTE_SERVER_NAME)
+            self.add_state(
+                EventTypes.Member, user_id, user_id,
+                {"membership": Membership.JOIN},
+            )
+
+    def build_event(self, event_type, state_key, sender, content):
+        if self.last_event:
+            prev_events = [(self.last_event.event_id, {})]
+            depth = self.last_event.depth + 1
+        else:
+            prev_events = []
+            depth = 1
+
+        auth_events = []
+        if event_type != EventTypes.Create:
+            auth_events.append(self.create_event)
+            if event_type == EventTypes.Member and sender != self.create_event.sender:
+                auth_events.extend([self.power_levels, self.join_rules])
+            elif self.state.get((EventTypes.Member, sender)):
+                auth_events.append(self.state[(EventTypes.Member, sender)])
+
+        event_dict = {
+            "type": event_type,
+            "room_id": self.room_id,
+            "sender": sender,
+            "content": content,
+            "prev_events": prev_events,
+            "auth_events": [(e.event_id, {}) for e in auth_events],
+            "depth": depth,
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+            event_dict["prev_state"] = []
+
+        builder = self.builder_factory.new(event_dict)
+        add_hashes_and_signatures(builder, REMOTE_SERVER_NAME, self.signing_key)
+        return builder.build(), auth_events
+
+    def add_state(self, event_type, state_key, sender, content):
+        event, auth_events = self.build_event(
+            event_type, state_key, sender, content,
+        )
+        self.state[(event_type, state_key)] = event
+        for auth_event in auth_events:
+            self.auth_chain[auth_event.event_id] = auth_event
+        self.last_event = event
+        return event
+
+    def make_join(self, user_id):
+        """Builds the partial join event returned by /make_join/"""
+        event, _ = self.build_event(
+            EventTypes.Member, user_id, user_id, {"membership": Membership.JOIN},
+        )
+        return event
+
+    def send_join_response(self):
+        """Builds the response to /send_join/"""
+        time_now = int(time.time() * 1000)
+        return {
+            "state": [e.get_pdu_json(time_now) for e in self.state.values()],
+            "auth_chain": [
+                e.get_pdu_json(time_now) for e in self.auth_chain.values()
+            ],
+        }
+
+
+@defer.inlineCallbacks
+def run(hs, args):
+    room_id = "!bench:%s" % (REMOTE_SERVER_NAME,)
+    joinee = "@joiner:%s" % (hs.hostname,)
+
+    start = time.time()
+    room = RemoteRoom(room_id, args.members)
+    response = room.send_join_response()
+    print(
+        "Generated room with %d state and %d auth chain events in %.2fs" % (
+            len(response["state"]), len(response["auth_chain"]),
+            time.time() - start,
+        )
+    )
+
+    store = hs.get_datastore()
+    yield store.store_server_verify_key(
+        REMOTE_SERVER_NAME, REMOTE_SERVER_NAME, int(time.time() * 1000),
+        get_verify_key(room.signing_key),
+    )
+
+    replication_layer = hs.get_replication_layer()
+    replication_layer.make_membership_event = Mock(
+        return_value=defer.succeed((REMOTE_SERVER_NAME, room.make_join(joinee))),
+    )
+    replication_layer.transport_layer.send_join = Mock(
+        return_value=defer.succeed((200, response)),
+    )
+
+    sigs_samples = Samples("check_sigs_and_hashes")
+    auth_samples = Samples("auth.check")
+    persist_samples = Samples("persist_events")
+
+    time_deferred_method(
+        replication_layer, "_check_sigs_and_hash_and_fetch", sigs_samples,
+    )
+    time_method(hs.get_auth(), "check", auth_samples)
+
+    orig_persist_events = store.persist_events
+
+    @defer.inlineCallbacks
+    def persist_events(events_and_contexts, *args, **kwargs):
+        start = time.time()
+        res = yield orig_persist_events(events_and_contexts, *args, **kwargs)
+        persist_samples.add(time.time() - start, len(events_and_contexts))
+        defer.returnValue(res)
+
+    store.persist_events = persist_events
+
+    start = time.time()
+    yield hs.get_handlers().federation_handler.do_invite_join(
+        [REMOTE_SERVER_NAME], room_id, joinee, {"membership": Membership.JOIN},
+    )
+    wall_clock = time.time() - start
+
+    state_ids = yield store.get_current_state_ids(room_id)
+
+    print()
+    print(
+        "Joined room with %d members on %s in %.2fs" % (
+            args.members, args.database, wall_clock,
+        )
+    )
+    print("The room now has %d state events" % (len(state_ids),))
+    sigs_samples.report()
+    auth_samples.report()
+    persist_samples.report()
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    hs = setup_homeserver(
+        args, signature_verification_threads=args.verify_threads,
+    )
+    with LoggingContext("benchmark"):
+        yield run(hs, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark joining a large room on another server",
+    )
+    add_database_arguments(parser)
+    parser.add_argument(
+        "--members", type=int, default=1000,
+        help="Number of members in the room being joined",
+    )
+    parser.add_argument(
+        "--verify-threads", type=int, default=4,
+        help="Number of threads to check signatures with",
+    )
+
+    task.react(main, [parser.parse_args()])
@@ -112,6 +112,12 @@ ROOM_EVENT_FILTER_SCHEMA = {
         },
         "contains_url": {
             "type": "boolean"
+        },
+        "lazy_load_members": {
+            "type": "boolean"
+        },
+        "include_redundant_members": {
+            "type": "boolean"
         }
     }
 }
@@ -278,6 +284,12 @@ class FilterCollection(object):
     def filter_room_account_data(self, events):
         return self._room_account_data.filter(self._room_filter.filter(events))
 
+    def lazy_load_members(self):
+        return self._room_state_filter.lazy_load_members
+
+    def include_redundant_members(self):
+        return self._room_state_filter.include_redundant_members
+
     def blocks_all_presence(self):
         return (
             self._presence_filter.filters_all_types() or
@@ -314,6 +326,15 @@ class Filter(object):
 
         self.contains_url = self.filter_json.get("contains_url", None)
 
+        # If set, only the membership events of the senders of the returned
+        # events are sent, rather than those of every member of the room.
+        self.lazy_load_members = self.filter_json.get("lazy_load_members", False)
+        # If set along with lazy_load_members, membership events are sent
+        # even if we think the client already has them.
+        self.include_redundant_members = self.filter_json.get(
+            "include_redundant_members", False
+        )
+
     def filters_all_types(self):
         return "*" in self.not_types
 
@@ -36,6 +36,7 @@ from synapse.replication.slave.storage.transactions import TransactionStore
 from synapse.replication.tcp.client import ReplicationClientHandler
 from synapse.server import HomeServer
 from synapse.storage.engines import create_engine
+from synapse.storage.stream import get_federation_pos_type
 from synapse.util.async import Linearizer
 from synapse.util.httpresourcetree import create_resource_tree
 from synapse.util.logcontext import LoggingContext, preserve_fn
@@ -58,21 +59,27 @@ class FederationSenderSlaveStore(
         # always have a known value for the federation position in memory so
         # that we don't have to bounce via a deferred once when we start the
         # replication streams.
-        self.federation_out_pos_startup = self._get_federation_out_pos(db_conn)
+        self.federation_out_pos_startup = self._get_federation_out_pos(
+            db_conn, hs.config.worker_federation_sender_instance,
+        )
 
-    def _get_federation_out_pos(self, db_conn):
+    def _get_federation_out_pos(self, db_conn, instance):
         sql = (
-            "SELECT stream_id FROM federation_stream_position"
-            " WHERE type = ?"
+            "SELECT type, stream_id FROM federation_stream_position"
+            " WHERE type IN (?, ?)"
         )
         sql = self.database_engine.convert_param_style(sql)
 
+        pos_type = get_federation_pos_type("federation", instance)
+
         txn = db_conn.cursor()
-        txn.execute(sql, ("federation",))
-        rows = txn.fetchall()
+        txn.execute(sql, ("federation", pos_type))
+        positions = dict(txn.fetchall())
         txn.close()
 
-        return rows[0][0] if rows else -1
+        # Fall back to the position of the first sender if this one hasn't
+        # stored a position yet.
+        return positions.get(pos_type, positions.get("federation", -1))
 
 
 class FederationSenderServer(HomeServer):
@@ -189,6 +196,15 @@ def start(config_options):
         )
         sys.exit(1)
 
+    instance = config.worker_federation_sender_instance
+    if not 0 <= instance < config.federation_sender_instances:
+        sys.stderr.write(
+            "\nworker_federation_sender_instance must be between 0 and"
+            " federation_sender_instances - 1"
+            "\n"
+        )
+        sys.exit(1)
+
     # Force the pushers to start since they will be disabled in the main config
     config.send_federation = True
 
@@ -222,6 +238,7 @@ class FederationSenderHandler(object):
         self.store = hs.get_datastore()
         self.federation_sender = hs.get_federation_sender()
         self.replication_client = replication_client
+        self.instance = hs.config.worker_federation_sender_instance
 
         self.federation_position = self.store.federation_out_pos_startup
         self._fed_position_linearizer = Linearizer(name="_fed_position_linearizer")
@@ -260,12 +277,14 @@ class FederationSenderHandler(object):
         with (yield self._fed_position_linearizer.queue(None)):
             if self._last_ack < self.federation_position:
                 yield self.store.update_federation_out_pos(
-                    "federation", self.federation_position
+                    "federation", self.federation_position, self.instance,
                 )
 
                 # We ACK this token over replication so that the master can drop
                 # its in memory queues
-                self.replication_client.send_federation_ack(self.federation_position)
+                self.replication_client.send_federation_ack(
+                    self.federation_position, self.instance,
+                )
                 self._last_ack = self.federation_position
 
 
@@ -49,7 +49,7 @@ from synapse.storage import are_all_users_on_domain
 from synapse.storage.engines import IncorrectDatabaseSetup, create_engine
 from synapse.storage.prepare_database import UpgradeDatabaseException, prepare_database
 from synapse.util.httpresourcetree import create_resource_tree
-from synapse.util.logcontext import LoggingContext
+from synapse.util.logcontext import LoggingContext, preserve_fn
 from synapse.util.manhole import manhole
 from synapse.util.module_loader import load_module
 from synapse.util.rlimit import change_resource_limit
@@ -357,6 +357,21 @@ def setup(config_options):
         hs.get_state_handler().start_caching()
         hs.get_datastore().start_profiling()
         hs.get_datastore().start_doing_background_updates()
+
+        def log_purge_failure(failure):
+            logger.error(
+                "Failed to resume purge jobs",
+                exc_info=(
+                    failure.type,
+                    failure.value,
+                    failure.getTracebackObject(),
+                ),
+            )
+
+        preserve_fn(
+            hs.get_handlers().message_handler.resume_purge_history
+        )().addErrback(log_purge_failure)
+
         hs.get_replication_layer().start_get_pdu_cache()
 
         register_memory_metrics(hs)
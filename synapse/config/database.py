@@ -43,6 +43,14 @@ class DatabaseConfig(Config):
         else:
             raise RuntimeError("Unsupported database type '%s'" % (name,))
 
+        self.background_update_parallelism = config.get(
+            "background_update_parallelism", 1
+        )
+        if name == "sqlite3":
+            # sqlite only has the one connection, so there's no point trying
+            # to run updates concurrently
+            self.background_update_parallelism = 1
+
         self.set_databasepath(config.get("database_path"))
 
     def default_config(self, **kwargs):
@@ -59,6 +67,10 @@ class DatabaseConfig(Config):
 
         # Number of events to cache in memory.
         event_cache_size: "10K"
+
+        # Number of background database updates (such as building indexes after
+        # an upgrade) to run at the same time. Only used with postgres.
+        background_update_parallelism: 1
         """ % locals()
 
     def read_arguments(self, args):
@@ -59,6 +59,10 @@ class KeyConfig(Config):
 
         self.expire_access_token = config.get("expire_access_token", False)
 
+        self.signature_verification_threads = config.get(
+            "signature_verification_threads", 4,
+        )
+
     def default_config(self, config_dir_path, server_name, is_generating_file=False,
                        **kwargs):
         base_key_name = os.path.join(config_dir_path, server_name)
@@ -101,6 +105,11 @@ class KeyConfig(Config):
               verify_keys:
                 "ed25519:auto":
                   key: "Noi6WqcDj0QmPxCNQqgezwTlBKrfqehY1u2FyWP9uYw"
+
+        # The number of threads to check signatures on incoming events and
+        # requests with, so that large batches of events don't block the rest
+        # of the server. 0 checks them on the main thread.
+        # signature_verification_threads: 4
         """ % locals()
 
     def read_perspectives(self, perspectives_config):
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ._base import Config, ConfigError
+
+
+# The tables which can be pruned, and the default maximum age of the rows we
+# keep in them. None means that rows are kept forever.
+DEFAULT_RETENTION_POLICIES = {
+    "received_transactions": "30d",
+    "stream_ordering_to_exterm": "30d",
+    "device_federation_inbox": None,
+    "device_federation_outbox": None,
+    "event_push_actions": None,
+    "user_ips": None,
+    "sync_snapshots": "1h",
+}
+
+
+class RetentionConfig(Config):
+    def read_config(self, config):
+        retention_config = config.get("retention", {})
+
+        self.retention_interval_ms = self.parse_duration(
+            retention_config.get("interval", "1h")
+        )
+        self.retention_batch_size = retention_config.get("batch_size", 1000)
+
+        policies = dict(DEFAULT_RETENTION_POLICIES)
+        for table, policy in retention_config.get("policies", {}).items():
+            if table not in DEFAULT_RETENTION_POLICIES:
+                raise ConfigError(
+                    "Unknown table in retention policies: %s" % (table,)
+                )
+            policies[table] = (policy or {}).get("max_age")
+
+        # table -> max age in ms, for the tables which should be pruned
+        self.retention_policies = {
+            table: self.parse_duration(max_age)
+            for table, max_age in policies.items()
+            if max_age is not None
+        }
+
+    def default_config(self, **kwargs):
+        return """\
+        # Controls how long rows are kept in some of the tables which would
+        # otherwise grow without bound. Old rows are deleted in batches of
+        # `batch_size` rows every `interval`. Setting the `max_age` of a table
+        # to null keeps its rows forever.
+        #
+        #   received_transactions: used to deduplicate incoming federation
+        #       transactions.
+        #   stream_ordering_to_exterm: historical forward extremities, used to
+        #       work out which rooms have changed since a client last synced.
+        #   device_federation_inbox: used to deduplicate incoming to-device
+        #       messages.
+        #   device_federation_outbox: to-device messages which are still
+        #       waiting to be sent to a remote server.
+        #   event_push_actions: highlighted notifications, as returned by the
+        #       /notifications API. Non-highlights are already summarised
+        #       after a day.
+        #   user_ips: the IPs and user agents seen for each access token, as
+        #       returned by the admin /whois API.
+        #   sync_snapshots: stored initial sync responses (see
+        #       `sync_snapshots_enabled`).
+        #
+        # retention:
+        #   interval: 1h
+        #   batch_size: 1000
+        #   policies:
+        #     received_transactions:
+        #       max_age: 30d
+        #     stream_ordering_to_exterm:
+        #       max_age: 30d
+        #     device_federation_inbox:
+        #       max_age: 4w
+        #     device_federation_outbox:
+        #       max_age: 4w
+        #     event_push_actions:
+        #       max_age: 1y
+        #     user_ips:
+        #       max_age: 1y
+        #     sync_snapshots:
+        #       max_age: 1h
+        """
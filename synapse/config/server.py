@@ -37,12 +37,73 @@ class ServerConfig(Config):
         # "disable" federation
         self.send_federation = config.get("send_federation", True)
 
+        # The number of federation sender workers. Each sends to a fixed
+        # subset of the remote servers.
+        self.federation_sender_instances = config.get(
+            "federation_sender_instances", 1,
+        )
+        if self.federation_sender_instances < 1:
+            raise ConfigError("federation_sender_instances must be at least 1")
+        if self.send_federation and self.federation_sender_instances > 1:
+            raise ConfigError(
+                "federation_sender_instances can only be used with"
+                " send_federation disabled in the main process"
+            )
+
         # Whether to update the user directory or not. This should be set to
         # false only if we are updating the user directory in a worker
         self.update_user_directory = config.get("update_user_directory", True)
 
         self.filter_timeline_limit = config.get("filter_timeline_limit", -1)
 
+        # Whether to gzip JSON responses for clients which accept it
+        self.gzip_responses = config.get("gzip_responses", False)
+        self.gzip_min_size = self.parse_size(config.get("gzip_min_size", "1K"))
+        self.gzip_thread_min_size = self.parse_size(
+            config.get("gzip_thread_min_size", "256K")
+        )
+
+        # Whether initial syncs should be answered from a stored snapshot
+        self.sync_snapshots_enabled = config.get("sync_snapshots_enabled", False)
+        self.sync_snapshot_refresh_interval_ms = self.parse_duration(
+            config.get("sync_snapshot_refresh_interval", "1m")
+        )
+        self.sync_snapshot_max_age_ms = self.parse_duration(
+            config.get("sync_snapshot_max_age", "1h")
+        )
+        self.sync_snapshot_max_size = self.parse_size(
+            config.get("sync_snapshot_max_size", "5M")
+        )
+
+        # How many rooms to generate sync entries for at once for each sync
+        self.sync_room_concurrency = config.get("sync_room_concurrency", 10)
+
+        # The maximum number of /sync and /events requests which may wait for
+        # new events at once in this process, or 0 for no limit
+        self.max_concurrent_long_polls = config.get("max_concurrent_long_polls", 0)
+
+        # Tuning of the connections used to send requests to other servers
+        self.federation_client_pool_size = config.get(
+            "federation_client_pool_size", 5,
+        )
+        self.federation_client_idle_timeout = self.parse_duration(
+            config.get("federation_client_idle_timeout", "2m")
+        )
+        self.federation_client_max_concurrent_requests = config.get(
+            "federation_client_max_concurrent_requests", 0,
+        )
+
+        # Limits on the processing of transactions received from other servers
+        self.federation_inbound_room_concurrency = config.get(
+            "federation_inbound_room_concurrency", 10,
+        )
+        self.federation_inbound_transactions_per_room = config.get(
+            "federation_inbound_transactions_per_room", 5,
+        )
+        self.federation_inbound_max_transactions_per_origin = config.get(
+            "federation_inbound_max_transactions_per_origin", 10,
+        )
+
         # Whether we should block invites sent to users on this server
         # (other than those sent by local server admins)
         self.block_non_admin_invites = config.get(
@@ -200,6 +261,58 @@ class ServerConfig(Config):
         # and sync operations. The default value is -1, means no upper limit.
         # filter_timeline_limit: 5000
 
+        # Whether to gzip JSON API responses of at least `gzip_min_size` bytes,
+        # for clients which send `Accept-Encoding: gzip`. Responses of at least
+        # `gzip_thread_min_size` bytes are compressed in a background thread.
+        # gzip_responses: False
+        # gzip_min_size: 1K
+        # gzip_thread_min_size: 256K
+
+        # Whether to answer initial syncs (those without a `since` token) from
+        # a stored snapshot of the user's previous initial sync. The client
+        # then catches up with an incremental sync from the snapshot's token.
+        # Snapshots older than `sync_snapshot_refresh_interval` are regenerated
+        # in the background after being used, and those older than
+        # `sync_snapshot_max_age` are not used at all. Responses which are
+        # larger than `sync_snapshot_max_size` bytes once compressed are not
+        # stored. Workers keep up to 200 compressed snapshots in memory
+        # rather than storing them in the database.
+        # sync_snapshots_enabled: False
+        # sync_snapshot_refresh_interval: 1m
+        # sync_snapshot_max_age: 1h
+        # sync_snapshot_max_size: 5M
+
+        # The number of rooms whose sync entries are generated concurrently
+        # for each /sync request. The most expensive rooms are started first.
+        # sync_room_concurrency: 10
+
+        # The maximum number of /sync and /events requests which can be
+        # waiting for new events at once in this process. Once the limit is
+        # reached, further requests which have no events waiting for them are
+        # rejected with a 429 error, asking the clients to retry after a second
+        # or two. 0 means no limit.
+        # max_concurrent_long_polls: 0
+
+        # The number of idle connections to keep open to each other server,
+        # and how long to keep them open for.
+        # federation_client_pool_size: 5
+        # federation_client_idle_timeout: 2m
+
+        # The maximum number of requests to send to each other server at
+        # once. Further requests wait for one of those to finish. 0 means no
+        # limit.
+        # federation_client_max_concurrent_requests: 0
+
+        # The number of rooms to process at once from each transaction received
+        # from another server, the number of transactions to process the PDUs
+        # for a room from at once, and the number of transactions from each
+        # server to process at once. Transactions over the last limit are
+        # rejected, and the sending server will retry them later. 0 means no
+        # limit.
+        # federation_inbound_room_concurrency: 10
+        # federation_inbound_transactions_per_room: 5
+        # federation_inbound_max_transactions_per_origin: 10
+
         # Whether room invites to users on this server should be blocked
         # (except those sent by local server admins). The default is False.
         # block_non_admin_invites: True
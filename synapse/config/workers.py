@@ -35,6 +35,12 @@ class WorkerConfig(Config):
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
         self.worker_cpu_affinity = config.get("worker_cpu_affinity")
 
+        # Which of the federation_sender_instances this federation sender
+        # worker is, counting from 0
+        self.worker_federation_sender_instance = config.get(
+            "worker_federation_sender_instance", 0,
+        )
+
         if self.worker_listeners:
             for listener in self.worker_listeners:
                 bind_address = listener.pop("bind_address", None)
@@ -22,8 +22,11 @@ from synapse.util.logcontext import (
     preserve_fn
 )
 from synapse.util.metrics import Measure
+import synapse.metrics
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 
 from signedjson.sign import (
     verify_signed_json, signature_ids, sign_json, encode_canonical_json
@@ -43,6 +46,13 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+verified_signatures_counter = metrics.register_counter("verified_signatures")
+
+# total time spent verifying batches of signatures on the threadpool, in ms
+verify_batch_timer = metrics.register_distribution("verify_batch_time")
+
 
 VerifyKeyRequest = namedtuple("VerifyRequest", (
     "server_name", "key_ids", "json_object", "deferred"
@@ -67,6 +77,14 @@ class KeyLookupError(ValueError):
 
 
 class Keyring(object):
+    # The maximum number of signatures to check in one go on the threadpool
+    VERIFY_BATCH_SIZE = 100
+
+    # After failing to fetch keys for a server, how long to wait before asking
+    # for them again. Doubles with each further failure up to the maximum.
+    MIN_KEY_FETCH_RETRY_INTERVAL_MS = 60 * 1000
+    MAX_KEY_FETCH_RETRY_INTERVAL_MS = 60 * 60 * 1000
+
     def __init__(self, hs):
         self.store = hs.get_datastore()
         self.clock = hs.get_clock()
@@ -82,6 +100,27 @@ class Keyring(object):
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # map from server name to (retry interval, retry at) in ms, for servers
+        # whose keys we recently failed to fetch. We don't ask for their keys
+        # again until the retry time.
+        self._key_fetch_failures = {}
+
+        # Signatures are checked in batches on a threadpool of this size, so
+        # that we don't block the reactor. If it is 0 they are checked on the
+        # reactor thread as their keys arrive.
+        self._verify_threads = self.config.signature_verification_threads
+        self._verify_threadpool = None
+
+        # list of (server_name, json_object, verify_key, deferred) waiting to be
+        # handed to the threadpool.
+        self._pending_verifications = []
+        self._verify_scheduled = False
+
+        metrics.register_callback(
+            "pending_verifications",
+            lambda: len(self._pending_verifications),
+        )
+
     def verify_json_for_server(self, server_name, json_object):
         return logcontext.make_deferred_yieldable(
             self.verify_json_objects_for_server(
@@ -133,9 +172,81 @@ class Keyring(object):
         # signatures can be verified
         handle = preserve_fn(_handle_key_deferred)
         return [
-            handle(rq) for rq in verify_requests
+            handle(rq, self._verify_signed_json) for rq in verify_requests
         ]
 
+    def _verify_signed_json(self, server_name, json_object, verify_key):
+        """Checks the signature on a JSON object, batching it up with any
+        others which are ready to be checked.
+
+        Returns:
+            Deferred: completes once the signature has been checked, or fails
+                if it is invalid. Runs its callbacks in the sentinel logcontext.
+        """
+        if not self._verify_threads:
+            verified_signatures_counter.inc()
+            try:
+                verify_signed_json(json_object, server_name, verify_key)
+            except Exception:
+                return defer.fail()
+            return defer.succeed(None)
+
+        deferred = defer.Deferred()
+        self._pending_verifications.append(
+            (server_name, json_object, verify_key, deferred)
+        )
+
+        # Wait until we're back in the reactor, so that any other signatures
+        # whose keys arrived at the same time are included in the batch.
+        if not self._verify_scheduled:
+            self._verify_scheduled = True
+            self.clock.call_later(0, self._start_pending_verifications)
+
+        return deferred
+
+    def _start_pending_verifications(self):
+        self._verify_scheduled = False
+
+        pending = self._pending_verifications
+        self._pending_verifications = []
+
+        if self._verify_threadpool is None:
+            self._verify_threadpool = ThreadPool(
+                minthreads=1, maxthreads=self._verify_threads,
+                name="signature_verification",
+            )
+            self._verify_threadpool.start()
+            reactor.addSystemEventTrigger(
+                "during", "shutdown", self._verify_threadpool.stop,
+            )
+
+        # Spread the work over all of the threads, rather than filling up
+        # one batch at a time.
+        batch_size = -(-len(pending) // self._verify_threads)
+        batch_size = min(batch_size, self.VERIFY_BATCH_SIZE)
+
+        for i in xrange(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            d = threads.deferToThreadPool(
+                reactor, self._verify_threadpool, _verify_signed_json_batch,
+                [(server_name, json_object, verify_key)
+                 for server_name, json_object, verify_key, _ in batch],
+            )
+            d.addBoth(self._on_verified_batch, batch, self.clock.time_msec())
+
+    def _on_verified_batch(self, results, batch, start):
+        verify_batch_timer.inc_by(self.clock.time_msec() - start)
+        verified_signatures_counter.inc_by(len(batch))
+
+        if isinstance(results, failure.Failure):
+            results = [results] * len(batch)
+
+        for (_, _, _, deferred), result in zip(batch, results):
+            if result is None:
+                deferred.callback(None)
+            else:
+                deferred.errback(result)
+
     @defer.inlineCallbacks
     def _start_key_lookups(self, verify_requests):
         """Sets off the key fetches for each verify request
@@ -253,6 +364,14 @@ class Keyring(object):
                 # map server_name -> key_id -> VerifyKey
                 merged_results = {}
 
+                # dict[str, dict[str, VerifyKey]]: keys which have passed their
+                # valid_until_ts. We try to refetch them, but fall back to these
+                # if that fails.
+                stale_results = {}
+
+                # servers which we have asked other servers about
+                attempted_servers = set()
+
                 # dict[str, set(str)]: keys to fetch for each server
                 missing_keys = {}
                 for verify_request in verify_requests:
@@ -261,8 +380,24 @@ class Keyring(object):
                     )
 
                 for fn in key_fetch_fns:
+                    if fn != self.get_keys_from_store:
+                        missing_keys = {
+                            server_name: key_ids
+                            for server_name, key_ids in missing_keys.items()
+                            if not self._is_key_fetch_backing_off(server_name)
+                        }
+                        if not missing_keys:
+                            break
+                        attempted_servers.update(missing_keys)
+
                     results = yield fn(missing_keys.items())
-                    merged_results.update(results)
+                    for server_name, keys in results.items():
+                        merged_keys = merged_results.setdefault(server_name, {})
+                        for key_id, key in keys.items():
+                            if self._is_key_stale(key):
+                                stale_results.setdefault(server_name, {})[key_id] = key
+                            else:
+                                merged_keys[key_id] = key
 
                     # We now need to figure out which verify requests we have keys
                     # for and which we don't
@@ -270,7 +405,7 @@ class Keyring(object):
                     requests_missing_keys = []
                     for verify_request in verify_requests:
                         server_name = verify_request.server_name
-                        result_keys = merged_results[server_name]
+                        result_keys = merged_results.get(server_name, {})
 
                         if verify_request.deferred.called:
                             # We've already called this deferred, which probably
@@ -297,15 +432,35 @@ class Keyring(object):
                     if not missing_keys:
                         break
 
+                failed_servers = set(rq.server_name for rq in requests_missing_keys)
+                for server_name in attempted_servers:
+                    if server_name in failed_servers:
+                        self._record_key_fetch_failure(server_name)
+                    else:
+                        self._key_fetch_failures.pop(server_name, None)
+
                 with PreserveLoggingContext():
                     for verify_request in requests_missing_keys:
-                        verify_request.deferred.errback(SynapseError(
-                            401,
-                            "No key for %s with id %s" % (
-                                verify_request.server_name, verify_request.key_ids,
-                            ),
-                            Codes.UNAUTHORIZED,
-                        ))
+                        server_name = verify_request.server_name
+                        stale_keys = stale_results.get(server_name, {})
+                        for key_id in verify_request.key_ids:
+                            if key_id in stale_keys:
+                                logger.info(
+                                    "Using expired key %s for %s",
+                                    key_id, server_name,
+                                )
+                                verify_request.deferred.callback((
+                                    server_name, key_id, stale_keys[key_id],
+                                ))
+                                break
+                        else:
+                            verify_request.deferred.errback(SynapseError(
+                                401,
+                                "No key for %s with id %s" % (
+                                    server_name, verify_request.key_ids,
+                                ),
+                                Codes.UNAUTHORIZED,
+                            ))
 
         def on_err(err):
             with PreserveLoggingContext():
@@ -315,6 +470,32 @@ class Keyring(object):
 
         preserve_fn(do_iterations)().addErrback(on_err)
 
+    def _is_key_stale(self, verify_key):
+        valid_until_ts = getattr(verify_key, "valid_until_ts", None)
+        return (
+            valid_until_ts is not None and
+            valid_until_ts < self.clock.time_msec()
+        )
+
+    def _is_key_fetch_backing_off(self, server_name):
+        failure = self._key_fetch_failures.get(server_name)
+        return failure is not None and self.clock.time_msec() < failure[1]
+
+    def _record_key_fetch_failure(self, server_name):
+        interval, _ = self._key_fetch_failures.get(server_name, (None, None))
+        if interval is None:
+            interval = self.MIN_KEY_FETCH_RETRY_INTERVAL_MS
+        else:
+            interval = min(interval * 2, self.MAX_KEY_FETCH_RETRY_INTERVAL_MS)
+
+        logger.info(
+            "Failed to fetch keys for %s: not retrying for %dms",
+            server_name, interval,
+        )
+        self._key_fetch_failures[server_name] = (
+            interval, self.clock.time_msec() + interval,
+        )
+
     @defer.inlineCallbacks
     def get_keys_from_store(self, server_name_and_key_ids):
         """
@@ -606,6 +787,9 @@ class Keyring(object):
         signed_key_json_bytes = encode_canonical_json(signed_key_json)
         ts_valid_until_ms = signed_key_json[u"valid_until_ts"]
 
+        for verify_key in verify_keys.values():
+            verify_key.valid_until_ts = ts_valid_until_ms
+
         updated_key_ids = set(requested_ids)
         updated_key_ids.update(verify_keys)
         updated_key_ids.update(old_verify_keys)
@@ -726,7 +910,7 @@ class Keyring(object):
 
 
 @defer.inlineCallbacks
-def _handle_key_deferred(verify_request):
+def _handle_key_deferred(verify_request, verify):
     server_name = verify_request.server_name
     try:
         with PreserveLoggingContext():
@@ -758,7 +942,8 @@ def _handle_key_deferred(verify_request):
         key_id, verify_key.alg, verify_key.version, server_name,
     ))
     try:
-        verify_signed_json(json_object, server_name, verify_key)
+        with PreserveLoggingContext():
+            yield verify(server_name, json_object, verify_key)
     except Exception:
         raise SynapseError(
             401,
@@ -767,3 +952,24 @@ def _handle_key_deferred(verify_request):
             ),
             Codes.UNAUTHORIZED,
         )
+
+
+def _verify_signed_json_batch(batch):
+    """Checks the signatures on a list of JSON objects. Runs on the signature
+    verification threadpool.
+
+    Args:
+        batch (list): list of (server_name, json_object, verify_key)
+
+    Returns:
+        list: for each object, None if its signature is valid, otherwise the
+            exception raised when checking it.
+    """
+    results = []
+    for server_name, json_object, verify_key in batch:
+        try:
+            verify_signed_json(json_object, server_name, verify_key)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
@@ -613,7 +613,7 @@ class FederationClient(FederationBase):
                 for s in signed_state:
                     s.internal_metadata = copy.deepcopy(s.internal_metadata)
 
-                auth_chain.sort(key=lambda e: e.depth)
+                signed_auth.sort(key=lambda e: e.depth)
 
                 defer.returnValue({
                     "state": signed_state,
@@ -25,17 +25,13 @@ from synapse.events import FrozenEvent
 from synapse.types import get_domain_from_id
 import synapse.metrics
 
-from synapse.api.errors import AuthError, FederationError, SynapseError
+from synapse.api.errors import AuthError, Codes, FederationError, SynapseError
 
 from synapse.crypto.event_signing import compute_event_signature
 
 import simplejson as json
 import logging
 
-# when processing incoming transactions, we try to handle multiple rooms in
-# parallel, up to this limit.
-TRANSACTION_CONCURRENCY_LIMIT = 10
-
 logger = logging.getLogger(__name__)
 
 # synapse.federation.federation_server is a silly name
@@ -47,6 +43,17 @@ received_edus_counter = metrics.register_counter("received_edus")
 
 received_queries_counter = metrics.register_counter("received_queries", labels=["type"])
 
+# PDUs which we had already persisted, so didn't need to process again
+already_seen_pdus_counter = metrics.register_counter("already_seen_pdus")
+
+# transactions refused because the origin already had too many in progress
+rejected_transactions_counter = metrics.register_counter("rejected_transactions")
+
+pdu_processing_time_histogram = metrics.register_histogram(
+    "pdu_processing_time_ms",
+    buckets=[10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000],
+)
+
 
 class FederationServer(FederationBase):
     def __init__(self, hs):
@@ -55,7 +62,40 @@ class FederationServer(FederationBase):
         self.auth = hs.get_auth()
 
         self._server_linearizer = async.Linearizer("fed_server")
-        self._transaction_linearizer = async.Linearizer("fed_txn_handler")
+
+        # Incoming transactions which are being processed, so that if the
+        # remote server times out and retries we wait for the original attempt
+        # rather than doing the work again.
+        self._transaction_resp_cache = ResponseCache(hs)
+
+        # How many rooms to process at once for each transaction, how many
+        # transactions to process the PDUs of at once for each room, and how
+        # many transactions to process at once for each origin (0 for no
+        # limit).
+        self._room_concurrency = hs.config.federation_inbound_room_concurrency
+        self._room_pdu_limiter = None
+        if hs.config.federation_inbound_transactions_per_room:
+            self._room_pdu_limiter = async.Limiter(
+                hs.config.federation_inbound_transactions_per_room,
+            )
+        self._max_transactions_per_origin = (
+            hs.config.federation_inbound_max_transactions_per_origin
+        )
+
+        # origin -> number of transactions being processed
+        self._transactions_in_progress = {}
+
+        # number of PDUs which have been received but not yet processed
+        self._pending_pdus = 0
+
+        metrics.register_callback(
+            "transactions_in_progress",
+            lambda: sum(self._transactions_in_progress.values()),
+        )
+        metrics.register_callback(
+            "pending_pdus",
+            lambda: self._pending_pdus,
+        )
 
         # We cache responses to state queries, as they take a while and often
         # come in waves.
@@ -125,14 +165,49 @@ class FederationServer(FederationBase):
 
         logger.debug("[%s] Got transaction", transaction.transaction_id)
 
-        # use a linearizer to ensure that we don't process the same transaction
-        # multiple times in parallel.
-        with (yield self._transaction_linearizer.queue(
-                (transaction.origin, transaction.transaction_id),
-        )):
+        key = (transaction.origin, transaction.transaction_id)
+        result = self._transaction_resp_cache.get(key)
+        if result is None:
+            in_progress = self._transactions_in_progress.get(transaction.origin, 0)
+            if (
+                self._max_transactions_per_origin and
+                in_progress >= self._max_transactions_per_origin
+            ):
+                rejected_transactions_counter.inc()
+                raise SynapseError(
+                    429, "Too many transactions in progress",
+                    Codes.LIMIT_EXCEEDED,
+                )
+
+            result = self._transaction_resp_cache.set(
+                key,
+                preserve_fn(self._process_incoming_transaction)(
+                    transaction, request_time,
+                ),
+            )
+        else:
+            logger.info(
+                "[%s] Transaction is already being processed",
+                transaction.transaction_id,
+            )
+
+        result = yield make_deferred_yieldable(result)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _process_incoming_transaction(self, transaction, request_time):
+        origin = transaction.origin
+        self._transactions_in_progress[origin] = (
+            self._transactions_in_progress.get(origin, 0) + 1
+        )
+        try:
             result = yield self._handle_incoming_transaction(
                 transaction, request_time,
             )
+        finally:
+            self._transactions_in_progress[origin] -= 1
+            if not self._transactions_in_progress[origin]:
+                del self._transactions_in_progress[origin]
 
         defer.returnValue(result)
 
@@ -161,8 +236,7 @@ class FederationServer(FederationBase):
 
         received_pdus_counter.inc_by(len(transaction.pdus))
 
-        pdus_by_room = {}
-
+        transaction_pdus = []
         for p in transaction.pdus:
             if "unsigned" in p:
                 unsigned = p["unsigned"]
@@ -172,20 +246,46 @@ class FederationServer(FederationBase):
                 p["age_ts"] = request_time - int(p["age"])
                 del p["age"]
 
-            event = self.event_from_pdu_json(p)
-            room_id = event.room_id
-            pdus_by_room.setdefault(room_id, []).append(event)
+            transaction_pdus.append(self.event_from_pdu_json(p))
 
         pdu_results = {}
 
+        # Anything we have already persisted can be acknowledged straight
+        # away, rather than waiting behind the rest of the transaction.
+        seen_event_ids = set()
+        if transaction_pdus:
+            seen_event_ids = yield self.store.have_events_in_timeline(
+                [p.event_id for p in transaction_pdus]
+            )
+        for event_id in seen_event_ids:
+            pdu_results[event_id] = {}
+        already_seen_pdus_counter.inc_by(len(seen_event_ids))
+
+        pdus_by_room = {}
+        for pdu in transaction_pdus:
+            if pdu.event_id not in seen_event_ids:
+                pdus_by_room.setdefault(pdu.room_id, []).append(pdu)
+
+        self._pending_pdus += sum(len(pdus) for pdus in pdus_by_room.itervalues())
+
         # we can process different rooms in parallel (which is useful if they
         # require callouts to other servers to fetch missing events), but
         # impose a limit to avoid going too crazy with ram/cpu.
         @defer.inlineCallbacks
         def process_pdus_for_room(room_id):
             logger.debug("Processing PDUs for %s", room_id)
+            if self._room_pdu_limiter is None:
+                yield handle_room_pdus(room_id)
+                return
+
+            with (yield self._room_pdu_limiter.queue(room_id)):
+                yield handle_room_pdus(room_id)
+
+        @defer.inlineCallbacks
+        def handle_room_pdus(room_id):
             for pdu in pdus_by_room[room_id]:
                 event_id = pdu.event_id
+                start = self._clock.time_msec()
                 try:
                     yield self._handle_received_pdu(
                         transaction.origin, pdu
@@ -197,10 +297,15 @@ class FederationServer(FederationBase):
                 except Exception as e:
                     pdu_results[event_id] = {"error": str(e)}
                     logger.exception("Failed to handle PDU %s", event_id)
+                finally:
+                    self._pending_pdus -= 1
+                    pdu_processing_time_histogram.observe(
+                        self._clock.time_msec() - start,
+                    )
 
         yield async.concurrently_execute(
             process_pdus_for_room, pdus_by_room.keys(),
-            TRANSACTION_CONCURRENCY_LIMIT,
+            self._room_concurrency or len(pdus_by_room),
         )
 
         if hasattr(transaction, "edus"):
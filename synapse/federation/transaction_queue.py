@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import hashlib
+import simplejson as json
+import struct
 
 from twisted.internet import defer
 
@@ -21,7 +24,9 @@ from .units import Transaction, Edu
 
 from synapse.api.errors import HttpResponseException
 from synapse.util import logcontext
-from synapse.util.async import run_on_reactor
+from synapse.util.async import (
+    concurrently_execute, run_on_reactor, ObservableDeferred,
+)
 from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 from synapse.util.metrics import measure_func
 from synapse.handlers.presence import format_user_presence_state, get_interested_remotes
@@ -42,6 +47,11 @@ sent_edus_counter = client_metrics.register_counter("sent_edus")
 
 sent_transactions_counter = client_metrics.register_counter("sent_transactions")
 
+# The number of PDUs dropped from the queues of unreachable destinations, and
+# the number of PDUs sent to catch them up once they are reachable again
+dropped_pdus_counter = metrics.register_counter("catch_up_dropped_pdus")
+catch_up_pdus_counter = metrics.register_counter("catch_up_sent_pdus")
+
 
 class TransactionQueue(object):
     """This class makes sure we only have one transaction in flight at
@@ -50,6 +60,31 @@ class TransactionQueue(object):
     It batches pending PDUs into single transactions.
     """
 
+    # The number of events to fetch from the events stream at a time in
+    # notify_new_events
+    EVENTS_PAGE_SIZE = 100
+
+    # The most PDUs and EDUs to send in a transaction. Each presence state
+    # counts as an EDU. Device messages and device list updates aren't
+    # counted, as they are limited when they're fetched from the database.
+    MAX_PDUS_PER_TRANSACTION = 50
+    MAX_EDUS_PER_TRANSACTION = 100
+
+    # The number of PDUs and EDUs sent in each transaction to a destination
+    # adapts between these limits: it grows while the destination accepts our
+    # transactions within TARGET_TRANSACTION_RTT_MS, and halves otherwise.
+    MIN_TRANSACTION_SIZE = 10
+    MAX_TRANSACTION_SIZE = MAX_PDUS_PER_TRANSACTION + MAX_EDUS_PER_TRANSACTION
+    TRANSACTION_SIZE_STEP = 10
+    TARGET_TRANSACTION_RTT_MS = 5000
+
+    # The most rooms to look up the current hosts of at once
+    HOSTS_LOOKUP_CONCURRENCY = 10
+
+    # How long to wait before retrying a destination which has rate limited
+    # us, if it doesn't say
+    RATE_LIMITED_RETRY_MS = 5000
+
     def __init__(self, hs):
         self.server_name = hs.hostname
 
@@ -62,6 +97,11 @@ class TransactionQueue(object):
         self.clock = hs.get_clock()
         self.is_mine_id = hs.is_mine_id
 
+        # If there are several federation senders, each only sends to the
+        # destinations in its shard.
+        self._shard_count = hs.config.federation_sender_instances
+        self._shard = hs.config.worker_federation_sender_instance
+
         # Is a mapping from destinations -> deferreds. Used to keep track
         # of which destinations have transactions in flight and when they are
         # done
@@ -108,6 +148,54 @@ class TransactionQueue(object):
         # destination -> list of tuple(failure, deferred)
         self.pending_failures_by_dest = {}
 
+        # destination -> the max number of PDUs and EDUs to send in the next
+        # transaction, for destinations below MAX_TRANSACTION_SIZE
+        self._transaction_size_by_dest = {}
+
+        # destination -> when we queued the oldest thing still waiting to be
+        # sent to it, in ms
+        self._queued_since_by_dest = {}
+
+        # Destinations which we have failed to reach, and so don't queue PDUs
+        # for. Once they are reachable we send them the latest of our events in
+        # each room instead, and they fetch any they are missing with
+        # get_missing_events.
+        # destination -> the stream position to catch up from if we haven't
+        # stored one for the destination yet, or None if we haven't dropped
+        # any of its PDUs yet
+        self._catching_up_by_dest = {}
+
+        # Destinations which have rate limited us, and which we are waiting to
+        # retry. Their queues are kept.
+        self._rate_limited_dests = set()
+
+        metrics.register_callback(
+            "catching_up_destinations",
+            lambda: len(self._catching_up_by_dest),
+        )
+
+        # We don't label these by destination, as there can be many
+        # thousands of them. The totals are given by pending_pdus and
+        # pending_edus.
+        metrics.register_callback(
+            "queued_destinations",
+            lambda: len(self._queued_since_by_dest),
+        )
+        metrics.register_callback(
+            "max_destination_queue_depth",
+            lambda: max([0] + [
+                self._get_queue_depth(destination)
+                for destination in self._queued_since_by_dest
+            ]),
+        )
+        metrics.register_callback(
+            "max_destination_queue_age_ms",
+            lambda: max([0] + [
+                self.clock.time_msec() - ts
+                for ts in self._queued_since_by_dest.values()
+            ]),
+        )
+
         # destination -> stream_id of last successfully sent to-device message.
         # NB: may be a long or an int.
         self.last_device_stream_id_by_dest = {}
@@ -124,6 +212,15 @@ class TransactionQueue(object):
         self._is_processing = False
         self._last_poked_id = -1
 
+        # The position in the events stream up to which we have queued events
+        # to be sent, i.e. the events federation_out_pos
+        self._federation_out_pos = -1
+
+        metrics.register_callback(
+            "events_stream_lag",
+            lambda: max(0, self._last_poked_id - self._federation_out_pos),
+        )
+
         self._processing_pending_presence = False
 
     def can_send_to(self, destination):
@@ -141,6 +238,9 @@ class TransactionQueue(object):
 
         if destination == self.server_name:
             return False
+        if self._shard_count > 1:
+            if get_destination_shard(destination, self._shard_count) != self._shard:
+                return False
         if self.server_name.startswith("localhost"):
             return destination.startswith("localhost")
         else:
@@ -158,54 +258,107 @@ class TransactionQueue(object):
 
         try:
             self._is_processing = True
+
+            last_token = yield self.store.get_federation_out_pos(
+                "events", self._shard,
+            )
+            self._federation_out_pos = last_token
+
+            next_page = None
             while True:
-                last_token = yield self.store.get_federation_out_pos("events")
-                next_token, events = yield self.store.get_all_new_events_stream(
-                    last_token, self._last_poked_id, limit=20,
+                if next_page is None:
+                    next_page = self._fetch_events_page(last_token)
+                next_token, events = yield logcontext.make_deferred_yieldable(
+                    next_page.observe(),
                 )
+                next_page = None
 
                 logger.debug("Handling %s -> %s", last_token, next_token)
 
                 if not events and next_token >= self._last_poked_id:
                     break
 
-                for event in events:
-                    # Only send events for this server.
-                    send_on_behalf_of = event.internal_metadata.get_send_on_behalf_of()
-                    is_mine = self.is_mine_id(event.event_id)
-                    if not is_mine and send_on_behalf_of is None:
-                        continue
-
-                    # Get the state from before the event.
-                    # We need to make sure that this is the state from before
-                    # the event and not from after it.
-                    # Otherwise if the last member on a server in a room is
-                    # banned then it won't receive the event because it won't
-                    # be in the room after the ban.
-                    destinations = yield self.state.get_current_hosts_in_room(
-                        event.room_id, latest_event_ids=[
-                            prev_id for prev_id, _ in event.prev_events
-                        ],
-                    )
-                    destinations = set(destinations)
-
-                    if send_on_behalf_of is not None:
-                        # If we are sending the event on behalf of another server
-                        # then it already has the event and there is no reason to
-                        # send the event to it.
-                        destinations.discard(send_on_behalf_of)
+                # If we're behind, fetch the next page while we work out where
+                # to send the events in this one.
+                if next_token < self._last_poked_id:
+                    next_page = self._fetch_events_page(next_token)
 
-                    logger.debug("Sending %s to %r", event, destinations)
-
-                    self._send_pdu(event, destinations)
+                yield self._send_events(events)
 
                 yield self.store.update_federation_out_pos(
-                    "events", next_token
+                    "events", next_token, self._shard,
                 )
+                last_token = next_token
+                self._federation_out_pos = next_token
 
         finally:
             self._is_processing = False
 
+    def _fetch_events_page(self, from_token):
+        """Starts fetching the next page of events after `from_token`.
+
+        Returns:
+            ObservableDeferred[(int, list[FrozenEvent])]: the token up to which
+                events were fetched, and the events.
+        """
+        d = logcontext.preserve_fn(self.store.get_all_new_events_stream)(
+            from_token, self._last_poked_id, limit=self.EVENTS_PAGE_SIZE,
+        )
+        # We consume errors so that a page we end up not needing doesn't log
+        # an unhandled error.
+        return ObservableDeferred(d, consumeErrors=True)
+
+    @measure_func("txnqueue._send_events")
+    @defer.inlineCallbacks
+    def _send_events(self, events):
+        """Works out where to send a batch of events and queues them up to be
+        sent, in order.
+        """
+        # Only send events for this server.
+        events = [
+            event for event in events
+            if self.is_mine_id(event.event_id) or
+            event.internal_metadata.get_send_on_behalf_of() is not None
+        ]
+
+        # The destinations only depend on the room and the prev events, so we
+        # look up the hosts for each distinct (room, prev events) at once.
+        hosts_by_key = {}
+        for event in events:
+            hosts_by_key[_get_hosts_key(event)] = None
+
+        @defer.inlineCallbacks
+        def get_hosts(key):
+            room_id, prev_event_ids = key
+            # Get the state from before the event.
+            # We need to make sure that this is the state from before
+            # the event and not from after it.
+            # Otherwise if the last member on a server in a room is
+            # banned then it won't receive the event because it won't
+            # be in the room after the ban.
+            hosts = yield self.state.get_current_hosts_in_room(
+                room_id, latest_event_ids=list(prev_event_ids),
+            )
+            hosts_by_key[key] = hosts
+
+        yield concurrently_execute(
+            get_hosts, list(hosts_by_key), self.HOSTS_LOOKUP_CONCURRENCY,
+        )
+
+        for event in events:
+            destinations = set(hosts_by_key[_get_hosts_key(event)])
+
+            send_on_behalf_of = event.internal_metadata.get_send_on_behalf_of()
+            if send_on_behalf_of is not None:
+                # If we are sending the event on behalf of another server
+                # then it already has the event and there is no reason to
+                # send the event to it.
+                destinations.discard(send_on_behalf_of)
+
+            logger.debug("Sending %s to %r", event, destinations)
+
+            self._send_pdu(event, destinations)
+
     def _send_pdu(self, pdu, destinations):
         # We loop through all destinations to see whether we already have
         # a transaction in progress. If we do, stick it in the pending_pdus
@@ -227,9 +380,23 @@ class TransactionQueue(object):
         sent_pdus_destination_dist.inc_by(len(destinations))
 
         for destination in destinations:
-            self.pending_pdus_by_dest.setdefault(destination, []).append(
-                (pdu, order)
-            )
+            if destination not in self._catching_up_by_dest:
+                self.pending_pdus_by_dest.setdefault(destination, []).append(
+                    (pdu, order)
+                )
+                self._mark_queued(destination)
+            elif self._catching_up_by_dest[destination] is None:
+                # This is the first PDU we've dropped, so we catch up from
+                # just before it.
+                stream_ordering = getattr(
+                    pdu.internal_metadata, "stream_ordering", None,
+                )
+                if stream_ordering is not None:
+                    self._catching_up_by_dest[destination] = stream_ordering - 1
+                else:
+                    self._catching_up_by_dest[destination] = (
+                        self._federation_out_pos
+                    )
 
             self._attempt_new_transaction(destination)
 
@@ -296,6 +463,7 @@ class TransactionQueue(object):
                 ).update({
                     state.user_id: state for state in states
                 })
+                self._mark_queued(destination)
 
                 self._attempt_new_transaction(destination)
 
@@ -318,6 +486,7 @@ class TransactionQueue(object):
             )[(edu.edu_type, key)] = edu
         else:
             self.pending_edus_by_dest.setdefault(destination, []).append(edu)
+        self._mark_queued(destination)
 
         self._attempt_new_transaction(destination)
 
@@ -331,6 +500,7 @@ class TransactionQueue(object):
         self.pending_failures_by_dest.setdefault(
             destination, []
         ).append(failure)
+        self._mark_queued(destination)
 
         self._attempt_new_transaction(destination)
 
@@ -346,6 +516,93 @@ class TransactionQueue(object):
     def get_current_token(self):
         return 0
 
+    def _mark_queued(self, destination):
+        self._queued_since_by_dest.setdefault(destination, self.clock.time_msec())
+
+    def _get_queue_depth(self, destination):
+        return (
+            len(self.pending_pdus_by_dest.get(destination, ())) +
+            len(self.pending_edus_by_dest.get(destination, ())) +
+            len(self.pending_edus_keyed_by_dest.get(destination, ())) +
+            len(self.pending_presence_by_dest.get(destination, ())) +
+            len(self.pending_failures_by_dest.get(destination, ()))
+        )
+
+    def _pop_pending_for_transaction(self, destination):
+        """Takes the PDUs and EDUs for the next transaction to a destination
+        off its queues, leaving the rest queued for later transactions.
+
+        PDUs are taken first, so that they aren't held up behind ephemeral
+        EDUs. EDUs then fill up the rest of the transaction, with presence
+        last. EDUs left queued remain keyed, so newer typing notifications or
+        presence for the same user replace them rather than being sent as
+        well.
+
+        Returns:
+            tuple: the PDUs as (event, order) tuples, the EDUs, the presence
+                states as a dict of user_id -> UserPresenceState, and the
+                failures.
+        """
+        size = self._transaction_size_by_dest.get(
+            destination, self.MAX_TRANSACTION_SIZE,
+        )
+
+        pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
+        limit = min(size, self.MAX_PDUS_PER_TRANSACTION)
+        pdus = pending_pdus[:limit]
+        if len(pending_pdus) > limit:
+            self.pending_pdus_by_dest[destination] = pending_pdus[limit:]
+
+        limit = min(size - len(pdus), self.MAX_EDUS_PER_TRANSACTION)
+
+        pending_edus = self.pending_edus_by_dest.pop(destination, [])
+        edus = pending_edus[:limit]
+        if len(pending_edus) > limit:
+            self.pending_edus_by_dest[destination] = pending_edus[limit:]
+        limit -= len(edus)
+
+        keyed_edus = self.pending_edus_keyed_by_dest.pop(destination, {}).items()
+        edus.extend(edu for _, edu in keyed_edus[:limit])
+        if len(keyed_edus) > limit:
+            self.pending_edus_keyed_by_dest[destination] = dict(keyed_edus[limit:])
+        limit -= min(limit, len(keyed_edus))
+
+        presence = self.pending_presence_by_dest.pop(destination, {}).items()
+        if len(presence) > limit:
+            self.pending_presence_by_dest[destination] = dict(presence[limit:])
+        presence = dict(presence[:limit])
+
+        failures = self.pending_failures_by_dest.pop(destination, [])
+
+        if not self._get_queue_depth(destination):
+            self._queued_since_by_dest.pop(destination, None)
+
+        return pdus, edus, presence, failures
+
+    def _update_transaction_size(self, destination, rtt_ms, accepted):
+        """Adjusts how much we send to a destination in each transaction,
+        given how the last transaction went.
+
+        Args:
+            destination (str)
+            rtt_ms (int): how long the remote took to respond
+            accepted (bool): whether the remote accepted the transaction and
+                all of its PDUs
+        """
+        size = self._transaction_size_by_dest.get(
+            destination, self.MAX_TRANSACTION_SIZE,
+        )
+        if accepted and rtt_ms <= self.TARGET_TRANSACTION_RTT_MS:
+            size += self.TRANSACTION_SIZE_STEP
+        else:
+            size //= 2
+        size = max(self.MIN_TRANSACTION_SIZE, size)
+
+        if size >= self.MAX_TRANSACTION_SIZE:
+            self._transaction_size_by_dest.pop(destination, None)
+        else:
+            self._transaction_size_by_dest[destination] = size
+
     def _attempt_new_transaction(self, destination):
         """Try to start a new transaction to this destination
 
@@ -371,6 +628,10 @@ class TransactionQueue(object):
             )
             return
 
+        if destination in self._rate_limited_dests:
+            logger.debug("TX [%s] Waiting to retry after rate limit", destination)
+            return
+
         logger.debug("TX [%s] Starting transaction loop", destination)
 
         # Drop the logcontext before starting the transaction. It doesn't
@@ -396,6 +657,9 @@ class TransactionQueue(object):
             # XXX: what's this for?
             yield run_on_reactor()
 
+            if destination in self._catching_up_by_dest:
+                yield self._queue_catch_up_pdus(destination)
+
             pending_pdus = []
             while True:
                 device_message_edus, device_stream_id, dev_list_id = (
@@ -411,13 +675,8 @@ class TransactionQueue(object):
                 # meantime, but not get sent because we hold the
                 # pending_transactions flag.
 
-                pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
-                pending_edus = self.pending_edus_by_dest.pop(destination, [])
-                pending_presence = self.pending_presence_by_dest.pop(destination, {})
-                pending_failures = self.pending_failures_by_dest.pop(destination, [])
-
-                pending_edus.extend(
-                    self.pending_edus_keyed_by_dest.pop(destination, {}).values()
+                pending_pdus, pending_edus, pending_presence, pending_failures = (
+                    self._pop_pending_for_transaction(destination)
                 )
 
                 pending_edus.extend(device_message_edus)
@@ -456,6 +715,17 @@ class TransactionQueue(object):
                 )
                 if success:
                     sent_transactions_counter.inc()
+
+                    stream_orderings = [
+                        p.internal_metadata.stream_ordering
+                        for p, _ in pending_pdus
+                        if hasattr(p.internal_metadata, "stream_ordering")
+                    ]
+                    if stream_orderings:
+                        yield self.store.set_destination_last_sent_stream_ordering(
+                            destination, max(stream_orderings),
+                        )
+
                     # Remove the acknowledged device messages from the database
                     # Only bother if we actually sent some device messages
                     if device_message_edus:
@@ -470,6 +740,7 @@ class TransactionQueue(object):
                     self.last_device_stream_id_by_dest[destination] = device_stream_id
                     self.last_device_list_stream_id_by_dest[destination] = dev_list_id
                 else:
+                    self._start_catch_up(destination, pending_pdus)
                     break
         except NotRetryingDestination as e:
             logger.debug(
@@ -480,6 +751,21 @@ class TransactionQueue(object):
                     (e.retry_last_ts + e.retry_interval) / 1000.0
                 ),
             )
+            self._start_catch_up(destination, pending_pdus)
+        except HttpResponseException as e:
+            if e.code == 429:
+                self._retry_after_rate_limit(destination, pending_pdus, e)
+                return
+
+            logger.warn(
+                "TX [%s] Failed to send transaction: %s",
+                destination,
+                e,
+            )
+            for p, _ in pending_pdus:
+                logger.info("Failed to send event %s to %s", p.event_id,
+                            destination)
+            self._start_catch_up(destination, pending_pdus)
         except Exception as e:
             logger.warn(
                 "TX [%s] Failed to send transaction: %s",
@@ -489,10 +775,151 @@ class TransactionQueue(object):
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             destination)
+            self._start_catch_up(destination, pending_pdus)
         finally:
             # We want to be *very* sure we delete this after we stop processing
             self.pending_transactions.pop(destination, None)
 
+    def _retry_after_rate_limit(self, destination, failed_pdus, e):
+        """Requeues the PDUs a destination rate limited us for, and tries
+        again once it said we could, or after RATE_LIMITED_RETRY_MS.
+
+        A destination which rate limits us is up, so we keep its queue rather
+        than catching it up later.
+
+        Args:
+            destination (str)
+            failed_pdus (list[(FrozenEvent, int)]): the PDUs we failed to send
+            e (HttpResponseException): the 429 response
+        """
+        retry_after_ms = self.RATE_LIMITED_RETRY_MS
+        try:
+            retry_after_ms = int(json.loads(e.response)["retry_after_ms"])
+        except Exception:
+            pass
+
+        logger.info(
+            "TX [%s] Rate limited; retrying in %dms", destination, retry_after_ms,
+        )
+
+        # The PDUs were taken off the front of the queue, so go back there.
+        queued = self.pending_pdus_by_dest.get(destination, [])
+        self.pending_pdus_by_dest[destination] = list(failed_pdus) + queued
+        if failed_pdus:
+            self._mark_queued(destination)
+
+        self._rate_limited_dests.add(destination)
+
+        def retry():
+            self._rate_limited_dests.discard(destination)
+            self._attempt_new_transaction(destination)
+
+        self.clock.call_later(retry_after_ms / 1000.0, retry)
+
+    def _start_catch_up(self, destination, failed_pdus):
+        """Stops queuing PDUs for a destination we've failed to reach, and
+        drops those already queued.
+
+        Args:
+            destination (str)
+            failed_pdus (list[(FrozenEvent, int)]): the PDUs we failed to send
+        """
+        pdus = list(failed_pdus)
+        pdus.extend(self.pending_pdus_by_dest.pop(destination, []))
+        if not self._get_queue_depth(destination):
+            self._queued_since_by_dest.pop(destination, None)
+
+        # In case we've never successfully sent anything to the destination,
+        # remember where the PDUs we're dropping start from.
+        stream_orderings = [
+            p.internal_metadata.stream_ordering
+            for p, _ in pdus
+            if hasattr(p.internal_metadata, "stream_ordering")
+        ]
+        from_id = min(stream_orderings) - 1 if stream_orderings else None
+
+        if from_id is None and self._federation_out_pos >= 0:
+            # Nothing was queued, but any PDUs for the destination after this
+            # point in the events stream will be dropped.
+            from_id = self._federation_out_pos
+
+        prev_from_id = self._catching_up_by_dest.get(destination)
+        if prev_from_id is not None:
+            from_id = prev_from_id if from_id is None else min(from_id, prev_from_id)
+        self._catching_up_by_dest[destination] = from_id
+
+        if pdus:
+            logger.info(
+                "TX [%s] Dropping %d PDUs until destination is reachable",
+                destination, len(pdus),
+            )
+            dropped_pdus_counter.inc_by(len(pdus))
+
+    @defer.inlineCallbacks
+    def _queue_catch_up_pdus(self, destination):
+        """Queues the latest of our events in each room we share with a
+        destination which has missed some events while unreachable.
+        """
+        # New PDUs are queued as normal from now on.
+        from_id = self._catching_up_by_dest.pop(destination)
+
+        last_sent = yield self.store.get_destination_last_sent_stream_ordering(
+            destination,
+        )
+        if last_sent is not None:
+            from_id = last_sent
+        if from_id is None:
+            return
+
+        events = yield self.store.get_latest_local_events_since(from_id)
+
+        shared_room_ids = set()
+
+        @defer.inlineCallbacks
+        def check_room(room_id):
+            hosts = yield self.state.get_current_hosts_in_room(room_id)
+            if destination in hosts:
+                shared_room_ids.add(room_id)
+
+        yield concurrently_execute(
+            check_room,
+            set(event.room_id for event in events),
+            self.HOSTS_LOOKUP_CONCURRENCY,
+        )
+
+        catch_up_events = [
+            event
+            for event in sorted(
+                events, key=lambda e: e.internal_metadata.stream_ordering,
+            )
+            if event.room_id in shared_room_ids
+        ]
+
+        # Any events queued while we were looking these up are newer, so the
+        # catch up events go ahead of them.
+        queued = self.pending_pdus_by_dest.pop(destination, [])
+        queued_ids = set(p.event_id for p, _ in queued)
+        catch_up_events = [
+            event for event in catch_up_events if event.event_id not in queued_ids
+        ]
+        first_order = queued[0][1] if queued else self._order
+        pdus = [
+            (event, first_order - len(catch_up_events) + i)
+            for i, event in enumerate(catch_up_events)
+        ]
+        pdus.extend(queued)
+
+        if pdus:
+            self.pending_pdus_by_dest[destination] = pdus
+            self._mark_queued(destination)
+
+        if catch_up_events:
+            logger.info(
+                "TX [%s] Catching up with %d PDUs",
+                destination, len(catch_up_events),
+            )
+            catch_up_pdus_counter.inc_by(len(catch_up_events))
+
     @defer.inlineCallbacks
     def _get_new_device_messages(self, destination):
         last_device_stream_id = self.last_device_stream_id_by_dest.get(destination, 0)
@@ -593,11 +1020,14 @@ class TransactionQueue(object):
                         del p["age_ts"]
             return data
 
+        accepted = False
+        start = self.clock.time_msec()
         try:
             response = yield self.transport_layer.send_transaction(
                 transaction, json_data_cb
             )
             code = 200
+            accepted = True
 
             if response:
                 for e_id, r in response.get("pdus", {}).items():
@@ -606,6 +1036,7 @@ class TransactionQueue(object):
                             "Transaction returned error for %s: %s",
                             e_id, r,
                         )
+                        accepted = False
         except HttpResponseException as e:
             code = e.code
             response = e.response
@@ -616,6 +1047,10 @@ class TransactionQueue(object):
                     destination, txn_id, code
                 )
                 raise e
+        finally:
+            self._update_transaction_size(
+                destination, self.clock.time_msec() - start, accepted,
+            )
 
         logger.info(
             "TX [%s] {%s} got %d response",
@@ -639,3 +1074,39 @@ class TransactionQueue(object):
             success = False
 
         defer.returnValue(success)
+
+
+def _get_hosts_key(event):
+    """The key under which to look up the hosts to send an event to: its room
+    and prev events.
+    """
+    return (
+        event.room_id,
+        frozenset(prev_id for prev_id, _ in event.prev_events),
+    )
+
+
+def get_destination_shard(destination, shard_count):
+    """Works out which federation sender sends to a destination.
+
+    This uses jump consistent hashing, so that changing the number of senders
+    moves as few destinations as possible between them.
+
+    Args:
+        destination (str)
+        shard_count (int)
+
+    Returns:
+        int: between 0 and shard_count - 1
+    """
+    key, = struct.unpack(
+        ">Q", hashlib.sha1(destination.encode("utf-8")).digest()[:8],
+    )
+
+    shard = -1
+    candidate = 0
+    while candidate < shard_count:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        candidate = int((shard + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return shard
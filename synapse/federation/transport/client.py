@@ -164,6 +164,9 @@ class TransportLayerClient(object):
             json_data_callback=json_data_callback,
             long_retries=True,
             backoff_on_404=True,  # If we get a 404 the other side has gone
+            # The transaction queue waits and retries if we're rate limited,
+            # without marking the destination as down.
+            backoff_on_429=False,
         )
 
         logger.debug(
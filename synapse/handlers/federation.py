@@ -24,11 +24,15 @@ from synapse.api.errors import (
     AuthError, FederationError, StoreError, CodeMessageException, SynapseError,
 )
 from synapse.api.constants import EventTypes, Membership, RejectedReason
+from synapse.event_auth import auth_types_for_event
+from synapse.events.snapshot import EventContext
 from synapse.events.validator import EventValidator
 from synapse.util import unwrapFirstError, logcontext
 from synapse.util.metrics import measure_func
 from synapse.util.logutils import log_function
-from synapse.util.async import run_on_reactor, Linearizer
+from synapse.util.async import (
+    run_on_reactor, Linearizer, concurrently_execute, ObservableDeferred,
+)
 from synapse.util.frozenutils import unfreeze
 from synapse.crypto.event_signing import (
     compute_event_signature, add_hashes_and_signatures,
@@ -43,11 +47,31 @@ from synapse.util.distributor import user_joined_room
 
 from twisted.internet import defer
 
+from collections import deque
 import itertools
 import logging
 
+import synapse.metrics
+
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+# how long it takes to fetch and persist each page of backfilled events
+backfill_page_time_histogram = metrics.register_histogram(
+    "backfill_page_time_ms",
+    buckets=[100, 500, 1000, 5000, 10000, 30000, 60000, 120000],
+)
+
+# The number of missing auth events to fetch at once when joining a room
+MISSING_AUTH_EVENTS_CONCURRENCY = 10
+
+# The number of backfill edges to fetch the state of at once
+BACKFILL_STATE_CONCURRENCY = 5
+
+# The number of events to ask for in each page of backfill
+BACKFILL_PAGE_SIZE = 100
+
 
 class FederationHandler(BaseHandler):
     """Handles events that originated from federation.
@@ -81,6 +105,10 @@ class FederationHandler(BaseHandler):
         self.room_queues = {}
         self._room_pdu_linearizer = Linearizer("fed_room_pdu")
 
+        # Backfills of the next page of history which have been started ahead
+        # of a client asking for it: room_id -> ObservableDeferred
+        self._backfill_prefetches = {}
+
     @defer.inlineCallbacks
     @log_function
     def on_receive_pdu(self, origin, pdu, get_missing=True):
@@ -529,10 +557,15 @@ class FederationHandler(BaseHandler):
         This will attempt to get more events from the remote. This may return
         be successfull and still return no events if the other side has no new
         events to offer.
+
+        The page of events is persisted, along with any state and auth events
+        we had to fetch for it, in a single call to `persist_events`.
         """
         if dest == self.server_name:
             raise SynapseError(400, "Can't backfill from self.")
 
+        start = self.clock.time_msec()
+
         events = yield self.replication_layer.backfill(
             dest,
             room_id,
@@ -548,6 +581,7 @@ class FederationHandler(BaseHandler):
         events = [e for e in events if e.event_id not in seen_events]
 
         if not events:
+            backfill_page_time_histogram.observe(self.clock.time_msec() - start)
             defer.returnValue([])
 
         event_map = {e.event_id: e for e in events}
@@ -570,7 +604,9 @@ class FederationHandler(BaseHandler):
         auth_events = {}
         state_events = {}
         events_to_state = {}
-        for e_id in edges:
+
+        @defer.inlineCallbacks
+        def get_state_for_edge(e_id):
             state, auth = yield self.replication_layer.get_state_for_room(
                 destination=dest,
                 room_id=room_id,
@@ -581,6 +617,10 @@ class FederationHandler(BaseHandler):
             state_events.update({s.event_id: s for s in state})
             events_to_state[e_id] = state
 
+        yield concurrently_execute(
+            get_state_for_edge, edges, BACKFILL_STATE_CONCURRENCY,
+        )
+
         required_auth = set(
             a_id
             for event in events + state_events.values() + auth_events.values()
@@ -638,7 +678,9 @@ class FederationHandler(BaseHandler):
 
         ev_infos = []
         for a in auth_events.values():
-            if a.event_id in seen_events:
+            # Events in this page are persisted below as part of the timeline,
+            # rather than as outliers.
+            if a.event_id in seen_events or a.event_id in event_map:
                 continue
             a.internal_metadata.outlier = True
             ev_infos.append({
@@ -663,31 +705,148 @@ class FederationHandler(BaseHandler):
                 }
             })
 
-        yield self._handle_new_events(
-            dest, ev_infos,
-            backfilled=True,
-        )
+        contexts = yield self._prep_events(dest, ev_infos)
+
+        events_and_contexts = [
+            (ev_info["event"], context)
+            for ev_info, context in itertools.izip(ev_infos, contexts)
+        ]
+        # The contexts of the events in this page, by event id. They stay
+        # valid once the events are persisted, as their state groups are
+        # allocated up front.
+        page_contexts = {
+            event.event_id: context
+            for event, context in events_and_contexts
+            if not event.internal_metadata.is_outlier()
+        }
+
+        known_events = dict(auth_events)
+        known_events.update(event_map)
 
         events.sort(key=lambda e: e.depth)
 
         for event in events:
-            if event in events_to_state:
+            if event.event_id in events_to_state:
                 continue
 
-            # We store these one at a time since each event depends on the
-            # previous to work out the state.
-            # TODO: We can probably do something more clever here.
-            yield self._handle_new_event(
-                dest, event, backfilled=True,
+            # Each event's prev events come before it in this page, so we can
+            # usually work out its state from theirs without persisting them.
+            context = self._compute_context_from_prev_contexts(
+                event, page_contexts,
             )
+            if context is None:
+                # Resolving the state at this event needs its prev events in
+                # the database.
+                yield self.store.persist_events(
+                    events_and_contexts, backfilled=True,
+                )
+                events_and_contexts = []
+
+                context = yield self._prep_event(dest, event)
+            else:
+                auth_for_event = yield self._get_auth_events_from_state(
+                    event, context.prev_state_ids, known_events,
+                )
+                context = yield self._check_event_with_context(
+                    dest, event, context, auth_for_event,
+                )
+
+            events_and_contexts.append((event, context))
+            page_contexts[event.event_id] = context
+
+        yield self.store.persist_events(events_and_contexts, backfilled=True)
+
+        backfill_page_time_histogram.observe(self.clock.time_msec() - start)
 
         defer.returnValue(events)
 
+    def _compute_context_from_prev_contexts(self, event, prev_contexts):
+        """Works out the context for a backfilled event from the contexts of
+        its prev events, which may not have been persisted yet.
+
+        Args:
+            event (FrozenEvent)
+            prev_contexts (dict[str, EventContext]): the contexts of the events
+                which have been processed so far, by event id
+
+        Returns:
+            EventContext|None: None if the state at the event can't be worked
+                out without persisting its prev events first.
+        """
+        contexts = [prev_contexts.get(e_id) for e_id, _ in event.prev_events]
+        if not contexts or any(c is None or c.rejected for c in contexts):
+            return None
+
+        # We'd need to do state resolution if the prev events' state differs.
+        if len(set(c.state_group for c in contexts)) != 1:
+            return None
+
+        prev_context = contexts[0]
+
+        context = EventContext()
+        context.prev_state_ids = prev_context.current_state_ids
+        context.prev_state_events = []
+
+        if event.is_state():
+            key = (event.type, event.state_key)
+            if key in context.prev_state_ids:
+                event.unsigned["replaces_state"] = context.prev_state_ids[key]
+
+            context.current_state_ids = dict(context.prev_state_ids)
+            context.current_state_ids[key] = event.event_id
+            context.state_group = self.store.get_next_state_group()
+            context.prev_group = prev_context.state_group
+            context.delta_ids = {key: event.event_id}
+        else:
+            context.current_state_ids = context.prev_state_ids
+            context.state_group = prev_context.state_group
+            context.prev_group = prev_context.prev_group
+            context.delta_ids = prev_context.delta_ids
+
+        return context
+
+    @defer.inlineCallbacks
+    def _get_auth_events_from_state(self, event, state_ids, known_events):
+        """Gets the events from the given state which may be needed to auth
+        the event.
+
+        Args:
+            event (FrozenEvent)
+            state_ids (dict[(str, str), str]): the state at the event
+            known_events (dict[str, FrozenEvent]): events which may not have
+                been persisted yet, by event id
+
+        Returns:
+            Deferred[dict[(str, str), FrozenEvent]]
+        """
+        auth_ids = [
+            state_ids[key] for key in auth_types_for_event(event)
+            if key in state_ids
+        ]
+
+        auth_events = {
+            e_id: known_events[e_id] for e_id in auth_ids if e_id in known_events
+        }
+        missing_ids = [e_id for e_id in auth_ids if e_id not in auth_events]
+        if missing_ids:
+            fetched = yield self.store.get_events(missing_ids)
+            auth_events.update(fetched)
+
+        defer.returnValue({
+            (e.type, e.state_key): e for e in auth_events.values()
+        })
+
     @defer.inlineCallbacks
     def maybe_backfill(self, room_id, current_depth):
         """Checks the database to see if we should backfill before paginating,
         and if so do.
         """
+        prefetch = self._backfill_prefetches.get(room_id)
+        if prefetch:
+            # We're already fetching the next page of this room, which is
+            # probably the one we need.
+            yield logcontext.make_deferred_yieldable(prefetch.observe())
+
         extremities = yield self.store.get_oldest_events_with_depth_in_room(
             room_id
         )
@@ -755,11 +914,15 @@ class FederationHandler(BaseHandler):
             # TODO: Should we try multiple of these at a time?
             for dom in domains:
                 try:
-                    yield self.backfill(
+                    events = yield self.backfill(
                         dom, room_id,
-                        limit=100,
+                        limit=BACKFILL_PAGE_SIZE,
                         extremities=[e for e in extremities.keys()]
                     )
+                    if events:
+                        # The client will probably carry on paginating, so
+                        # get the next page ready while they read this one.
+                        self._prefetch_backfill(dom, room_id)
                     # If this succeeded then we probably already have the
                     # appropriate stuff.
                     # TODO: We can probably do something more intelligent here.
@@ -840,6 +1003,50 @@ class FederationHandler(BaseHandler):
 
         defer.returnValue(False)
 
+    def _prefetch_backfill(self, dest, room_id):
+        """Starts backfilling the page of history before the oldest events we
+        have in the room, if we aren't already.
+        """
+        if room_id in self._backfill_prefetches:
+            return
+
+        # The prefetch shouldn't be logged against whichever request made us
+        # start it.
+        with logcontext.PreserveLoggingContext():
+            d = self._backfill_next_page(dest, room_id)
+        self._backfill_prefetches[room_id] = ObservableDeferred(
+            d, consumeErrors=True,
+        )
+
+        def remove(r):
+            self._backfill_prefetches.pop(room_id, None)
+            return r
+        d.addBoth(remove)
+
+    @defer.inlineCallbacks
+    def _backfill_next_page(self, dest, room_id):
+        try:
+            extremities = yield self.store.get_oldest_events_with_depth_in_room(
+                room_id
+            )
+            if not extremities:
+                return
+
+            sorted_extremities = sorted(
+                extremities.items(),
+                key=lambda e: -int(e[1])
+            )
+
+            yield self.backfill(
+                dest, room_id,
+                limit=BACKFILL_PAGE_SIZE,
+                extremities=[e_id for e_id, _ in sorted_extremities[:5]],
+            )
+        except Exception as e:
+            logger.info(
+                "Failed to prefetch backfill from %s because %s", dest, e,
+            )
+
     @defer.inlineCallbacks
     def send_invite(self, target_host, event):
         """ Sends the invite to the remote server for signing.
@@ -1471,7 +1678,25 @@ class FederationHandler(BaseHandler):
         a bunch of outliers, but not a chunk of individual events that depend
         on each other for state calculations.
         """
-        contexts = yield logcontext.make_deferred_yieldable(defer.gatherResults(
+        contexts = yield self._prep_events(origin, event_infos)
+
+        yield self.store.persist_events(
+            [
+                (ev_info["event"], context)
+                for ev_info, context in itertools.izip(event_infos, contexts)
+            ],
+            backfilled=backfilled,
+        )
+
+    def _prep_events(self, origin, event_infos):
+        """Creates the contexts for events which don't depend on one another,
+        as for `_handle_new_events`, without persisting them.
+
+        Returns:
+            Deferred[list[EventContext]]: the contexts, in the same order as
+                `event_infos`
+        """
+        return logcontext.make_deferred_yieldable(defer.gatherResults(
             [
                 logcontext.preserve_fn(self._prep_event)(
                     origin,
@@ -1483,14 +1708,6 @@ class FederationHandler(BaseHandler):
             ], consumeErrors=True,
         ))
 
-        yield self.store.persist_events(
-            [
-                (ev_info["event"], context)
-                for ev_info, context in itertools.izip(event_infos, contexts)
-            ],
-            backfilled=backfilled,
-        )
-
     @defer.inlineCallbacks
     def _persist_auth_tree(self, origin, auth_events, state, event):
         """Checks the auth chain is valid (and passes auth checks) for the
@@ -1520,6 +1737,12 @@ class FederationHandler(BaseHandler):
             for e in itertools.chain(auth_events, state, [event])
         }
 
+        # The state and auth chain overlap, so we only check each event once.
+        events_to_check = []
+        for e in itertools.chain(auth_events, state, [event]):
+            if event_map[e.event_id] is e:
+                events_to_check.append(e)
+
         create_event = None
         for e in auth_events:
             if (e.type, e.state_key) == (EventTypes.Create, ""):
@@ -1532,7 +1755,8 @@ class FederationHandler(BaseHandler):
                 if e_id not in event_map:
                     missing_auth_events.add(e_id)
 
-        for e_id in missing_auth_events:
+        @defer.inlineCallbacks
+        def get_missing_auth_event(e_id):
             m_ev = yield self.replication_layer.get_pdu(
                 [origin],
                 e_id,
@@ -1544,11 +1768,19 @@ class FederationHandler(BaseHandler):
             else:
                 logger.info("Failed to find auth event %r", e_id)
 
-        for e in itertools.chain(auth_events, state, [event]):
+        yield concurrently_execute(
+            get_missing_auth_event, missing_auth_events,
+            MISSING_AUTH_EVENTS_CONCURRENCY,
+        )
+
+        # We check each event after its auth events, so that events whose auth
+        # events were rejected can be checked without them.
+        rejected_event_ids = set()
+        for e in _sorted_by_auth_events(events_to_check):
             auth_for_e = {
                 (event_map[e_id].type, event_map[e_id].state_key): event_map[e_id]
                 for e_id, _ in e.auth_events
-                if e_id in event_map
+                if e_id in event_map and e_id not in rejected_event_ids
             }
             if create_event:
                 auth_for_e[(EventTypes.Create, "")] = create_event
@@ -1567,8 +1799,9 @@ class FederationHandler(BaseHandler):
                     e.event_id, err.msg
                 )
 
-                if e == event:
+                if e.event_id == event.event_id:
                     raise
+                rejected_event_ids.add(e.event_id)
                 events_to_context[e.event_id].rejected = RejectedReason.AUTH_ERROR
 
         yield self.store.persist_events(
@@ -1605,6 +1838,27 @@ class FederationHandler(BaseHandler):
             event, old_state=state,
         )
 
+        context = yield self._check_event_with_context(
+            origin, event, context, auth_events,
+        )
+        defer.returnValue(context)
+
+    @defer.inlineCallbacks
+    def _check_event_with_context(self, origin, event, context, auth_events=None):
+        """Auths an event whose context has already been worked out, marking
+        the context as rejected if it fails.
+
+        Args:
+            origin (str)
+            event (FrozenEvent)
+            context (EventContext)
+            auth_events (dict[(str, str), FrozenEvent]|None): the events to
+                auth the event against. If not given, they are worked out
+                from the context's state.
+
+        Returns:
+            Deferred[EventContext]: the context
+        """
         if not auth_events:
             auth_events_ids = yield self.auth.compute_auth_events(
                 event, context.prev_state_ids, for_verification=True,
@@ -2290,3 +2544,45 @@ class FederationHandler(BaseHandler):
             )
         if "valid" not in response or not response["valid"]:
             raise AuthError(403, "Third party certificate was invalid")
+
+
+def _sorted_by_auth_events(events):
+    """Sorts a list of events so that each event comes after any of its auth
+    events which are in the list.
+
+    Args:
+        events (list[FrozenEvent])
+
+    Returns:
+        list[FrozenEvent]: the events in an order which respects the auth
+            chain, but is otherwise the original order. If there is a cycle
+            in the auth events, the events in it are added at the end.
+    """
+    event_ids = set(e.event_id for e in events)
+
+    # event_id -> number of its auth events which haven't been added yet
+    pending_auth_counts = {}
+    # event_id -> events which have it as an auth event
+    dependents = {}
+    for e in events:
+        auth_ids = set(e_id for e_id, _ in e.auth_events if e_id in event_ids)
+        pending_auth_counts[e.event_id] = len(auth_ids)
+        for auth_id in auth_ids:
+            dependents.setdefault(auth_id, []).append(e)
+
+    ready = deque(e for e in events if not pending_auth_counts[e.event_id])
+    ordered = []
+    while ready:
+        e = ready.popleft()
+        ordered.append(e)
+        for dependent in dependents.get(e.event_id, []):
+            pending_auth_counts[dependent.event_id] -= 1
+            if not pending_auth_counts[dependent.event_id]:
+                ready.append(dependent)
+
+    if len(ordered) < len(events):
+        logger.warn("Cycle in auth events of %d events", len(events) - len(ordered))
+        added = set(e.event_id for e in ordered)
+        ordered.extend(e for e in events if e.event_id not in added)
+
+    return ordered
@@ -23,10 +23,12 @@ from synapse.events.validator import EventValidator
 from synapse.types import (
     UserID, RoomAlias, RoomStreamToken,
 )
-from synapse.util.async import run_on_reactor, ReadWriteLock, Limiter
+from synapse.storage.background_updates import BackgroundUpdatePerformance
+from synapse.util.async import run_on_reactor, ReadWriteLock, Limiter, sleep
 from synapse.util.logcontext import preserve_fn
 from synapse.util.metrics import measure_func
 from synapse.util.frozenutils import unfreeze
+from synapse.util.stringutils import random_string
 from synapse.visibility import filter_events_for_client
 
 from ._base import BaseHandler
@@ -41,6 +43,13 @@ logger = logging.getLogger(__name__)
 
 
 class MessageHandler(BaseHandler):
+    # Purges are done in batches, sized so that each batch takes roughly
+    # PURGE_HISTORY_BATCH_DURATION_MS, with a pause between batches so that
+    # we don't starve event persistence of database time.
+    PURGE_HISTORY_BATCH_DURATION_MS = 100
+    PURGE_HISTORY_INTERVAL_MS = 100
+    MINIMUM_PURGE_HISTORY_BATCH_SIZE = 100
+    DEFAULT_PURGE_HISTORY_BATCH_SIZE = 100
 
     def __init__(self, hs):
         super(MessageHandler, self).__init__(hs)
@@ -52,6 +61,9 @@ class MessageHandler(BaseHandler):
 
         self.pagination_lock = ReadWriteLock()
 
+        # purge_id -> BackgroundUpdatePerformance, for purges in progress
+        self._purge_performance = {}
+
         self.pusher_pool = hs.get_pusherpool()
 
         # We arbitrarily limit concurrent event creation for a room to 5.
@@ -63,16 +75,130 @@ class MessageHandler(BaseHandler):
         self.spam_checker = hs.get_spam_checker()
 
     @defer.inlineCallbacks
-    def purge_history(self, room_id, event_id):
+    def start_purge_history(self, room_id, event_id):
+        """Start purging the history of a room before the given event.
+
+        The purge is carried out in the background; its progress can be
+        queried with `get_purge_status`.
+
+        Args:
+            room_id (str): room to purge
+            event_id (str): events before this one are purged
+
+        Returns:
+            Deferred[str]: the ID of the purge job
+        """
         event = yield self.store.get_event(event_id)
 
         if event.room_id != room_id:
             raise SynapseError(400, "Event is for wrong room.")
 
         depth = event.depth
+        purge_id = random_string(16)
+
+        logger.info(
+            "[purge] starting purge_id %s for %s before depth %i",
+            purge_id, room_id, depth,
+        )
 
         with (yield self.pagination_lock.write(room_id)):
-            yield self.store.delete_old_state(room_id, depth)
+            yield self.store.start_purge_history(purge_id, room_id, depth)
+
+        preserve_fn(self._purge_history_loop)(purge_id, room_id)
+
+        defer.returnValue(purge_id)
+
+    @defer.inlineCallbacks
+    def resume_purge_history(self):
+        """Restart any purge jobs which were interrupted by a restart
+        """
+        purge_ids = yield self.store.get_active_purge_history_ids()
+        for purge_id in purge_ids:
+            job = yield self.store.get_purge_history(purge_id)
+            logger.info(
+                "[purge] resuming purge_id %s for %s", purge_id, job["room_id"],
+            )
+            preserve_fn(self._purge_history_loop)(purge_id, job["room_id"])
+
+    @defer.inlineCallbacks
+    def _purge_history_loop(self, purge_id, room_id):
+        if purge_id in self._purge_performance:
+            # already running
+            return
+
+        performance = BackgroundUpdatePerformance(purge_id)
+        self._purge_performance[purge_id] = performance
+
+        try:
+            while True:
+                items_per_ms = performance.average_items_per_ms()
+                if items_per_ms is not None:
+                    batch_size = int(
+                        self.PURGE_HISTORY_BATCH_DURATION_MS * items_per_ms
+                    )
+                    # Clamp the batch size so that we always make progress
+                    batch_size = max(
+                        batch_size, self.MINIMUM_PURGE_HISTORY_BATCH_SIZE,
+                    )
+                else:
+                    batch_size = self.DEFAULT_PURGE_HISTORY_BATCH_SIZE
+
+                # We take the pagination lock for each batch rather than for
+                # the whole purge, so that the room can still be paginated
+                # while a long purge is in progress.
+                with (yield self.pagination_lock.write(room_id)):
+                    time_start = self.clock.time_msec()
+                    processed = yield self.store.purge_history_batch(
+                        purge_id, batch_size,
+                    )
+                    duration_ms = self.clock.time_msec() - time_start
+
+                if not processed:
+                    break
+
+                performance.update(processed, duration_ms)
+
+                yield sleep(self.PURGE_HISTORY_INTERVAL_MS / 1000.)
+        except Exception:
+            logger.exception("[purge] failed purge_id %s", purge_id)
+            yield self.store.set_purge_history_failed(purge_id)
+        finally:
+            self._purge_performance.pop(purge_id, None)
+
+    @defer.inlineCallbacks
+    def get_purge_status(self, purge_id):
+        """Get the progress of a purge job
+
+        Args:
+            purge_id (str)
+
+        Returns:
+            Deferred[dict]: with keys `status` (one of "active", "complete" or
+                "failed"), `events_total`, `events_processed` and, for active
+                purges where we have an estimate, `eta_ms`.
+        """
+        job = yield self.store.get_purge_history(purge_id)
+        if job is None:
+            raise SynapseError(404, "Unknown purge_id", Codes.NOT_FOUND)
+
+        ret = {
+            "room_id": job["room_id"],
+            "status": job["status"],
+            "events_total": job["events_total"],
+            "events_processed": job["events_processed"],
+        }
+
+        performance = self._purge_performance.get(purge_id)
+        items_per_ms = performance and performance.total_items_per_ms()
+        if job["status"] == "active" and items_per_ms:
+            remaining = max(job["events_total"] - job["events_processed"], 0)
+            batches = remaining / max(performance.avg_item_count, 1)
+            ret["eta_ms"] = int(
+                remaining / items_per_ms
+                + batches * self.PURGE_HISTORY_INTERVAL_MS
+            )
+
+        defer.returnValue(ret)
 
     @defer.inlineCallbacks
     def get_messages(self, requester, room_id=None, pagin_config=None,
@@ -180,6 +306,23 @@ class MessageHandler(BaseHandler):
             "end": next_token.to_string(),
         }
 
+        if events and event_filter and event_filter.lazy_load_members:
+            # Include the membership events for the senders of the returned
+            # events, since the client won't necessarily have them.
+            state_ids = yield self.store.get_state_ids_for_event(
+                events[0].event_id,
+                types=[
+                    (EventTypes.Member, sender)
+                    for sender in set(e.sender for e in events)
+                ],
+            )
+            if state_ids:
+                state = yield self.store.get_events(state_ids.values())
+                chunk["state"] = [
+                    serialize_event(e, time_now, as_client_event)
+                    for e in state.itervalues()
+                ]
+
         defer.returnValue(chunk)
 
     @defer.inlineCallbacks
@@ -17,9 +17,7 @@ from twisted.internet import defer
 
 from ._base import BaseHandler
 
-from synapse.api.constants import (
-    EventTypes, JoinRules,
-)
+from synapse.api.constants import JoinRules
 from synapse.util.logcontext import make_deferred_yieldable, preserve_fn
 from synapse.util.async import concurrently_execute
 from synapse.util.caches.descriptors import cachedInlineCallbacks
@@ -126,13 +124,14 @@ class RoomListHandler(BaseHandler):
         @defer.inlineCallbacks
         def get_order_for_room(room_id):
             # Most of the rooms won't have changed between the since token and
-            # now (especially if the since token is "now"). So, we can ask what
-            # the current users are in a room (that will hit a cache) and then
-            # check if the room has changed since the since token. (We have to
-            # do it in that order to avoid races).
+            # now (especially if the since token is "now"). So, we can ask how
+            # many users are currently in a room (that will hit a cache) and
+            # then check if the room has changed since the since token. (We
+            # have to do it in that order to avoid races).
             # If things have changed then fall back to getting the current state
             # at the since token.
-            joined_users = yield self.store.get_users_in_room(room_id)
+            summary = yield self.store.get_room_summary(room_id)
+            num_joined_users = summary["joined_members"]
             if self.store.has_room_changed_since(room_id, stream_token):
                 latest_event_ids = yield self.store.get_forward_extremeties_for_room(
                     room_id, stream_token
@@ -144,8 +143,8 @@ class RoomListHandler(BaseHandler):
                 joined_users = yield self.state_handler.get_current_user_in_room(
                     room_id, latest_event_ids,
                 )
+                num_joined_users = len(joined_users)
 
-            num_joined_users = len(joined_users)
             rooms_to_num_joined[room_id] = num_joined_users
 
             if num_joined_users == 0:
@@ -296,34 +295,14 @@ class RoomListHandler(BaseHandler):
             "num_joined_members": num_joined_users,
         }
 
-        current_state_ids = yield self.store.get_current_state_ids(
+        summary = yield self.store.get_room_summary(
             room_id, on_invalidate=cache_context.invalidate,
         )
 
-        event_map = yield self.store.get_events([
-            event_id for key, event_id in current_state_ids.iteritems()
-            if key[0] in (
-                EventTypes.JoinRules,
-                EventTypes.Name,
-                EventTypes.Topic,
-                EventTypes.CanonicalAlias,
-                EventTypes.RoomHistoryVisibility,
-                EventTypes.GuestAccess,
-                "m.room.avatar",
-            )
-        ])
-
-        current_state = {
-            (ev.type, ev.state_key): ev
-            for ev in event_map.values()
-        }
-
         # Double check that this is actually a public room.
-        join_rules_event = current_state.get((EventTypes.JoinRules, ""))
-        if join_rules_event:
-            join_rule = join_rules_event.content.get("join_rule", None)
-            if not allow_private and join_rule and join_rule != JoinRules.PUBLIC:
-                defer.returnValue(None)
+        join_rule = summary["join_rule"]
+        if not allow_private and join_rule and join_rule != JoinRules.PUBLIC:
+            defer.returnValue(None)
 
         if with_alias:
             aliases = yield self.store.get_aliases_for_room(
@@ -332,41 +311,22 @@ class RoomListHandler(BaseHandler):
             if aliases:
                 result["aliases"] = aliases
 
-        name_event = yield current_state.get((EventTypes.Name, ""))
-        if name_event:
-            name = name_event.content.get("name", None)
-            if name:
-                result["name"] = name
-
-        topic_event = current_state.get((EventTypes.Topic, ""))
-        if topic_event:
-            topic = topic_event.content.get("topic", None)
-            if topic:
-                result["topic"] = topic
-
-        canonical_event = current_state.get((EventTypes.CanonicalAlias, ""))
-        if canonical_event:
-            canonical_alias = canonical_event.content.get("alias", None)
-            if canonical_alias:
-                result["canonical_alias"] = canonical_alias
-
-        visibility_event = current_state.get((EventTypes.RoomHistoryVisibility, ""))
-        visibility = None
-        if visibility_event:
-            visibility = visibility_event.content.get("history_visibility", None)
-        result["world_readable"] = visibility == "world_readable"
-
-        guest_event = current_state.get((EventTypes.GuestAccess, ""))
-        guest = None
-        if guest_event:
-            guest = guest_event.content.get("guest_access", None)
-        result["guest_can_join"] = guest == "can_join"
-
-        avatar_event = current_state.get(("m.room.avatar", ""))
-        if avatar_event:
-            avatar_url = avatar_event.content.get("url", None)
-            if avatar_url:
-                result["avatar_url"] = avatar_url
+        if summary["name"]:
+            result["name"] = summary["name"]
+
+        if summary["topic"]:
+            result["topic"] = summary["topic"]
+
+        if summary["canonical_alias"]:
+            result["canonical_alias"] = summary["canonical_alias"]
+
+        result["world_readable"] = (
+            summary["history_visibility"] == "world_readable"
+        )
+        result["guest_can_join"] = summary["guest_access"] == "can_join"
+
+        if summary["avatar_url"]:
+            result["avatar_url"] = summary["avatar_url"]
 
         defer.returnValue(result)
 
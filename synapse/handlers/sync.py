@@ -14,9 +14,11 @@
 # limitations under the License.
 
 from synapse.api.constants import Membership, EventTypes
-from synapse.util.async import concurrently_execute
+from synapse.util.async import concurrently_execute, ObservableDeferred
 from synapse.util.logcontext import LoggingContext, make_deferred_yieldable, preserve_fn
 from synapse.util.metrics import Measure, measure_func
+from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
 from synapse.push.clientformat import format_push_rules_for_user
 from synapse.visibility import filter_events_for_client
@@ -24,12 +26,43 @@ from synapse.types import RoomStreamToken
 
 from twisted.internet import defer
 
+from canonicaljson import encode_canonical_json
+
+import synapse.metrics
+
 import collections
 import logging
 import itertools
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+# How long it takes to generate the sync entry for each room
+room_entry_time_histogram = metrics.register_histogram(
+    "room_entry_time_ms", labels=["type"],
+    buckets=[1, 5, 10, 50, 100, 500, 1000, 5000, 10000],
+)
+
+# The number of syncs which reused the shared part of a sync result generated
+# for another of the user's devices
+shared_sync_results_counter = metrics.register_counter("shared_sync_results")
+
+# How long to remember which membership events we have sent to a device, for
+# lazy-loading members, after its last sync.
+LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
+
+# The maximum number of membership events to remember per device
+LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 1000
+
+# How long to keep the device-independent part of a sync result after it has
+# been generated, so that it can be reused for the user's other devices
+SHARED_SYNC_CACHE_TIMEOUT_MS = 10 * 1000
+
+# The number of members we assume a room has when estimating the cost of
+# syncing it, if we don't have its membership cached
+DEFAULT_ROOM_MEMBER_COUNT_ESTIMATE = 100
+
 
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
@@ -170,7 +203,21 @@ class SyncHandler(object):
         self.event_sources = hs.get_event_sources()
         self.clock = hs.get_clock()
         self.response_cache = ResponseCache(hs)
+        self.shared_sync_cache = ResponseCache(
+            hs, timeout_ms=SHARED_SYNC_CACHE_TIMEOUT_MS,
+        )
         self.state = hs.get_state_handler()
+        self.room_concurrency = hs.config.sync_room_concurrency
+
+        # (user_id, device_id) -> LruCache((room_id, user_id) -> event_id) of
+        # the membership events each device has been sent when lazy-loading
+        # members, so that we don't send them again.
+        self.lazy_loaded_members_cache = ExpiringCache(
+            "lazy_loaded_members_cache", self.clock,
+            expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
+            reset_expiry_on_get=True,
+        )
+        self.lazy_loaded_members_cache.start()
 
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
@@ -461,7 +508,22 @@ class SyncHandler(object):
         # updates even if they occured logically before the previous event.
         # TODO(mjark) Check for new redactions in the state events.
 
+        filter_collection = sync_config.filter_collection
+        lazy_load_members = filter_collection.lazy_load_members()
+
         with Measure(self.clock, "compute_state_delta"):
+            timeline_state = {
+                (event.type, event.state_key): event.event_id
+                for event in batch.events if event.is_state()
+            }
+
+            if lazy_load_members:
+                # We only send the membership events of the senders of the
+                # timeline events, unless the timeline already includes them.
+                member_keys = set(
+                    (EventTypes.Member, event.sender) for event in batch.events
+                ).difference(timeline_state)
+
             if full_state:
                 if batch:
                     current_state_ids = yield self.store.get_state_ids_for_event(
@@ -478,11 +540,6 @@ class SyncHandler(object):
 
                     state_ids = current_state_ids
 
-                timeline_state = {
-                    (event.type, event.state_key): event.event_id
-                    for event in batch.events if event.is_state()
-                }
-
                 state_ids = _calculate_state(
                     timeline_contains=timeline_state,
                     timeline_start=state_ids,
@@ -494,6 +551,16 @@ class SyncHandler(object):
                     room_id, stream_position=since_token
                 )
 
+                if lazy_load_members:
+                    # the client won't necessarily have been sent the
+                    # membership events in the previous state, so we rely on
+                    # the lazy-loaded members cache instead.
+                    state_at_previous_sync = {
+                        key: event_id
+                        for key, event_id in state_at_previous_sync.iteritems()
+                        if key[0] != EventTypes.Member
+                    }
+
                 current_state_ids = yield self.store.get_state_ids_for_event(
                     batch.events[-1].event_id
                 )
@@ -502,48 +569,84 @@ class SyncHandler(object):
                     batch.events[0].event_id
                 )
 
-                timeline_state = {
-                    (event.type, event.state_key): event.event_id
-                    for event in batch.events if event.is_state()
-                }
-
                 state_ids = _calculate_state(
                     timeline_contains=timeline_state,
                     timeline_start=state_at_timeline_start,
                     previous=state_at_previous_sync,
                     current=current_state_ids,
                 )
+            elif lazy_load_members and member_keys:
+                # The client has all the state up to the start of the
+                # timeline, except perhaps the senders' membership events.
+                state_ids = yield self.store.get_state_ids_for_event(
+                    batch.events[0].event_id, types=list(member_keys),
+                )
             else:
                 state_ids = {}
 
+            if lazy_load_members:
+                state_ids = self._filter_lazy_loaded_members(
+                    room_id, batch, sync_config, state_ids, member_keys,
+                    full_state,
+                )
+
         state = {}
         if state_ids:
             state = yield self.store.get_events(state_ids.values())
 
         defer.returnValue({
             (e.type, e.state_key): e
-            for e in sync_config.filter_collection.filter_room_state(state.values())
+            for e in filter_collection.filter_room_state(state.values())
         })
 
-    @defer.inlineCallbacks
-    def unread_notifs_for_room_id(self, room_id, sync_config):
-        with Measure(self.clock, "unread_notifs_for_room_id"):
-            last_unread_event_id = yield self.store.get_last_receipt_event_id_for_user(
-                user_id=sync_config.user.to_string(),
-                room_id=room_id,
-                receipt_type="m.read"
-            )
+    def _filter_lazy_loaded_members(self, room_id, batch, sync_config, state_ids,
+                                    member_keys, full_state):
+        """Removes the membership events that the client doesn't need from
+        the state to be returned, when the client is lazy-loading members.
 
-            notifs = []
-            if last_unread_event_id:
-                notifs = yield self.store.get_unread_event_push_actions_by_room_for_user(
-                    room_id, sync_config.user.to_string(), last_unread_event_id
-                )
-                defer.returnValue(notifs)
+        Args:
+            room_id(str)
+            batch(synapse.handlers.sync.TimelineBatch): The timeline batch for
+                the room that will be sent to the user.
+            sync_config(synapse.handlers.sync.SyncConfig)
+            state_ids(dict[(str, str), str]): the state to be returned
+            member_keys(set[(str, str)]): the state keys of the membership
+                events needed by the timeline.
+            full_state(bool): whether the client is getting the full state,
+                and so won't have any membership events already.
 
-        # There is no new information in this period, so your notification
-        # count is whatever it was last time.
-        defer.returnValue(None)
+        Returns:
+            dict[(str, str), str]: the filtered state
+        """
+        state_ids = {
+            key: event_id for key, event_id in state_ids.iteritems()
+            if key[0] != EventTypes.Member or key in member_keys
+        }
+
+        if sync_config.filter_collection.include_redundant_members():
+            return state_ids
+
+        cache_key = (sync_config.user.to_string(), sync_config.device_id)
+        cache = self.lazy_loaded_members_cache.get(cache_key)
+        if cache is None:
+            cache = LruCache(LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE)
+            self.lazy_loaded_members_cache[cache_key] = cache
+
+        if not full_state:
+            state_ids = {
+                key: event_id for key, event_id in state_ids.iteritems()
+                if key[0] != EventTypes.Member
+                or cache.get((room_id, key[1])) != event_id
+            }
+
+        for key, event_id in state_ids.iteritems():
+            if key[0] == EventTypes.Member:
+                cache[(room_id, key[1])] = event_id
+        for event in batch.events:
+            if event.type == EventTypes.Member:
+                cache[(room_id, event.state_key)] = event.event_id
+
+        return state_ids
 
     @defer.inlineCallbacks
     def generate_sync_result(self, sync_config, since_token=None, full_state=False):
@@ -559,12 +662,115 @@ class SyncHandler(object):
         """
         logger.info("Calculating sync response for %r", sync_config.user)
 
+        now_token = yield self.event_sources.get_current_token()
+
+        # Most of the result is the same for all of the user's devices, so if
+        # another device is syncing from the same point then we share the
+        # result with it.
+        shared_key = self._get_shared_sync_key(
+            sync_config, since_token, now_token, full_state,
+        )
+        if shared_key is None:
+            shared_result = yield self._generate_shared_sync_result(
+                sync_config, since_token, now_token, full_state,
+            )
+        else:
+            result = self.shared_sync_cache.get(shared_key)
+            if result:
+                shared_sync_results_counter.inc()
+            else:
+                result = self.shared_sync_cache.set(
+                    shared_key,
+                    preserve_fn(self._generate_shared_sync_result)(
+                        sync_config, since_token, now_token, full_state,
+                    )
+                )
+            shared_result = yield make_deferred_yieldable(result)
+
+        # The shared result has been generated without looking at the
+        # to-device stream, so we use our own position in it.
+        sync_result_builder = SyncResultBuilder(
+            sync_config, full_state,
+            since_token=since_token,
+            now_token=shared_result.next_batch.copy_and_replace(
+                "to_device_key", now_token.to_device_key,
+            ),
+        )
+
+        yield self._generate_sync_entry_for_to_device(sync_result_builder)
+
+        device_id = sync_config.device_id
+        one_time_key_counts = {}
+        if device_id:
+            user_id = sync_config.user.to_string()
+            one_time_key_counts = yield self.store.count_e2e_one_time_keys(
+                user_id, device_id
+            )
+
+        defer.returnValue(shared_result._replace(
+            to_device=sync_result_builder.to_device,
+            device_one_time_keys_count=one_time_key_counts,
+            next_batch=sync_result_builder.now_token,
+        ))
+
+    def _get_shared_sync_key(self, sync_config, since_token, now_token,
+                             full_state):
+        """Gets the key under which the device-independent part of a sync
+        result is shared between the user's devices.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken|None)
+            now_token (StreamToken)
+            full_state (bool)
+
+        Returns:
+            tuple|None: the key, or None if the result can't be shared.
+        """
+        filter_collection = sync_config.filter_collection
+
+        # The membership events sent to lazy-loading clients depend on what
+        # has already been sent to that device.
+        if (
+            filter_collection.lazy_load_members()
+            and not filter_collection.include_redundant_members()
+        ):
+            return None
+
+        # The to-device stream is the only one which differs between devices
+        if since_token is not None:
+            since_token = since_token.copy_and_replace("to_device_key", 0)
+        now_token = now_token.copy_and_replace("to_device_key", 0)
+
+        return (
+            sync_config.user.to_string(),
+            sync_config.is_guest,
+            encode_canonical_json(filter_collection.get_filter_json()),
+            since_token,
+            now_token,
+            full_state,
+        )
+
+    @defer.inlineCallbacks
+    def _generate_shared_sync_result(self, sync_config, since_token, now_token,
+                                     full_state):
+        """Generates the parts of a sync result which are the same for all of
+        the user's devices, i.e. everything apart from the to-device messages
+        and the one-time key counts.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken|None)
+            now_token (StreamToken)
+            full_state (bool)
+
+        Returns:
+            Deferred(SyncResult)
+        """
         # NB: The now_token gets changed by some of the generate_sync_* methods,
         # this is due to some of the underlying streams not supporting the ability
         # to query up to a given point.
         # Always use the `now_token` in `SyncResultBuilder`
-        now_token = yield self.event_sources.get_current_token()
-
         sync_result_builder = SyncResultBuilder(
             sync_config, full_state,
             since_token=since_token,
@@ -590,8 +796,6 @@ class SyncHandler(object):
                 sync_result_builder, newly_joined_rooms, newly_joined_users
             )
 
-        yield self._generate_sync_entry_for_to_device(sync_result_builder)
-
         device_lists = yield self._generate_sync_entry_for_device_list(
             sync_result_builder,
             newly_joined_rooms=newly_joined_rooms,
@@ -600,14 +804,6 @@ class SyncHandler(object):
             newly_left_users=newly_left_users,
         )
 
-        device_id = sync_config.device_id
-        one_time_key_counts = {}
-        if device_id:
-            user_id = sync_config.user.to_string()
-            one_time_key_counts = yield self.store.count_e2e_one_time_keys(
-                user_id, device_id
-            )
-
         yield self._generate_sync_entry_for_groups(sync_result_builder)
 
         defer.returnValue(SyncResult(
@@ -616,10 +812,10 @@ class SyncHandler(object):
             joined=sync_result_builder.joined,
             invited=sync_result_builder.invited,
             archived=sync_result_builder.archived,
-            to_device=sync_result_builder.to_device,
+            to_device=[],
             device_lists=device_lists,
             groups=sync_result_builder.groups,
-            device_one_time_keys_count=one_time_key_counts,
+            device_one_time_keys_count={},
             next_batch=sync_result_builder.now_token,
         ))
 
@@ -935,18 +1131,51 @@ class SyncHandler(object):
 
             tags_by_room = yield self.store.get_tags_for_user(user_id)
 
+        # Fetch the unread counts for all the joined rooms at once, rather
+        # than one room at a time.
+        with Measure(self.clock, "unread_notifs_for_rooms"):
+            unread_notifs_by_room = (
+                yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+                    [
+                        room_entry.room_id for room_entry in room_entries
+                        if room_entry.rtype == "joined"
+                    ],
+                    user_id,
+                )
+            )
+
+        @defer.inlineCallbacks
         def handle_room_entries(room_entry):
-            return self._generate_room_entry(
+            start = self.clock.time_msec()
+            yield self._generate_room_entry(
                 sync_result_builder,
                 ignored_users,
                 room_entry,
                 ephemeral=ephemeral_by_room.get(room_entry.room_id, []),
                 tags=tags_by_room.get(room_entry.room_id),
                 account_data=account_data_by_room.get(room_entry.room_id, {}),
+                unread_notifs=unread_notifs_by_room.get(room_entry.room_id),
                 always_include=sync_result_builder.full_state,
             )
+            room_entry_time_histogram.observe(
+                self.clock.time_msec() - start, room_entry.rtype,
+            )
 
-        yield concurrently_execute(handle_room_entries, room_entries, 10)
+        # Start with the most expensive rooms, so that a single slow room
+        # doesn't get left until the end and hold up the whole response.
+        filter_collection = sync_result_builder.sync_config.filter_collection
+        timeline_limit = filter_collection.timeline_limit()
+        room_entries = sorted(
+            room_entries,
+            key=lambda room_entry: self._estimate_room_entry_cost(
+                room_entry, timeline_limit,
+            ),
+            reverse=True,
+        )
+
+        yield concurrently_execute(
+            handle_room_entries, room_entries, self.room_concurrency,
+        )
 
         sync_result_builder.invited.extend(invited)
 
@@ -1009,6 +1238,56 @@ class SyncHandler(object):
                 defer.returnValue(True)
         defer.returnValue(False)
 
+    def _estimate_room_entry_cost(self, room_entry, timeline_limit):
+        """Roughly estimates how much work it will be to generate the sync
+        entry for a room, so that the expensive rooms can be started first.
+
+        Loading the timeline costs about the number of events. Rooms which
+        need their full state cost about as much as their membership on top
+        of that, and rooms with a gappy timeline need a state delta across
+        the gap, which is bounded by both the size of the gap in the stream
+        and the size of the state.
+
+        Args:
+            room_entry (RoomSyncResultBuilder)
+            timeline_limit (int)
+
+        Returns:
+            int
+        """
+        events = room_entry.events
+        if events is None:
+            cost = timeline_limit
+        else:
+            cost = len(events)
+
+        since_token = room_entry.since_token
+        needs_full_state = (
+            since_token is None or room_entry.full_state
+            or room_entry.newly_joined
+        )
+        gappy = events is None or len(events) > timeline_limit
+        if not needs_full_state and not gappy:
+            return cost
+
+        members = self.store.get_users_in_room.cache.get(
+            room_entry.room_id, None, update_metrics=False,
+        )
+        if members is None or isinstance(members, ObservableDeferred):
+            member_count = DEFAULT_ROOM_MEMBER_COUNT_ESTIMATE
+        else:
+            member_count = len(members)
+
+        if needs_full_state:
+            return cost + member_count
+
+        since_stream = RoomStreamToken.parse_stream_token(since_token.room_key)
+        upto_stream = RoomStreamToken.parse_stream_token(
+            room_entry.upto_token.room_key
+        )
+        gap = upto_stream.stream - since_stream.stream
+        return cost + max(0, min(gap, member_count))
+
     @defer.inlineCallbacks
     def _get_rooms_changed(self, sync_result_builder, ignored_users):
         """Gets the the changes that have happened since the last sync.
@@ -1258,7 +1537,7 @@ class SyncHandler(object):
     @defer.inlineCallbacks
     def _generate_room_entry(self, sync_result_builder, ignored_users,
                              room_builder, ephemeral, tags, account_data,
-                             always_include=False):
+                             unread_notifs=None, always_include=False):
         """Populates the `joined` and `archived` section of `sync_result_builder`
         based on the `room_builder`.
 
@@ -1270,6 +1549,9 @@ class SyncHandler(object):
             tags(list): List of *all* tags for room, or None if there has been
                 no change.
             account_data(list): List of new account data for room
+            unread_notifs(dict|None): The unread notification and highlight
+                counts for the room, or None if the user has no read receipt
+                in it.
             always_include(bool): Always include this room in the sync response,
                 even if empty.
         """
@@ -1341,13 +1623,13 @@ class SyncHandler(object):
             )
 
             if room_sync or always_include:
-                notifs = yield self.unread_notifs_for_room_id(
-                    room_id, sync_config
-                )
-
-                if notifs is not None:
-                    unread_notifications["notification_count"] = notifs["notify_count"]
-                    unread_notifications["highlight_count"] = notifs["highlight_count"]
+                if unread_notifs is not None:
+                    unread_notifications["notification_count"] = (
+                        unread_notifs["notify_count"]
+                    )
+                    unread_notifications["highlight_count"] = (
+                        unread_notifs["highlight_count"]
+                    )
 
                 sync_result_builder.joined.append(room_sync)
         elif room_builder.rtype == "archived":
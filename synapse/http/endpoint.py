@@ -25,12 +25,33 @@ import logging
 import random
 import time
 
+import synapse.metrics
+
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+# New connections made to other servers, and how long they took to set up
+new_connections_counter = metrics.register_counter("new_connections")
+tls_handshakes_counter = metrics.register_counter("tls_handshakes")
+connection_setup_histogram = metrics.register_histogram(
+    "connection_setup_time_ms",
+    buckets=[10, 50, 100, 250, 500, 1000, 2500, 5000, 10000],
+)
+
 
 SERVER_CACHE = {}
 
+# service name -> when we can next look up a service which we found doesn't
+# exist, in seconds
+NEGATIVE_SERVER_CACHE = {}
+
+# How long to remember that a service doesn't exist, if the DNS server doesn't
+# tell us, and the most we will remember it for, in seconds
+DEFAULT_NEGATIVE_TTL = 5 * 60
+MAX_NEGATIVE_TTL = 60 * 60
+
 # our record of an individual server which can be tried to reach a destination.
 #
 # "host" is actually a dotted-quad or ipv6 address string. Except when there's
@@ -71,25 +92,34 @@ def matrix_federation_endpoint(reactor, destination, ssl_context_factory=None,
                 HostnameEndpoint(reactor, host, port, timeout=timeout))
         default_port = 8448
 
+    tls = ssl_context_factory is not None
+
     if port is None:
         return _WrappingEndpointFac(SRVClientEndpoint(
             reactor, "matrix", domain, protocol="tcp",
             default_port=default_port, endpoint=transport_endpoint,
             endpoint_kw_args=endpoint_kw_args
-        ))
+        ), tls)
     else:
         return _WrappingEndpointFac(transport_endpoint(
             reactor, domain, port, **endpoint_kw_args
-        ))
+        ), tls)
 
 
 class _WrappingEndpointFac(object):
-    def __init__(self, endpoint_fac):
+    def __init__(self, endpoint_fac, tls=False):
         self.endpoint_fac = endpoint_fac
+        self.tls = tls
 
     @defer.inlineCallbacks
     def connect(self, protocolFactory):
+        start = time.time()
         conn = yield self.endpoint_fac.connect(protocolFactory)
+        connection_setup_histogram.observe((time.time() - start) * 1000)
+        new_connections_counter.inc()
+        if self.tls:
+            tls_handshakes_counter.inc()
+
         conn = _WrappedConnection(conn)
         defer.returnValue(conn)
 
@@ -270,20 +300,26 @@ class SRVClientEndpoint(object):
 
 
 @defer.inlineCallbacks
-def resolve_service(service_name, dns_client=client, cache=SERVER_CACHE, clock=time):
+def resolve_service(service_name, dns_client=client, cache=SERVER_CACHE, clock=time,
+                    negative_cache=NEGATIVE_SERVER_CACHE):
     cache_entry = cache.get(service_name, None)
     if cache_entry:
         if all(s.expires > int(clock.time()) for s in cache_entry):
             servers = list(cache_entry)
             defer.returnValue(servers)
 
+    if negative_cache.get(service_name, 0) > int(clock.time()):
+        defer.returnValue([])
+
     servers = []
 
     try:
         try:
             answers, _, _ = yield dns_client.lookupService(service_name)
-        except DNSNameError:
+        except DNSNameError as e:
+            negative_cache[service_name] = int(clock.time()) + _get_negative_ttl(e)
             defer.returnValue([])
+        negative_cache.pop(service_name, None)
 
         if (len(answers) == 1
                 and answers[0].type == dns.SRV
@@ -330,6 +366,23 @@ def resolve_service(service_name, dns_client=client, cache=SERVER_CACHE, clock=t
     defer.returnValue(servers)
 
 
+def _get_negative_ttl(error):
+    """Works out how long to cache the non-existence of a name for, from the
+    SOA record the DNS server should have included in its response.
+
+    Args:
+        error (DNSNameError)
+
+    Returns:
+        int: the TTL in seconds
+    """
+    message = error.args[0] if error.args else None
+    for answer in getattr(message, "authority", []):
+        if answer.type == dns.SOA and answer.payload:
+            return min(answer.ttl, answer.payload.minimum, MAX_NEGATIVE_TTL)
+    return DEFAULT_NEGATIVE_TTL
+
+
 @defer.inlineCallbacks
 def _get_hosts_for_srv_record(dns_client, host):
     """Look up each of the hosts in a SRV record
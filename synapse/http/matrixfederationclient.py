@@ -55,6 +55,11 @@ incoming_responses_counter = metrics.register_counter(
     labels=["method", "code"],
 )
 
+# The number of attempts at sending requests. Together with the number of new
+# connections from synapse.http.endpoint this gives the connection pool's hit
+# rate.
+request_attempts_counter = metrics.register_counter("request_attempts")
+
 
 MAX_LONG_RETRIES = 10
 MAX_SHORT_RETRIES = 3
@@ -87,8 +92,10 @@ class MatrixFederationHttpClient(object):
         self.signing_key = hs.config.signing_key[0]
         self.server_name = hs.hostname
         pool = HTTPConnectionPool(reactor)
-        pool.maxPersistentPerHost = 5
-        pool.cachedConnectionTimeout = 2 * 60
+        pool.maxPersistentPerHost = hs.config.federation_client_pool_size
+        pool.cachedConnectionTimeout = (
+            hs.config.federation_client_idle_timeout / 1000.
+        )
         self.agent = Agent.usingEndpointFactory(
             reactor, MatrixFederationEndpointFactory(hs), pool=pool
         )
@@ -97,19 +104,69 @@ class MatrixFederationHttpClient(object):
         self.version_string = hs.version_string
         self._next_id = 1
 
+        # destination -> DeferredSemaphore limiting the number of requests in
+        # flight to it, if federation_client_max_concurrent_requests is set
+        self._max_concurrent_requests = (
+            hs.config.federation_client_max_concurrent_requests
+        )
+        self._request_semaphores = {}
+
     def _create_url(self, destination, path_bytes, param_bytes, query_bytes):
         return urlparse.urlunparse(
             ("matrix", destination, path_bytes, param_bytes, query_bytes, "")
         )
 
+    @defer.inlineCallbacks
+    def _acquire_request_slot(self, destination, time_out):
+        """Waits until a request may be sent to the destination without
+        exceeding federation_client_max_concurrent_requests.
+
+        Args:
+            destination (str)
+            time_out (float): how long to wait, in seconds
+
+        Returns:
+            Deferred[DeferredSemaphore|None]: to be passed to
+                _release_request_slot once the request is done. None if there
+                is no limit.
+        """
+        if not self._max_concurrent_requests:
+            defer.returnValue(None)
+
+        semaphore = self._request_semaphores.get(destination)
+        if semaphore is None:
+            semaphore = defer.DeferredSemaphore(self._max_concurrent_requests)
+            self._request_semaphores[destination] = semaphore
+
+        with logcontext.PreserveLoggingContext():
+            yield self.clock.time_bound_deferred(
+                semaphore.acquire(), time_out=time_out,
+            )
+
+        defer.returnValue(semaphore)
+
+    def _release_request_slot(self, destination, semaphore):
+        if semaphore is None:
+            return
+
+        # Waking up the next request mustn't run it in our logcontext.
+        with logcontext.PreserveLoggingContext():
+            semaphore.release()
+        if semaphore.tokens == semaphore.limit:
+            self._request_semaphores.pop(destination, None)
+
     @defer.inlineCallbacks
     def _request(self, destination, method, path,
                  body_callback, headers_dict={}, param_bytes=b"",
                  query_bytes=b"", retry_on_dns_fail=True,
                  timeout=None, long_retries=False,
                  ignore_backoff=False,
-                 backoff_on_404=False):
-        """ Creates and sends a request to the given server
+                 backoff_on_404=False,
+                 backoff_on_429=True,
+                 read_body=None):
+        """ Creates and sends a request to the given server, and reads the
+        response body.
+
         Args:
             destination (str): The remote server to send the HTTP request to.
             method (str): HTTP method
@@ -117,9 +174,13 @@ class MatrixFederationHttpClient(object):
             ignore_backoff (bool): true to ignore the historical backoff data
                 and try the request anyway.
             backoff_on_404 (bool): Back off if we get a 404
+            backoff_on_429 (bool): Back off if we get a 429
+            read_body (callable|None): called with a 2xx response to read its
+                body. Returns a deferred. Defaults to readBody.
 
         Returns:
-            Deferred: resolves with the http response object on success.
+            Deferred: resolves with a tuple of the http response object and
+                the result of read_body on success.
 
             Fails with ``HTTPRequestException``: if we get an HTTP response
                 code >= 300.
@@ -133,6 +194,7 @@ class MatrixFederationHttpClient(object):
             self.clock,
             self._store,
             backoff_on_404=backoff_on_404,
+            backoff_on_429=backoff_on_429,
             ignore_backoff=ignore_backoff,
         )
 
@@ -165,89 +227,108 @@ class MatrixFederationHttpClient(object):
                 ("", "", path_bytes, param_bytes, query_bytes, "")
             )
 
+            time_out = timeout / 1000. if timeout else 60
+
+            # The slot we hold in the destination's concurrency limit. We only
+            # hold it during each attempt, not while waiting to retry, and
+            # until we've read the response body.
+            semaphore = None
+
             log_result = None
             try:
-                while True:
-                    producer = None
-                    if body_callback:
-                        producer = body_callback(method, http_url_bytes, headers_dict)
-
-                    try:
-                        def send_request():
-                            request_deferred = self.agent.request(
-                                method,
-                                url_bytes,
-                                Headers(headers_dict),
-                                producer
+                try:
+                    while True:
+                        producer = None
+                        if body_callback:
+                            producer = body_callback(method, http_url_bytes, headers_dict)
+
+                        try:
+                            semaphore = yield self._acquire_request_slot(
+                                destination, time_out,
                             )
 
-                            return self.clock.time_bound_deferred(
-                                request_deferred,
-                                time_out=timeout / 1000. if timeout else 60,
-                            )
-
-                        with logcontext.PreserveLoggingContext():
-                            response = yield send_request()
+                            def send_request():
+                                request_attempts_counter.inc()
+                                request_deferred = self.agent.request(
+                                    method,
+                                    url_bytes,
+                                    Headers(headers_dict),
+                                    producer
+                                )
+
+                                return self.clock.time_bound_deferred(
+                                    request_deferred,
+                                    time_out=time_out,
+                                )
+
+                            with logcontext.PreserveLoggingContext():
+                                response = yield send_request()
+
+                            log_result = "%d %s" % (response.code, response.phrase,)
+                            break
+                        except Exception as e:
+                            if not retry_on_dns_fail and isinstance(e, DNSLookupError):
+                                logger.warn(
+                                    "DNS Lookup failed to %s with %s",
+                                    destination,
+                                    e
+                                )
+                                log_result = "DNS Lookup failed to %s with %s" % (
+                                    destination, e
+                                )
+                                raise
 
-                        log_result = "%d %s" % (response.code, response.phrase,)
-                        break
-                    except Exception as e:
-                        if not retry_on_dns_fail and isinstance(e, DNSLookupError):
                             logger.warn(
-                                "DNS Lookup failed to %s with %s",
+                                "{%s} Sending request failed to %s: %s %s: %s",
+                                txn_id,
                                 destination,
-                                e
-                            )
-                            log_result = "DNS Lookup failed to %s with %s" % (
-                                destination, e
+                                method,
+                                url_bytes,
+                                _flatten_response_never_received(e),
                             )
-                            raise
-
-                        logger.warn(
-                            "{%s} Sending request failed to %s: %s %s: %s",
-                            txn_id,
-                            destination,
-                            method,
-                            url_bytes,
-                            _flatten_response_never_received(e),
-                        )
-
-                        log_result = _flatten_response_never_received(e)
-
-                        if retries_left and not timeout:
-                            if long_retries:
-                                delay = 4 ** (MAX_LONG_RETRIES + 1 - retries_left)
-                                delay = min(delay, 60)
-                                delay *= random.uniform(0.8, 1.4)
+
+                            log_result = _flatten_response_never_received(e)
+
+                            self._release_request_slot(destination, semaphore)
+                            semaphore = None
+
+                            if retries_left and not timeout:
+                                if long_retries:
+                                    delay = 4 ** (MAX_LONG_RETRIES + 1 - retries_left)
+                                    delay = min(delay, 60)
+                                    delay *= random.uniform(0.8, 1.4)
+                                else:
+                                    delay = 0.5 * 2 ** (MAX_SHORT_RETRIES - retries_left)
+                                    delay = min(delay, 2)
+                                    delay *= random.uniform(0.8, 1.4)
+
+                                yield sleep(delay)
+                                retries_left -= 1
                             else:
-                                delay = 0.5 * 2 ** (MAX_SHORT_RETRIES - retries_left)
-                                delay = min(delay, 2)
-                                delay *= random.uniform(0.8, 1.4)
-
-                            yield sleep(delay)
-                            retries_left -= 1
-                        else:
-                            raise
+                                raise
+                finally:
+                    outbound_logger.info(
+                        "{%s} [%s] Result: %s",
+                        txn_id,
+                        destination,
+                        log_result,
+                    )
+
+                if 200 <= response.code < 300:
+                    with logcontext.PreserveLoggingContext():
+                        body = yield (read_body or readBody)(response)
+                else:
+                    # :'(
+                    # Update transactions table?
+                    with logcontext.PreserveLoggingContext():
+                        body = yield readBody(response)
+                    raise HttpResponseException(
+                        response.code, response.phrase, body
+                    )
             finally:
-                outbound_logger.info(
-                    "{%s} [%s] Result: %s",
-                    txn_id,
-                    destination,
-                    log_result,
-                )
-
-            if 200 <= response.code < 300:
-                pass
-            else:
-                # :'(
-                # Update transactions table?
-                with logcontext.PreserveLoggingContext():
-                    body = yield readBody(response)
-                raise HttpResponseException(
-                    response.code, response.phrase, body
-                )
+                self._release_request_slot(destination, semaphore)
 
-            defer.returnValue(response)
+            defer.returnValue((response, body))
 
     def sign_request(self, destination, method, url_bytes, headers_dict,
                      content=None):
@@ -278,7 +359,7 @@ class MatrixFederationHttpClient(object):
     def put_json(self, destination, path, data={}, json_data_callback=None,
                  long_retries=False, timeout=None,
                  ignore_backoff=False,
-                 backoff_on_404=False):
+                 backoff_on_404=False, backoff_on_429=True):
         """ Sends the specifed json data using PUT
 
         Args:
@@ -298,6 +379,8 @@ class MatrixFederationHttpClient(object):
             backoff_on_404 (bool): True if we should count a 404 response as
                 a failure of the server (and should therefore back off future
                 requests)
+            backoff_on_429 (bool): True if we should back off future requests
+                if we are rate limited.
 
         Returns:
             Deferred: Succeeds when we get a 2xx HTTP response. The result
@@ -322,7 +405,7 @@ class MatrixFederationHttpClient(object):
             producer = _JsonProducer(json_data)
             return producer
 
-        response = yield self._request(
+        response, body = yield self._request(
             destination,
             "PUT",
             path,
@@ -332,14 +415,13 @@ class MatrixFederationHttpClient(object):
             timeout=timeout,
             ignore_backoff=ignore_backoff,
             backoff_on_404=backoff_on_404,
+            backoff_on_429=backoff_on_429,
         )
 
         if 200 <= response.code < 300:
             # We need to update the transactions table to say it was sent?
             check_content_type_is_json(response.headers)
 
-        with logcontext.PreserveLoggingContext():
-            body = yield readBody(response)
         defer.returnValue(json.loads(body))
 
     @defer.inlineCallbacks
@@ -376,7 +458,7 @@ class MatrixFederationHttpClient(object):
             )
             return _JsonProducer(data)
 
-        response = yield self._request(
+        response, body = yield self._request(
             destination,
             "POST",
             path,
@@ -392,9 +474,6 @@ class MatrixFederationHttpClient(object):
             # We need to update the transactions table to say it was sent?
             check_content_type_is_json(response.headers)
 
-        with logcontext.PreserveLoggingContext():
-            body = yield readBody(response)
-
         defer.returnValue(json.loads(body))
 
     @defer.inlineCallbacks
@@ -431,7 +510,7 @@ class MatrixFederationHttpClient(object):
             self.sign_request(destination, method, url_bytes, headers_dict)
             return None
 
-        response = yield self._request(
+        response, body = yield self._request(
             destination,
             "GET",
             path,
@@ -446,9 +525,6 @@ class MatrixFederationHttpClient(object):
             # We need to update the transactions table to say it was sent?
             check_content_type_is_json(response.headers)
 
-        with logcontext.PreserveLoggingContext():
-            body = yield readBody(response)
-
         defer.returnValue(json.loads(body))
 
     @defer.inlineCallbacks
@@ -477,7 +553,7 @@ class MatrixFederationHttpClient(object):
             to retry this server.
         """
 
-        response = yield self._request(
+        response, body = yield self._request(
             destination,
             "DELETE",
             path,
@@ -492,9 +568,6 @@ class MatrixFederationHttpClient(object):
             # We need to update the transactions table to say it was sent?
             check_content_type_is_json(response.headers)
 
-        with logcontext.PreserveLoggingContext():
-            body = yield readBody(response)
-
         defer.returnValue(json.loads(body))
 
     @defer.inlineCallbacks
@@ -533,7 +606,16 @@ class MatrixFederationHttpClient(object):
             self.sign_request(destination, method, url_bytes, headers_dict)
             return None
 
-        response = yield self._request(
+        @defer.inlineCallbacks
+        def read_body(response):
+            try:
+                length = yield _readBodyToFile(response, output_stream, max_size)
+            except Exception:
+                logger.exception("Failed to download body")
+                raise
+            defer.returnValue(length)
+
+        response, length = yield self._request(
             destination,
             "GET",
             path,
@@ -541,19 +623,11 @@ class MatrixFederationHttpClient(object):
             body_callback=body_callback,
             retry_on_dns_fail=retry_on_dns_fail,
             ignore_backoff=ignore_backoff,
+            read_body=read_body,
         )
 
         headers = dict(response.headers.getAllRawHeaders())
 
-        try:
-            with logcontext.PreserveLoggingContext():
-                length = yield _readBodyToFile(
-                    response, output_stream, max_size
-                )
-        except Exception:
-            logger.exception("Failed to download body")
-            raise
-
         defer.returnValue((length, headers))
 
 
@@ -17,7 +17,9 @@
 from synapse.api.errors import (
     cs_exception, SynapseError, CodeMessageException, UnrecognizedRequestError, Codes
 )
-from synapse.util.logcontext import LoggingContext, PreserveLoggingContext
+from synapse.util.logcontext import (
+    LoggingContext, PreserveLoggingContext, make_deferred_yieldable,
+)
 from synapse.util.caches import intern_dict
 from synapse.util.metrics import Measure
 import synapse.metrics
@@ -27,15 +29,19 @@ from canonicaljson import (
     encode_canonical_json, encode_pretty_printed_json
 )
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces, threads
 from twisted.web import server, resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.util import redirectTo
 
+from zope.interface import implementer
+
 import collections
 import logging
+import time
 import urllib
 import ujson
+import zlib
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +61,16 @@ response_timer = metrics.register_distribution(
     labels=["method", "servlet", "tag"]
 )
 
+compression_timer = metrics.register_distribution(
+    "compression_time", labels=["servlet"]
+)
+uncompressed_bytes_counter = metrics.register_counter(
+    "uncompressed_bytes", labels=["servlet"]
+)
+compressed_bytes_counter = metrics.register_counter(
+    "compressed_bytes", labels=["servlet"]
+)
+
 response_ru_utime = metrics.register_distribution(
     "response_ru_utime", labels=["method", "servlet", "tag"]
 )
@@ -127,7 +143,7 @@ def wrap_request_handler(request_handler, include_metrics=False):
                         outgoing_responses_counter.inc(request.method, str(code))
                         respond_with_json(
                             request, code, cs_exception(e), send_cors=True,
-                            pretty_print=_request_user_agent_is_curl(request),
+                            pretty_print=request_user_agent_is_curl(request),
                             version_string=self.version_string,
                         )
                     except Exception:
@@ -146,7 +162,7 @@ def wrap_request_handler(request_handler, include_metrics=False):
                                 "errcode": Codes.UNKNOWN,
                             },
                             send_cors=True,
-                            pretty_print=_request_user_agent_is_curl(request),
+                            pretty_print=request_user_agent_is_curl(request),
                             version_string=self.version_string,
                         )
                     finally:
@@ -208,6 +224,10 @@ class JsonResource(HttpServer, resource.Resource):
         self.version_string = hs.version_string
         self.hs = hs
 
+        self.gzip_responses = hs.config.gzip_responses
+        self.gzip_min_size = hs.config.gzip_min_size
+        self.gzip_thread_min_size = hs.config.gzip_thread_min_size
+
     def register_paths(self, method, path_patterns, callback):
         for path_pattern in path_patterns:
             logger.debug("Registering for %s %s", method, path_pattern.pattern)
@@ -233,7 +253,7 @@ class JsonResource(HttpServer, resource.Resource):
             path.
         """
         if request.method == "OPTIONS":
-            self._send_response(request, 200, {})
+            yield self._send_response(request, 200, {})
             return
 
         # Loop through all the registered callbacks to check if the method
@@ -254,17 +274,19 @@ class JsonResource(HttpServer, resource.Resource):
                 for name, value in m.groupdict().items()
             })
 
-            callback_return = yield callback(request, **kwargs)
-            if callback_return is not None:
-                code, response = callback_return
-                self._send_response(request, code, response)
-
             servlet_instance = getattr(callback, "__self__", None)
             if servlet_instance is not None:
                 servlet_classname = servlet_instance.__class__.__name__
             else:
                 servlet_classname = "%r" % callback
 
+            callback_return = yield callback(request, **kwargs)
+            if callback_return is not None:
+                code, response = callback_return
+                yield self._send_response(
+                    request, code, response, servlet_name=servlet_classname,
+                )
+
             request_metrics.name = servlet_classname
 
             return
@@ -272,8 +294,9 @@ class JsonResource(HttpServer, resource.Resource):
         # Huh. No one wanted to handle that? Fiiiiiine. Send 400.
         raise UnrecognizedRequestError()
 
+    @defer.inlineCallbacks
     def _send_response(self, request, code, response_json_object,
-                       response_code_message=None):
+                       response_code_message=None, servlet_name=""):
         # could alternatively use request.notifyFinish() and flip a flag when
         # the Deferred fires, but since the flag is RIGHT THERE it seems like
         # a waste.
@@ -285,16 +308,52 @@ class JsonResource(HttpServer, resource.Resource):
 
         outgoing_responses_counter.inc(request.method, str(code))
 
+        if request_user_agent_is_curl(request):
+            json_bytes = encode_pretty_printed_json(response_json_object) + "\n"
+        else:
+            json_bytes = encode_json(response_json_object, self.canonical_json)
+
+        content_encoding = None
+        if (
+            self.gzip_responses
+            and len(json_bytes) >= self.gzip_min_size
+            and request_accepts_gzip(request)
+        ):
+            json_bytes = yield self._gzip(json_bytes, servlet_name)
+            content_encoding = b"gzip"
+
+            if request._disconnected:
+                return
+
         # TODO: Only enable CORS for the requests that need it.
-        respond_with_json(
-            request, code, response_json_object,
+        respond_with_json_bytes(
+            request, code, json_bytes,
             send_cors=True,
             response_code_message=response_code_message,
-            pretty_print=_request_user_agent_is_curl(request),
             version_string=self.version_string,
-            canonical_json=self.canonical_json,
+            content_encoding=content_encoding,
+            vary_on_encoding=self.gzip_responses,
         )
 
+    @defer.inlineCallbacks
+    def _gzip(self, data, servlet_name):
+        """Compresses a response body, in a thread if it is large enough that
+        compressing it would hold up the reactor.
+        """
+        start = self.clock.time_msec()
+        if len(data) >= self.gzip_thread_min_size:
+            compressed = yield make_deferred_yieldable(
+                threads.deferToThread(gzip_bytes, data)
+            )
+        else:
+            compressed = gzip_bytes(data)
+
+        compression_timer.inc_by(self.clock.time_msec() - start, servlet_name)
+        uncompressed_bytes_counter.inc_by(len(data), servlet_name)
+        compressed_bytes_counter.inc_by(len(compressed), servlet_name)
+
+        defer.returnValue(compressed)
+
 
 class RequestMetrics(object):
     def start(self, clock, name):
@@ -355,17 +414,31 @@ class RootRedirect(resource.Resource):
         return resource.Resource.getChild(self, name, request)
 
 
+def encode_json(json_object, canonical_json=True):
+    """Encodes an object as JSON for sending in a response
+
+    Args:
+        json_object (object)
+        canonical_json (bool): whether to use canonical JSON. Canonical JSON
+            is always used if we are using frozen dicts.
+
+    Returns:
+        bytes
+    """
+    if canonical_json or synapse.events.USE_FROZEN_DICTS:
+        return encode_canonical_json(json_object)
+    else:
+        # ujson doesn't like frozen_dicts.
+        return ujson.dumps(json_object, ensure_ascii=False)
+
+
 def respond_with_json(request, code, json_object, send_cors=False,
                       response_code_message=None, pretty_print=False,
                       version_string="", canonical_json=True):
     if pretty_print:
         json_bytes = encode_pretty_printed_json(json_object) + "\n"
     else:
-        if canonical_json or synapse.events.USE_FROZEN_DICTS:
-            json_bytes = encode_canonical_json(json_object)
-        else:
-            # ujson doesn't like frozen_dicts.
-            json_bytes = ujson.dumps(json_object, ensure_ascii=False)
+        json_bytes = encode_json(json_object, canonical_json)
 
     return respond_with_json_bytes(
         request, code, json_bytes,
@@ -376,7 +449,8 @@ def respond_with_json(request, code, json_object, send_cors=False,
 
 
 def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
-                            version_string="", response_code_message=None):
+                            version_string="", response_code_message=None,
+                            content_encoding=None, vary_on_encoding=False):
     """Sends encoded JSON in response to the given request.
 
     Args:
@@ -385,6 +459,11 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
         json_bytes (bytes): The json bytes to use as the response body.
         send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
             http://www.w3.org/TR/cors/
+        content_encoding (bytes|None): The encoding of json_bytes, if it has
+            been compressed.
+        vary_on_encoding (bool): Whether the response could have been
+            compressed, depending on the request's Accept-Encoding. Caches
+            are told so whether or not it actually was.
     Returns:
         twisted.web.server.NOT_DONE_YET"""
 
@@ -392,6 +471,10 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     request.setHeader(b"Content-Type", b"application/json")
     request.setHeader(b"Server", version_string)
     request.setHeader(b"Content-Length", b"%d" % (len(json_bytes),))
+    if content_encoding:
+        request.setHeader(b"Content-Encoding", content_encoding)
+    if content_encoding or vary_on_encoding:
+        request.setHeader(b"Vary", b"Accept-Encoding")
 
     if send_cors:
         set_cors_headers(request)
@@ -401,6 +484,179 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     return NOT_DONE_YET
 
 
+def respond_with_json_chunks(request, code, chunks, send_cors=False,
+                             version_string="", gzip=False, servlet_name="",
+                             vary_on_encoding=False):
+    """Sends a JSON response whose body is produced a piece at a time.
+
+    The chunks are only generated as the client reads the response, so we
+    don't need to hold the whole encoded body in memory. The response is
+    sent with chunked transfer encoding, since we don't know its length up
+    front.
+
+    Args:
+        request (twisted.web.http.Request): The http request to respond to.
+        code (int): The HTTP response code.
+        chunks (iterator[bytes]): the pieces of the encoded JSON body.
+        send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
+            http://www.w3.org/TR/cors/
+        gzip (bool): Whether to gzip the body. The caller should check that
+            the client accepts it.
+        servlet_name (str): The name used for the compression metrics.
+        vary_on_encoding (bool): Whether the response could have been
+            gzipped, depending on the request's Accept-Encoding.
+    Returns:
+        Deferred: resolves once the whole body has been written, or the
+            connection has been lost. Request handlers should wait for it so
+            that the request metrics cover the time spent sending the body.
+    """
+
+    outgoing_responses_counter.inc(request.method, str(code))
+
+    request.setResponseCode(code)
+    request.setHeader(b"Content-Type", b"application/json")
+    request.setHeader(b"Server", version_string)
+    if gzip:
+        request.setHeader(b"Content-Encoding", b"gzip")
+    if gzip or vary_on_encoding:
+        request.setHeader(b"Vary", b"Accept-Encoding")
+
+    if send_cors:
+        set_cors_headers(request)
+
+    producer = _ChunkProducer(request, chunks, gzip, servlet_name)
+    return make_deferred_yieldable(producer.finished)
+
+
+@implementer(interfaces.IPullProducer)
+class _ChunkProducer(object):
+    """Writes the chunks from an iterator to a request whenever the transport
+    is ready for more data, and then finishes the request.
+
+    The chunks are generated in the logcontext which created the producer, so
+    that their logging and resource usage are attributed to the request.
+    """
+
+    # We write at least this many bytes at a time, to avoid lots of tiny
+    # writes when the chunks are small.
+    MIN_WRITE_SIZE = 64 * 1024
+
+    def __init__(self, request, chunks, gzip=False, servlet_name=""):
+        self._request = request
+        self._chunks = chunks
+        self._servlet_name = servlet_name
+        self._logcontext = LoggingContext.current_context()
+        self._compressor = None
+        self.finished = defer.Deferred()
+        if gzip:
+            self._compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS,
+            )
+        request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self._request:
+            return
+
+        with PreserveLoggingContext(self._logcontext):
+            self._produce()
+
+    def _produce(self):
+        buf = []
+        size = 0
+        try:
+            while size < self.MIN_WRITE_SIZE:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                buf.append(chunk)
+                size += len(chunk)
+        except Exception:
+            # We've already started sending the response, so all we can do is
+            # drop the connection.
+            logger.exception("Failed to generate response for %s", self._request)
+            self._request.unregisterProducer()
+            self._request.transport.loseConnection()
+            self.stopProducing()
+            return
+
+        finished = size < self.MIN_WRITE_SIZE
+        data = b"".join(buf)
+
+        if self._compressor:
+            start = time.time()
+            compressed = self._compressor.compress(data)
+            if finished:
+                compressed += self._compressor.flush()
+            compression_timer.inc_by(
+                (time.time() - start) * 1000, self._servlet_name,
+            )
+            uncompressed_bytes_counter.inc_by(len(data), self._servlet_name)
+            compressed_bytes_counter.inc_by(len(compressed), self._servlet_name)
+            data = compressed
+
+        if data:
+            self._request.write(data)
+
+        if finished:
+            # we've run out of chunks
+            self._request.unregisterProducer()
+            finish_request(self._request)
+            self.stopProducing()
+
+    def stopProducing(self):
+        self._request = None
+        self._chunks = None
+        if not self.finished.called:
+            self.finished.callback(None)
+
+
+def request_accepts_gzip(request):
+    """Whether the client has said it can accept a gzipped response
+
+    Args:
+        request (twisted.web.http.Request)
+
+    Returns:
+        bool
+    """
+    accept_encodings = request.requestHeaders.getRawHeaders(
+        b"Accept-Encoding", default=[]
+    )
+    for header in accept_encodings:
+        for coding in header.split(b","):
+            params = coding.split(b";")
+            if params[0].strip().lower() not in (b"gzip", b"x-gzip"):
+                continue
+
+            # it might have been explicitly disallowed with q=0
+            for param in params[1:]:
+                name, _, value = param.partition(b"=")
+                if name.strip() == b"q":
+                    try:
+                        if float(value) == 0:
+                            return False
+                    except ValueError:
+                        pass
+            return True
+    return False
+
+
+def gzip_bytes(data, level=6):
+    """Compresses some bytes into the gzip format
+
+    Args:
+        data (bytes)
+        level (int): the zlib compression level
+
+    Returns:
+        bytes
+    """
+    # Adding 16 to wbits gives us a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 def set_cors_headers(request):
     """Set the CORs headers so that javascript running in a web browsers can
     use this API
@@ -437,7 +693,7 @@ def finish_request(request):
         logger.info("Connection disconnected before response was written: %r", e)
 
 
-def _request_user_agent_is_curl(request):
+def request_user_agent_is_curl(request):
     user_agents = request.requestHeaders.getRawHeaders(
         "User-Agent", default=[]
     )
@@ -21,8 +21,8 @@ import gc
 from twisted.internet import reactor
 
 from .metric import (
-    CounterMetric, CallbackMetric, DistributionMetric, CacheMetric,
-    MemoryUsageMetric,
+    CounterMetric, CallbackMetric, DistributionMetric, HistogramMetric,
+    CacheMetric, MemoryUsageMetric,
 )
 from .process_collector import register_process_collector
 
@@ -65,6 +65,9 @@ class Metrics(object):
     def register_distribution(self, *args, **kwargs):
         return self._register(DistributionMetric, *args, **kwargs)
 
+    def register_histogram(self, *args, **kwargs):
+        return self._register(HistogramMetric, *args, **kwargs)
+
     def register_cache(self, *args, **kwargs):
         return self._register(CacheMetric, *args, **kwargs)
 
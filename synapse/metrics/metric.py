@@ -125,6 +125,77 @@ class DistributionMetric(object):
         return self.counts.render() + self.totals.render()
 
 
+class HistogramMetric(BaseMetric):
+    """Counts the number of observed values that fall into each of a set of
+    buckets, as well as the total number of observations and their sum.
+
+    Each bucket is rendered with an extra "le" label giving its upper bound;
+    as with Prometheus histograms, the bucket counts are cumulative.
+    """
+
+    def __init__(self, name, buckets, labels=[]):
+        super(HistogramMetric, self).__init__(name, labels=labels)
+
+        self.buckets = sorted(buckets)
+
+        # label values -> count of observations in each bucket, with a final
+        # entry for those above the highest bucket
+        self.bucket_counts = {}
+        self.sums = {}
+
+        # Scalar metrics are never empty
+        if self.is_scalar():
+            self.bucket_counts[()] = [0] * (len(self.buckets) + 1)
+            self.sums[()] = 0
+
+    def observe(self, value, *values):
+        if len(values) != self.dimension():
+            raise ValueError(
+                "Expected as many values to observe() as labels (%d)" % (
+                    self.dimension(),
+                )
+            )
+
+        if values not in self.bucket_counts:
+            self.bucket_counts[values] = [0] * (len(self.buckets) + 1)
+            self.sums[values] = 0
+
+        counts = self.bucket_counts[values]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+
+        self.sums[values] += value
+
+    def _render_bucket_key(self, values, bound):
+        return "{%s}" % (
+            ",".join(["%s=%s" % (k, self._render_labelvalue(v))
+                      for k, v in zip(self.labels + ["le"], values + (bound,))])
+        )
+
+    def render_item(self, k):
+        lines = []
+        total = 0
+        bounds = ["%g" % (bound,) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, self.bucket_counts[k]):
+            total += count
+            lines.append("%s:bucket%s %d" % (
+                self.name, self._render_bucket_key(k, bound), total,
+            ))
+
+        lines.append("%s:count%s %d" % (self.name, self._render_key(k), total))
+        lines.append("%s:total%s %.12g" % (
+            self.name, self._render_key(k), self.sums[k],
+        ))
+        return lines
+
+    def render(self):
+        return map_concat(self.render_item, sorted(self.bucket_counts.keys()))
+
+
 class CacheMetric(object):
     __slots__ = ("name", "cache_name", "hits", "misses", "size_callback")
 
@@ -15,7 +15,7 @@
 
 from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership
-from synapse.api.errors import AuthError
+from synapse.api.errors import AuthError, LimitExceededError
 from synapse.handlers.presence import format_user_presence_state
 
 from synapse.util import DeferredTimedOutError
@@ -30,6 +30,8 @@ import synapse.metrics
 from collections import namedtuple
 
 import logging
+import random
+import sys
 
 
 logger = logging.getLogger(__name__)
@@ -42,6 +44,31 @@ users_woken_by_stream_counter = metrics.register_counter(
     "users_woken_by_stream", labels=["stream"]
 )
 
+# The number of user streams poked by each call to on_new_event
+notify_fanout_histogram = metrics.register_histogram(
+    "notify_fanout", labels=["stream"],
+    buckets=[1, 10, 100, 1000, 10000, 100000],
+)
+
+# The number of batches of user streams woken up
+wake_batches_counter = metrics.register_counter("wake_batches")
+
+# How long long-polling requests wait for, labelled by what ended the wait:
+# the stream which woke them up, "timeout" or "cancelled"
+long_poll_wait_histogram = metrics.register_histogram(
+    "long_poll_wait_ms", labels=["reason"],
+    buckets=[10, 100, 1000, 5000, 10000, 30000, 60000],
+)
+
+# The number of long-polling requests which were rejected because too many
+# requests were already waiting
+long_polls_rejected_counter = metrics.register_counter("long_polls_rejected")
+
+# How long clients are asked to wait before retrying a rejected long-polling
+# request. This is randomised by up to as much again, so that the rejected
+# requests don't all come back at once.
+LONG_POLL_RETRY_AFTER_MS = 1000
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -87,12 +114,28 @@ class _NotifierUserStream(object):
         self.last_notified_token = current_token
         self.last_notified_ms = time_now_ms
 
+        # The stream which last advanced the token, for metrics
+        self.last_notified_stream_key = "initial"
+
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
 
     def notify(self, stream_key, stream_id, time_now_ms):
         """Notify any listeners for this user of a new event from an
         event source.
+        Args:
+            stream_key(str): The stream the event came from.
+            stream_id(str): The new id for the stream the event came from.
+            time_now_ms(int): The current time in milliseconds.
+        """
+        self.advance(stream_key, stream_id, time_now_ms)
+        self.wake()
+
+    def advance(self, stream_key, stream_id, time_now_ms):
+        """Advance the token for this user without waking up any of the
+        listeners. New listeners with an older token will still return
+        immediately.
+
         Args:
             stream_key(str): The stream the event came from.
             stream_id(str): The new id for the stream the event came from.
@@ -103,10 +146,15 @@ class _NotifierUserStream(object):
         )
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
-        noify_deferred = self.notify_deferred
+        self.last_notified_stream_key = stream_key
 
         users_woken_by_stream_counter.inc(stream_key)
 
+    def wake(self):
+        """Wake up any listeners waiting on this user with the current token.
+        """
+        noify_deferred = self.notify_deferred
+
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
@@ -125,6 +173,22 @@ class _NotifierUserStream(object):
     def count_listeners(self):
         return len(self.notify_deferred.observers())
 
+    def estimate_size(self):
+        """Roughly estimates the memory held by this stream and its listeners,
+        in bytes. The room and user IDs are shared with other structures so
+        aren't included.
+        """
+        observers = self.notify_deferred.observers()
+        return (
+            sys.getsizeof(self) + sys.getsizeof(self.__dict__) +
+            sys.getsizeof(self.rooms) +
+            sys.getsizeof(self.current_token) +
+            sys.getsizeof(self.last_notified_token) +
+            sys.getsizeof(self.notify_deferred) +
+            sys.getsizeof(observers) +
+            sum(sys.getsizeof(d) for d in observers)
+        )
+
     def new_listener(self, token):
         """Returns a deferred that is resolved when there is a new token
         greater than the given token.
@@ -155,6 +219,11 @@ class Notifier(object):
 
     UNUSED_STREAM_EXPIRY_MS = 10 * 60 * 1000
 
+    # The maximum number of user streams to wake up in one reactor tick. Any
+    # more are woken up in subsequent ticks, so that a message in a very
+    # large room doesn't block the reactor.
+    WAKE_BATCH_SIZE = 1000
+
     def __init__(self, hs):
         self.user_to_user_stream = {}
         self.room_to_user_streams = {}
@@ -181,6 +250,16 @@ class Notifier(object):
 
         self.replication_deferred = ObservableDeferred(defer.Deferred())
 
+        # User streams whose tokens have been advanced but whose listeners
+        # have not yet been woken up. A stream that is poked again before it
+        # has been woken up is only woken once.
+        self._streams_to_wake = set()
+        self._wake_scheduled = False
+
+        # The number of requests currently waiting in wait_for_events
+        self._waiting_long_polls = 0
+        self._max_concurrent_long_polls = hs.config.max_concurrent_long_polls
+
         # This is not a very cheap test to perform, but it's only executed
         # when rendering the metrics page, which is likely once per minute at
         # most when scraping it.
@@ -203,6 +282,24 @@ class Notifier(object):
             "users",
             lambda: len(self.user_to_user_stream),
         )
+        metrics.register_callback(
+            "pending_wakeups",
+            lambda: len(self._streams_to_wake),
+        )
+        metrics.register_callback(
+            "waiting_long_polls",
+            lambda: self._waiting_long_polls,
+        )
+
+        # Like count_listeners, this is only calculated when the metrics are
+        # scraped.
+        metrics.register_callback(
+            "user_streams_size_bytes",
+            lambda: sum(
+                stream.estimate_size()
+                for stream in self.user_to_user_stream.values()
+            ),
+        )
 
     def add_replication_callback(self, cb):
         """Add a callback that will be called when some new data is available.
@@ -285,14 +382,52 @@ class Notifier(object):
                 for room in rooms:
                     user_streams |= self.room_to_user_streams.get(room, set())
 
+                notify_fanout_histogram.observe(len(user_streams), stream_key)
+
+                # We advance the tokens straight away so that anyone who
+                # starts listening after this returns immediately, but the
+                # existing listeners may be woken up in later ticks.
                 time_now_ms = self.clock.time_msec()
                 for user_stream in user_streams:
+                    user_stream.advance(stream_key, new_token, time_now_ms)
+
+                self._streams_to_wake |= user_streams
+
+                # The streams are woken up in the next reactor tick, so that
+                # any other notifications for them in this tick are merged in.
+                if not self._wake_scheduled:
+                    self._wake_scheduled = True
+                    self.clock.call_later(0, self._wake_pending_streams)
+
+                self.notify_replication()
+
+    def _wake_pending_streams(self):
+        """Wake up a batch of the user streams which are waiting to be woken
+        up, scheduling another call in the next reactor tick if there are
+        any left.
+        """
+        self._wake_scheduled = False
+
+        to_wake = self._streams_to_wake
+        if len(to_wake) > self.WAKE_BATCH_SIZE:
+            batch = [to_wake.pop() for _ in xrange(self.WAKE_BATCH_SIZE)]
+        else:
+            batch = to_wake
+            self._streams_to_wake = set()
+
+        wake_batches_counter.inc()
+
+        with PreserveLoggingContext():
+            with Measure(self.clock, "wake_pending_streams"):
+                for user_stream in batch:
                     try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
+                        user_stream.wake()
                     except Exception:
                         logger.exception("Failed to notify listener")
 
-                self.notify_replication()
+        if self._streams_to_wake:
+            self._wake_scheduled = True
+            self.clock.call_later(0, self._wake_pending_streams)
 
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
@@ -319,39 +454,73 @@ class Notifier(object):
             )
             self._register_with_keys(user_stream)
 
+        if timeout and (
+            self._max_concurrent_long_polls and
+            self._waiting_long_polls >= self._max_concurrent_long_polls
+        ):
+            # Too many requests are already waiting. If there's anything to
+            # send the client we do that, but otherwise returning straight
+            # away would just have it poll again immediately, so we ask it to
+            # back off for a bit.
+            result = yield callback(from_token, user_stream.current_token)
+            if result:
+                defer.returnValue(result)
+
+            long_polls_rejected_counter.inc()
+            raise LimitExceededError(
+                retry_after_ms=int(
+                    LONG_POLL_RETRY_AFTER_MS * random.uniform(1, 2)
+                ),
+            )
+
         result = None
         prev_token = from_token
         if timeout:
             end_time = self.clock.time_msec() + timeout
 
-            while not result:
-                try:
-                    now = self.clock.time_msec()
-                    if end_time <= now:
+            self._waiting_long_polls += 1
+            try:
+                while not result:
+                    try:
+                        now = self.clock.time_msec()
+                        if end_time <= now:
+                            break
+
+                        # Now we wait for the _NotifierUserStream to be told
+                        # there is a new token.
+                        listener = user_stream.new_listener(prev_token)
+                        wake_reason = "cancelled"
+                        try:
+                            with PreserveLoggingContext():
+                                yield self.clock.time_bound_deferred(
+                                    listener.deferred,
+                                    time_out=(end_time - now) / 1000.
+                                )
+                            wake_reason = user_stream.last_notified_stream_key
+                        except DeferredTimedOutError:
+                            wake_reason = "timeout"
+                            raise
+                        finally:
+                            long_poll_wait_histogram.observe(
+                                self.clock.time_msec() - now, wake_reason,
+                            )
+
+                        current_token = user_stream.current_token
+
+                        result = yield callback(prev_token, current_token)
+                        if result:
+                            break
+
+                        # Update the prev_token to the current_token since
+                        # nothing has happened between the old prev_token and
+                        # the current_token
+                        prev_token = current_token
+                    except DeferredTimedOutError:
                         break
-
-                    # Now we wait for the _NotifierUserStream to be told there
-                    # is a new token.
-                    listener = user_stream.new_listener(prev_token)
-                    with PreserveLoggingContext():
-                        yield self.clock.time_bound_deferred(
-                            listener.deferred,
-                            time_out=(end_time - now) / 1000.
-                        )
-
-                    current_token = user_stream.current_token
-
-                    result = yield callback(prev_token, current_token)
-                    if result:
+                    except defer.CancelledError:
                         break
-
-                    # Update the prev_token to the current_token since nothing
-                    # has happened between the old prev_token and the current_token
-                    prev_token = current_token
-                except DeferredTimedOutError:
-                    break
-                except defer.CancelledError:
-                    break
+            finally:
+                self._waiting_long_polls -= 1
 
         if result is None:
             # This happened if there was no timeout or if the timeout had
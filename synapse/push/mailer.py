@@ -153,9 +153,10 @@ class Mailer(object):
             )
             rooms.append(roomvars)
 
+        room_summary = yield self.store.get_room_summary(reason['room_id'])
         reason['room_name'] = yield calculate_room_name(
             self.store, state_by_room[reason['room_id']], user_id,
-            fallback_to_members=True
+            fallback_to_members=True, room_summary=room_summary,
         )
 
         summary_text = yield self.make_summary_text(
@@ -207,7 +208,10 @@ class Mailer(object):
         my_member_event = yield self.store.get_event(my_member_event_id)
         is_invite = my_member_event.content["membership"] == "invite"
 
-        room_name = yield calculate_room_name(self.store, room_state_ids, user_id)
+        room_summary = yield self.store.get_room_summary(room_id)
+        room_name = yield calculate_room_name(
+            self.store, room_state_ids, user_id, room_summary=room_summary,
+        )
 
         room_vars = {
             "title": room_name,
@@ -335,8 +339,10 @@ class Mailer(object):
             # If the room has some kind of name, use it, but we don't
             # want the generated-from-names one here otherwise we'll
             # end up with, "new message from Bob in the Bob room"
+            room_summary = yield self.store.get_room_summary(room_id)
             room_name = yield calculate_room_name(
-                self.store, room_state_ids[room_id], user_id, fallback_to_members=False
+                self.store, room_state_ids[room_id], user_id, fallback_to_members=False,
+                room_summary=room_summary,
             )
 
             my_member_event_id = room_state_ids[room_id][("m.room.member", user_id)]
@@ -29,7 +29,7 @@ ALL_ALONE = "Empty Room"
 
 @defer.inlineCallbacks
 def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True,
-                        fallback_to_single_member=True):
+                        fallback_to_single_member=True, room_summary=None):
     """
     Works out a user-facing name for the given room as per Matrix
     spec recommendations.
@@ -40,12 +40,26 @@ def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True
         fallback_to_members: If False, return None instead of generating a name
                              based on the room's members if the room has no
                              title or aliases.
+        room_summary: The room's summary from the store, if available. If
+                      given, the name, canonical alias and members are taken
+                      from it rather than by loading the state events. As the
+                      summary is of the room's current state, it should only
+                      be given when `room_state_ids` is the current state too.
 
     Returns:
         (string or None) A human readable name for the room.
     """
+    if room_summary is not None:
+        # does it have a name or canonical alias?
+        if room_summary["name"]:
+            defer.returnValue(room_summary["name"])
+
+        canonical_alias = room_summary["canonical_alias"]
+        if canonical_alias and _looks_like_an_alias(canonical_alias):
+            defer.returnValue(canonical_alias)
+
     # does it have a name?
-    if ("m.room.name", "") in room_state_ids:
+    elif ("m.room.name", "") in room_state_ids:
         m_room_name = yield store.get_event(
             room_state_ids[("m.room.name", "")], allow_none=True
         )
@@ -53,7 +67,7 @@ def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True
             defer.returnValue(m_room_name.content["name"])
 
     # does it have a canonical alias?
-    if ("m.room.canonical_alias", "") in room_state_ids:
+    if room_summary is None and ("m.room.canonical_alias", "") in room_state_ids:
         canon_alias = yield store.get_event(
             room_state_ids[("m.room.canonical_alias", "")], allow_none=True
         )
@@ -111,10 +125,26 @@ def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True
 
     # we're going to have to generate a name based on who's in the room,
     # so find out who is in the room that isn't the user.
-    if "m.room.member" in room_state_bytype_ids:
-        member_events = yield store.get_events(
-            room_state_bytype_ids["m.room.member"].values()
+    if room_summary is not None:
+        # We only need the member events of the first few members, and the
+        # number of the others.
+        member_event_ids = [
+            room_state_ids[("m.room.member", hero)]
+            for hero in room_summary["heroes"]
+            if ("m.room.member", hero) in room_state_ids
+        ]
+        member_count = (
+            room_summary["joined_members"] + room_summary["invited_members"]
         )
+    elif "m.room.member" in room_state_bytype_ids:
+        member_event_ids = room_state_bytype_ids["m.room.member"].values()
+        member_count = None
+    else:
+        member_event_ids = []
+        member_count = None
+
+    if member_event_ids:
+        member_events = yield store.get_events(member_event_ids)
         all_members = [
             ev for ev in member_events.values()
             if ev.content['membership'] == "join" or ev.content['membership'] == "invite"
@@ -128,6 +158,17 @@ def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True
         other_members = []
         all_members = []
 
+    if member_count is None:
+        other_count = len(other_members)
+    else:
+        other_count = member_count
+        if (
+            my_member_event is not None and
+            my_member_event.content['membership'] in ("join", "invite")
+        ):
+            other_count -= 1
+        other_count = max(other_count, len(other_members))
+
     if len(other_members) == 0:
         if len(all_members) == 1:
             # self-chat, peeked room with 1 participant,
@@ -155,18 +196,31 @@ def calculate_room_name(store, room_state_ids, user_id, fallback_to_members=True
                 defer.returnValue(name_from_member_event(all_members[0]))
         else:
             defer.returnValue(ALL_ALONE)
-    elif len(other_members) == 1 and not fallback_to_single_member:
+    elif other_count == 1 and not fallback_to_single_member:
         return
     else:
-        defer.returnValue(descriptor_from_member_events(other_members))
+        defer.returnValue(
+            descriptor_from_member_events(other_members, count=other_count)
+        )
+
 
+def descriptor_from_member_events(member_events, count=None):
+    """Describes a group of members, e.g. "Alice and 3 others".
+
+    Args:
+        member_events (list[FrozenEvent]): the member events of (at least
+            the first two of) the members.
+        count (int|None): the number of members, if there are more than
+            there are member events.
+    """
+    if count is None:
+        count = len(member_events)
 
-def descriptor_from_member_events(member_events):
-    if len(member_events) == 0:
+    if count == 0 or not member_events:
         return "nobody"
-    elif len(member_events) == 1:
+    elif count == 1 or len(member_events) == 1:
         return name_from_member_event(member_events[0])
-    elif len(member_events) == 2:
+    elif count == 2:
         return "%s and %s" % (
             name_from_member_event(member_events[0]),
             name_from_member_event(member_events[1]),
@@ -174,7 +228,7 @@ def descriptor_from_member_events(member_events):
     else:
         return "%s and %d others" % (
             name_from_member_event(member_events[0]),
-            len(member_events) - 1,
+            count - 1,
         )
 
 
@@ -20,6 +20,7 @@ from synapse.storage import DataStore
 from synapse.storage.roommember import RoomMemberStore
 from synapse.storage.event_federation import EventFederationStore
 from synapse.storage.event_push_actions import EventPushActionsStore
+from synapse.storage.room_summaries import RoomSummaryStore
 from synapse.storage.state import StateStore
 from synapse.storage.stream import StreamStore
 from synapse.util.caches.stream_change_cache import StreamChangeCache
@@ -84,6 +85,14 @@ class SlavedEventStore(BaseSlavedStore):
     get_unread_event_push_actions_by_room_for_user = (
         EventPushActionsStore.__dict__["get_unread_event_push_actions_by_room_for_user"]
     )
+    get_unread_event_push_actions_by_rooms_for_user = (
+        EventPushActionsStore.__dict__[
+            "get_unread_event_push_actions_by_rooms_for_user"
+        ]
+    )
+    _get_unread_counts_by_rooms_txn = (
+        DataStore._get_unread_counts_by_rooms_txn.__func__
+    )
     _get_unread_counts_by_receipt_txn = (
         DataStore._get_unread_counts_by_receipt_txn.__func__
     )
@@ -109,6 +118,10 @@ class SlavedEventStore(BaseSlavedStore):
         StateStore.__dict__["get_current_state_ids"]
     )
     get_state_group_delta = StateStore.__dict__["get_state_group_delta"]
+    get_room_summary = RoomSummaryStore.__dict__["get_room_summary"]
+    _get_room_summary_txn = DataStore._get_room_summary_txn.__func__
+    _compute_room_summary_txn = DataStore._compute_room_summary_txn.__func__
+    _get_room_heroes_txn = DataStore._get_room_heroes_txn.__func__
     _get_joined_hosts_cache = RoomMemberStore.__dict__["_get_joined_hosts_cache"]
     has_room_changed_since = DataStore.has_room_changed_since.__func__
 
@@ -193,6 +206,10 @@ class SlavedEventStore(BaseSlavedStore):
     )
 
     get_all_new_events_stream = DataStore.get_all_new_events_stream.__func__
+    get_latest_local_events_since = DataStore.get_latest_local_events_since.__func__
+    _get_events_with_stream_orderings = (
+        DataStore._get_events_with_stream_orderings.__func__
+    )
 
     get_federation_out_pos = DataStore.get_federation_out_pos.__func__
     update_federation_out_pos = DataStore.update_federation_out_pos.__func__
@@ -242,6 +259,9 @@ class SlavedEventStore(BaseSlavedStore):
         if redacts:
             self._invalidate_get_event_cache(redacts)
 
+        if state_key is not None:
+            self.get_room_summary.invalidate((room_id,))
+
         if etype == EventTypes.Member:
             self._membership_stream_cache.entity_has_changed(
                 state_key, stream_ordering
@@ -26,5 +26,12 @@ class TransactionStore(BaseSlavedStore):
     set_destination_retry_timings = DataStore.set_destination_retry_timings.__func__
     _set_destination_retry_timings = DataStore._set_destination_retry_timings.__func__
 
+    get_destination_last_sent_stream_ordering = (
+        DataStore.get_destination_last_sent_stream_ordering.__func__
+    )
+    set_destination_last_sent_stream_ordering = (
+        DataStore.set_destination_last_sent_stream_ordering.__func__
+    )
+
     prep_send_transaction = DataStore.prep_send_transaction.__func__
     delivered_txn = DataStore.delivered_txn.__func__
@@ -156,11 +156,11 @@ class ReplicationClientHandler(object):
             logger.warn("Queuing command as not connected: %r", cmd.NAME)
             self.pending_commands.append(cmd)
 
-    def send_federation_ack(self, token):
+    def send_federation_ack(self, token, instance=0):
         """Ack data for the federation stream. This allows the master to drop
         data stored purely in memory.
         """
-        self.send_command(FederationAckCommand(token))
+        self.send_command(FederationAckCommand(token, instance))
 
     def send_user_sync(self, user_id, is_syncing, last_sync_ms):
         """Poke the master that a user has started/stopped syncing.
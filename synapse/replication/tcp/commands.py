@@ -224,23 +224,28 @@ class FederationAckCommand(Command):
     federation stream. This allows the master to drop in-memory caches of the
     federation stream.
 
-    This must only be sent from one worker (i.e. the one sending federation)
+    This must only be sent from the workers sending federation. If there are
+    several, each includes which federation sender instance it is.
 
     Format::
 
-        FEDERATION_ACK <token>
+        FEDERATION_ACK <token> [<instance>]
     """
     NAME = "FEDERATION_ACK"
 
-    def __init__(self, token):
+    def __init__(self, token, instance=0):
         self.token = token
+        self.instance = instance
 
     @classmethod
     def from_line(cls, line):
-        return cls(int(line))
+        parts = line.split(" ")
+        token = int(parts[0])
+        instance = int(parts[1]) if len(parts) > 1 else 0
+        return cls(token, instance)
 
     def to_line(self):
-        return str(self.token)
+        return "%d %d" % (self.token, self.instance)
 
 
 class SyncCommand(Command):
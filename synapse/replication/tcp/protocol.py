@@ -398,7 +398,7 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             self.subscribe_to_stream(stream_name, token)
 
     def on_FEDERATION_ACK(self, cmd):
-        self.streamer.federation_ack(cmd.token)
+        self.streamer.federation_ack(cmd.token, cmd.instance)
 
     def on_REMOVE_PUSHER(self, cmd):
         self.streamer.on_remove_pusher(cmd.app_id, cmd.push_key, cmd.user_id)
@@ -39,6 +39,10 @@ user_ip_cache_counter = metrics.register_counter("user_ip_cache")
 
 logger = logging.getLogger(__name__)
 
+# How long a federation sender can go without acking before we assume it is
+# down, and stop keeping federation rows around for it.
+FEDERATION_ACK_TIMEOUT_MS = 5 * 60 * 1000
+
 
 class ReplicationStreamProtocolFactory(Factory):
     """Factory for new replication connections.
@@ -101,6 +105,12 @@ class ReplicationStreamer(object):
         if not hs.config.send_federation:
             self.federation_sender = hs.get_federation_sender()
 
+        # The number of federation senders, and the last position each has
+        # acked in the federation stream along with when it did so
+        self._federation_sender_instances = hs.config.federation_sender_instances
+        self._federation_acks = {}
+        self._federation_acks_start_ms = self.clock.time_msec()
+
         self.notifier.add_replication_callback(self.on_notifier_poke)
 
         # Keeps track of whether we are currently checking for updates
@@ -208,12 +218,31 @@ class ReplicationStreamer(object):
         return stream.get_updates_since(token)
 
     @measure_func("repl.federation_ack")
-    def federation_ack(self, token):
+    def federation_ack(self, token, instance=0):
         """We've received an ack for federation stream from a client.
         """
         federation_ack_counter.inc()
-        if self.federation_sender:
-            self.federation_sender.federation_ack(token)
+        if not self.federation_sender:
+            return
+
+        now = self.clock.time_msec()
+        self._federation_acks[instance] = (token, now)
+
+        # We can only drop the rows once every federation sender has seen them.
+        # Senders which haven't acked for a while are assumed to be down, so
+        # that we don't keep rows for them forever; they will miss the dropped
+        # rows when they come back.
+        live_tokens = [
+            ack_token for ack_token, ack_ms in self._federation_acks.itervalues()
+            if now - ack_ms < FEDERATION_ACK_TIMEOUT_MS
+        ]
+
+        if len(live_tokens) < self._federation_sender_instances:
+            # Give the senders time to connect after we start.
+            if now - self._federation_acks_start_ms < FEDERATION_ACK_TIMEOUT_MS:
+                return
+
+        self.federation_sender.federation_ack(min(live_tokens))
 
     @measure_func("repl.on_user_sync")
     def on_user_sync(self, conn_id, user_id, is_syncing, last_sync_ms):
@@ -239,9 +268,12 @@ class ReplicationStreamer(object):
     @measure_func("repl.on_invalidate_cache")
     def on_invalidate_cache(self, cache_func, keys):
         """The client has asked us to invalidate a cache
+
+        We pass the invalidation on through the caches stream, so that the
+        other workers see it too.
         """
         invalidate_cache_counter.inc()
-        getattr(self.store, cache_func).invalidate(tuple(keys))
+        return self.store.invalidate_cache_and_stream(cache_func, tuple(keys))
 
     @measure_func("repl.on_user_ip")
     def on_user_ip(self, user_id, access_token, ip, user_agent, device_id, last_seen):
@@ -128,9 +128,56 @@ class PurgeHistoryRestServlet(ClientV1RestServlet):
         if not is_admin:
             raise AuthError(403, "You are not a server admin")
 
-        yield self.handlers.message_handler.purge_history(room_id, event_id)
+        purge_id = yield self.handlers.message_handler.start_purge_history(
+            room_id, event_id,
+        )
 
-        defer.returnValue((200, {}))
+        defer.returnValue((200, {"purge_id": purge_id}))
+
+
+class PurgeHistoryStatusRestServlet(ClientV1RestServlet):
+    PATTERNS = client_path_patterns(
+        "/admin/purge_history_status/(?P<purge_id>[^/]*)"
+    )
+
+    def __init__(self, hs):
+        super(PurgeHistoryStatusRestServlet, self).__init__(hs)
+        self.handlers = hs.get_handlers()
+
+    @defer.inlineCallbacks
+    def on_GET(self, request, purge_id):
+        requester = yield self.auth.get_user_by_req(request)
+        is_admin = yield self.auth.is_server_admin(requester.user)
+
+        if not is_admin:
+            raise AuthError(403, "You are not a server admin")
+
+        ret = yield self.handlers.message_handler.get_purge_status(purge_id)
+
+        defer.returnValue((200, ret))
+
+
+class BackgroundUpdatesRestServlet(ClientV1RestServlet):
+    """Lists the outstanding background database updates, along with their
+    progress and current rate.
+    """
+    PATTERNS = client_path_patterns("/admin/background_updates")
+
+    def __init__(self, hs):
+        super(BackgroundUpdatesRestServlet, self).__init__(hs)
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def on_GET(self, request):
+        requester = yield self.auth.get_user_by_req(request)
+        is_admin = yield self.auth.is_server_admin(requester.user)
+
+        if not is_admin:
+            raise AuthError(403, "You are not a server admin")
+
+        updates = yield self.store.get_background_updates_status()
+
+        defer.returnValue((200, {"updates": updates}))
 
 
 class DeactivateAccountRestServlet(ClientV1RestServlet):
@@ -481,6 +528,8 @@ def register_servlets(hs, http_server):
     PurgeMediaCacheRestServlet(hs).register(http_server)
     DeactivateAccountRestServlet(hs).register(http_server)
     PurgeHistoryRestServlet(hs).register(http_server)
+    PurgeHistoryStatusRestServlet(hs).register(http_server)
+    BackgroundUpdatesRestServlet(hs).register(http_server)
     UsersRestServlet(hs).register(http_server)
     ResetPasswordRestServlet(hs).register(http_server)
     GetUsersPaginatedRestServlet(hs).register(http_server)
@@ -15,6 +15,10 @@
 
 from twisted.internet import defer
 
+from synapse.http.server import (
+    encode_json, request_accepts_gzip, request_user_agent_is_curl,
+    respond_with_json_chunks,
+)
 from synapse.http.servlet import (
     RestServlet, parse_string, parse_integer, parse_boolean
 )
@@ -27,16 +31,32 @@ from synapse.events.utils import (
 from synapse.api.filtering import FilterCollection, DEFAULT_FILTER_COLLECTION
 from synapse.api.errors import SynapseError
 from synapse.api.constants import PresenceState
+from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.logcontext import preserve_fn
+import synapse.metrics
 from ._base import client_v2_patterns
 from ._base import set_timeline_upper_limit
 
 import itertools
 import logging
+import zlib
 
+from canonicaljson import encode_pretty_printed_json
 import ujson as json
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+# The number of initial syncs which looked for a snapshot, by whether one was
+# used ("hit"), there wasn't one ("miss") or it was too old ("expired")
+snapshot_lookups_counter = metrics.register_counter(
+    "sync_snapshot_lookups", labels=["result"],
+)
+
+# The maximum number of sync snapshots a worker keeps in memory
+SYNC_SNAPSHOT_CACHE_SIZE = 200
+
 
 class SyncRestServlet(RestServlet):
     """
@@ -85,6 +105,30 @@ class SyncRestServlet(RestServlet):
         self.clock = hs.get_clock()
         self.filtering = hs.get_filtering()
         self.presence_handler = hs.get_presence_handler()
+        self.store = hs.get_datastore()
+
+        # We encode the streamed responses ourselves, so need to match the
+        # JSON encoding of the resource we're registered with.
+        self._canonical_json = True
+
+        # (user_id, filter_key) of the sync snapshots currently being refreshed
+        self._refreshing_snapshots = set()
+
+        # Workers can't write to the database, so they keep their snapshots in
+        # memory instead, compressed. Maps (user_id, filter_key) to
+        # (ts, compressed snapshot_json).
+        self._snapshot_cache = None
+        if hs.config.sync_snapshots_enabled and hs.config.worker_app:
+            self._snapshot_cache = ExpiringCache(
+                "sync_snapshots", self.clock,
+                max_len=SYNC_SNAPSHOT_CACHE_SIZE,
+                expiry_ms=hs.config.sync_snapshot_max_age_ms,
+            )
+            self._snapshot_cache.start()
+
+    def register(self, http_server):
+        self._canonical_json = getattr(http_server, "canonical_json", True)
+        super(SyncRestServlet, self).register(http_server)
 
     @defer.inlineCallbacks
     def on_GET(self, request):
@@ -157,19 +201,184 @@ class SyncRestServlet(RestServlet):
         context = yield self.presence_handler.user_syncing(
             user.to_string(), affect_presence=affect_presence,
         )
+        use_snapshot = (
+            self.hs.config.sync_snapshots_enabled
+            and since_token is None
+            and not full_state
+            and not requester.is_guest
+        )
+        filter_key = filter_id or ""
+
         with context:
+            if use_snapshot:
+                response_content = yield self._get_response_from_snapshot(
+                    sync_config, filter, filter_key,
+                )
+                if response_content is not None:
+                    defer.returnValue((200, response_content))
+
             sync_result = yield self.sync_handler.wait_for_sync_for_user(
                 sync_config, since_token=since_token, timeout=timeout,
                 full_state=full_state
             )
 
+        if use_snapshot:
+            preserve_fn(self._store_snapshot)(
+                user.to_string(), filter_key, filter, sync_result,
+            )
+
         time_now = self.clock.time_msec()
+
+        if since_token is None or full_state:
+            # These responses can be huge, so rather than building the whole
+            # response up front we encode and send it a room at a time.
+            yield respond_with_json_chunks(
+                request, 200,
+                self.encode_response_chunks(
+                    time_now, sync_result, requester.access_token_id, filter,
+                    canonical_json=self._canonical_json,
+                    pretty_print=request_user_agent_is_curl(request),
+                ),
+                send_cors=True,
+                version_string=self.hs.version_string,
+                gzip=(
+                    self.hs.config.gzip_responses
+                    and request_accepts_gzip(request)
+                ),
+                servlet_name=self.__class__.__name__,
+                vary_on_encoding=self.hs.config.gzip_responses,
+            )
+            defer.returnValue(None)
+
         response_content = self.encode_response(
             time_now, sync_result, requester.access_token_id, filter
         )
 
         defer.returnValue((200, response_content))
 
+    @defer.inlineCallbacks
+    def _get_response_from_snapshot(self, sync_config, filter, filter_key):
+        """Builds a response to an initial sync from the stored snapshot, if
+        there is a recent enough one.
+
+        The response is as of the snapshot's stream token, so the client will
+        catch up on anything since with its next (incremental) sync.
+
+        Returns:
+            Deferred[dict|None]: the response, or None if there is no usable
+                snapshot.
+        """
+        user_id = sync_config.user.to_string()
+        device_id = sync_config.device_id
+
+        snapshot = yield self._get_snapshot(user_id, filter_key)
+        if snapshot is None:
+            snapshot_lookups_counter.inc("miss")
+            defer.returnValue(None)
+
+        age = self.clock.time_msec() - snapshot["ts"]
+        if age > self.hs.config.sync_snapshot_max_age_ms:
+            snapshot_lookups_counter.inc("expired")
+            defer.returnValue(None)
+
+        snapshot_lookups_counter.inc("hit")
+
+        if age > self.hs.config.sync_snapshot_refresh_interval_ms:
+            preserve_fn(self._refresh_snapshot)(sync_config, filter, filter_key)
+
+        response_content = snapshot["snapshot"]
+        _adjust_ages(response_content, age)
+
+        # The snapshot doesn't include anything specific to a device. We reset
+        # the to-device position, so that all of the device's outstanding
+        # to-device messages are returned by its next sync.
+        next_batch = StreamToken.from_string(snapshot["stream_token"])
+        response_content["next_batch"] = next_batch.copy_and_replace(
+            "to_device_key", 0,
+        ).to_string()
+
+        one_time_key_counts = {}
+        if device_id:
+            one_time_key_counts = yield self.store.count_e2e_one_time_keys(
+                user_id, device_id
+            )
+        response_content["device_one_time_keys_count"] = one_time_key_counts
+
+        defer.returnValue(response_content)
+
+    @defer.inlineCallbacks
+    def _refresh_snapshot(self, sync_config, filter, filter_key):
+        user_id = sync_config.user.to_string()
+        key = (user_id, filter_key)
+        if key in self._refreshing_snapshots:
+            return
+
+        self._refreshing_snapshots.add(key)
+        try:
+            sync_result = yield self.sync_handler.current_sync_for_user(
+                sync_config._replace(device_id=None, request_key=None),
+            )
+            yield self._store_snapshot(user_id, filter_key, filter, sync_result)
+        except Exception:
+            logger.exception("Failed to refresh sync snapshot for %s", user_id)
+        finally:
+            self._refreshing_snapshots.discard(key)
+
+    @defer.inlineCallbacks
+    def _store_snapshot(self, user_id, filter_key, filter, sync_result):
+        # Transaction IDs are only returned to the device which sent the event,
+        # so we don't include any.
+        snapshot = self.encode_response(
+            self.clock.time_msec(), sync_result, None, filter,
+        )
+        snapshot["to_device"] = {"events": []}
+        snapshot["device_lists"] = {"changed": [], "left": []}
+        snapshot["device_one_time_keys_count"] = {}
+
+        snapshot_json = json.dumps(snapshot)
+        compressed = zlib.compress(snapshot_json)
+        if len(compressed) > self.hs.config.sync_snapshot_max_size:
+            logger.debug(
+                "Not storing %d byte sync snapshot for %s",
+                len(compressed), user_id,
+            )
+            return
+
+        if self._snapshot_cache is not None:
+            self._snapshot_cache[(user_id, filter_key)] = (
+                self.clock.time_msec(), compressed,
+            )
+            return
+
+        try:
+            yield self.store.store_sync_snapshot(
+                user_id, filter_key, snapshot["next_batch"], snapshot_json,
+            )
+        except Exception:
+            logger.exception("Failed to store sync snapshot for %s", user_id)
+
+    def _get_snapshot(self, user_id, filter_key):
+        """Get the snapshot for a user, from memory on workers or from the
+        database otherwise.
+
+        Returns:
+            Deferred[dict|None]: as get_sync_snapshot
+        """
+        if self._snapshot_cache is None:
+            return self.store.get_sync_snapshot(user_id, filter_key)
+
+        cached = self._snapshot_cache.get((user_id, filter_key))
+        if cached is None:
+            return defer.succeed(None)
+
+        ts, compressed = cached
+        snapshot = json.loads(zlib.decompress(compressed))
+        return defer.succeed({
+            "stream_token": snapshot["next_batch"],
+            "ts": ts,
+            "snapshot": snapshot,
+        })
+
     @staticmethod
     def encode_response(time_now, sync_result, access_token_id, filter):
         joined = SyncRestServlet.encode_joined(
@@ -209,6 +418,77 @@ class SyncRestServlet(RestServlet):
             "next_batch": sync_result.next_batch.to_string(),
         }
 
+    @staticmethod
+    def encode_response_chunks(time_now, sync_result, access_token_id, filter,
+                               canonical_json=True, pretty_print=False):
+        """Encodes a sync result as JSON, a piece at a time
+
+        This gives the same response as encode_response, except that the
+        joined and left rooms are only serialised and encoded one at a time,
+        as the chunks are consumed.
+
+        Args:
+            canonical_json (bool): whether to use canonical JSON
+            pretty_print (bool): whether to pretty print the response. The
+                response is then encoded in one go, as the indentation
+                depends on the whole structure.
+
+        Returns:
+            iterator[bytes]: the pieces of the encoded response
+        """
+        if pretty_print:
+            yield encode_pretty_printed_json(SyncRestServlet.encode_response(
+                time_now, sync_result, access_token_id, filter,
+            )) + "\n"
+            return
+
+        response = SyncRestServlet.encode_response(
+            time_now, sync_result._replace(joined=[], archived=[]),
+            access_token_id, filter,
+        )
+        rooms = response.pop("rooms")
+        joined = sync_result.joined
+        archived = sync_result.archived
+
+        # Everything else is written around the rooms. Canonical JSON needs
+        # its keys sorted, so in that case the rooms go in their place among
+        # the other keys rather than at the end.
+        before, after = response, {}
+        if canonical_json:
+            joined = sorted(joined, key=lambda room: room.room_id)
+            archived = sorted(archived, key=lambda room: room.room_id)
+            before = {k: v for k, v in response.items() if k < "rooms"}
+            after = {k: v for k, v in response.items() if k > "rooms"}
+
+        def encode_rooms(rooms, joined):
+            for i, room in enumerate(rooms):
+                encoded = SyncRestServlet.encode_room(
+                    room, time_now, access_token_id, joined=joined,
+                    only_fields=filter.event_fields,
+                )
+                yield "%s%s:%s" % (
+                    "," if i else "",
+                    encode_json(room.room_id, canonical_json=canonical_json),
+                    encode_json(encoded, canonical_json=canonical_json),
+                )
+
+        # Leave the object open so that we can add the rooms.
+        yield encode_json(before, canonical_json=canonical_json)[:-1]
+        yield '%s"rooms":{"invite":%s,"join":{' % (
+            "," if before else "",
+            encode_json(rooms["invite"], canonical_json=canonical_json),
+        )
+        for chunk in encode_rooms(joined, joined=True):
+            yield chunk
+        yield '},"leave":{'
+        for chunk in encode_rooms(archived, joined=False):
+            yield chunk
+        yield "}}"
+        if after:
+            yield "," + encode_json(after, canonical_json=canonical_json)[1:]
+        else:
+            yield "}"
+
     @staticmethod
     def encode_presence(events, time_now):
         return {
@@ -373,3 +653,27 @@ class SyncRestServlet(RestServlet):
 
 def register_servlets(hs, http_server):
     SyncRestServlet(hs).register(http_server)
+
+
+def _adjust_ages(response_content, elapsed_ms):
+    """Updates the ages of the events and presence in a stored sync response to
+    account for the time since it was generated.
+    """
+    rooms = response_content["rooms"]
+    events = []
+    for section in ("join", "leave"):
+        for room in rooms[section].itervalues():
+            events.extend(room["timeline"]["events"])
+            events.extend(room["state"]["events"])
+    for room in rooms["invite"].itervalues():
+        events.extend(room["invite_state"]["events"])
+
+    for event in events:
+        if "age" in event.get("unsigned", {}):
+            event["unsigned"]["age"] += elapsed_ms
+        if "age" in event:
+            event["age"] += elapsed_ms
+
+    for event in response_content["presence"]["events"]:
+        if "last_active_ago" in event["content"]:
+            event["content"]["last_active_ago"] += elapsed_ms
@@ -44,7 +44,10 @@ from .filtering import FilteringStore
 from .end_to_end_keys import EndToEndKeyStore
 
 from .receipts import ReceiptsStore
+from .retention import RetentionStore
+from .room_summaries import RoomSummaryStore
 from .search import SearchStore
+from .sync_snapshots import SyncSnapshotStore
 from .tags import TagsStore
 from .account_data import AccountDataStore
 from .openid import OpenIdStore
@@ -89,6 +92,9 @@ class DataStore(RoomMemberStore, RoomStore,
                 DeviceInboxStore,
                 UserDirectoryStore,
                 GroupServerStore,
+                RetentionStore,
+                SyncSnapshotStore,
+                RoomSummaryStore,
                 ):
 
     def __init__(self, db_conn, hs):
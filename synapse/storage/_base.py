@@ -978,6 +978,30 @@ class SQLBaseStore(object):
                 }
             )
 
+    def invalidate_cache_and_stream(self, cache_name, keys):
+        """Invalidates the named cache and adds it to the cache stream, so
+        slaves will invalidate theirs too.
+
+        This is used when a worker asks us to invalidate a cache, so that the
+        invalidation reaches all of the other workers.
+
+        Args:
+            cache_name (str): the name of the cached function
+            keys (tuple): the cache key to invalidate
+
+        Returns:
+            Deferred
+        """
+        cache_func = getattr(self, cache_name, None)
+        if not cache_func:
+            # We don't have that cache here, so can't stream it either.
+            return defer.succeed(None)
+
+        return self.runInteraction(
+            "invalidate_cache_and_stream",
+            self._invalidate_cache_and_stream, cache_func, keys,
+        )
+
     def get_all_updated_caches(self, last_id, current_id, limit):
         if last_id == current_id:
             return defer.succeed([])
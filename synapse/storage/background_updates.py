@@ -17,6 +17,8 @@ import synapse.util.async
 from ._base import SQLBaseStore
 from . import engines
 
+from synapse.util.logcontext import make_deferred_yieldable, preserve_fn
+
 from twisted.internet import defer
 
 import ujson as json
@@ -73,6 +75,12 @@ class BackgroundUpdateStore(SQLBaseStore):
     background. Each update processes a batch of data at once. We attempt to
     limit the impact of each update by monitoring how long each batch takes to
     process and autotuning the batch size.
+
+    Several updates may be run at once (see `start_doing_background_updates`),
+    in which case each update is only ever worked on by one runner at a time.
+    Updates are picked in order of priority, and round-robin amongst updates
+    of the same priority. An update is not started until the update it
+    `depends_on` has finished.
     """
 
     MINIMUM_BACKGROUND_BATCH_SIZE = 100
@@ -85,11 +93,44 @@ class BackgroundUpdateStore(SQLBaseStore):
         self._background_update_performance = {}
         self._background_update_queue = []
         self._background_update_handlers = {}
+        self._background_update_priorities = {}
 
-    @defer.inlineCallbacks
-    def start_doing_background_updates(self):
-        logger.info("Starting background schema updates")
+        # updates which a runner is currently doing a batch of
+        self._background_updates_in_progress = set()
+
+        # updates which have finished since we started, so that a refill of
+        # the queue which raced with them finishing doesn't add them back.
+        self._background_updates_ended = set()
+
+        # only one runner refills the queue at a time.
+        self._background_update_queue_linearizer = synapse.util.async.Linearizer(
+            "background_update_queue"
+        )
+
+    def start_doing_background_updates(self, parallelism=None):
+        """Start running the background updates
 
+        Args:
+            parallelism (int|None): how many updates to run at once. Defaults
+                to the `background_update_parallelism` config option.
+
+        Returns:
+            Deferred: resolves once there are no more updates to do
+        """
+        if parallelism is None:
+            parallelism = self.hs.config.background_update_parallelism
+
+        logger.info(
+            "Starting background schema updates with parallelism %d", parallelism,
+        )
+
+        return make_deferred_yieldable(defer.gatherResults([
+            preserve_fn(self._background_update_loop)()
+            for _ in range(parallelism)
+        ], consumeErrors=True))
+
+    @defer.inlineCallbacks
+    def _background_update_loop(self):
         while True:
             yield synapse.util.async.sleep(
                 self.BACKGROUND_UPDATE_INTERVAL_MS / 1000.)
@@ -102,6 +143,10 @@ class BackgroundUpdateStore(SQLBaseStore):
                 logger.exception("Error doing update")
             else:
                 if result is None:
+                    if self._background_updates_in_progress:
+                        # another runner is still working on an update, which
+                        # may unblock others once it completes.
+                        continue
                     logger.info(
                         "No more background updates to do."
                         " Unscheduling background update task."
@@ -121,27 +166,59 @@ class BackgroundUpdateStore(SQLBaseStore):
             no more work to do.
         """
         if not self._background_update_queue:
-            updates = yield self._simple_select_list(
-                "background_updates",
-                keyvalues=None,
-                retcols=("update_name", "depends_on"),
-            )
-            in_flight = set(update["update_name"] for update in updates)
-            for update in updates:
-                if update["depends_on"] not in in_flight:
-                    self._background_update_queue.append(update['update_name'])
-
-        if not self._background_update_queue:
-            # no work left to do
+            with (yield self._background_update_queue_linearizer.queue(())):
+                # another runner may have refilled the queue while we waited.
+                if not self._background_update_queue:
+                    yield self._refill_background_update_queue()
+
+        # pick the first update that isn't already being worked on by another
+        # runner.
+        for update_name in self._background_update_queue:
+            if update_name not in self._background_updates_in_progress:
+                break
+        else:
+            # no work left to do, or at least none that isn't already being
+            # done.
             defer.returnValue(None)
 
-        # pop from the front, and add back to the back
-        update_name = self._background_update_queue.pop(0)
+        # move it to the back, and then re-sort by priority, so that we
+        # round-robin between updates of the same priority.
+        self._background_update_queue.remove(update_name)
         self._background_update_queue.append(update_name)
+        self._background_update_queue.sort(
+            key=lambda name: -self._background_update_priorities.get(name, 0)
+        )
 
-        res = yield self._do_background_update(update_name, desired_duration_ms)
+        self._background_updates_in_progress.add(update_name)
+        try:
+            res = yield self._do_background_update(
+                update_name, desired_duration_ms,
+            )
+        finally:
+            self._background_updates_in_progress.discard(update_name)
         defer.returnValue(res)
 
+    @defer.inlineCallbacks
+    def _refill_background_update_queue(self):
+        updates = yield self._simple_select_list(
+            "background_updates",
+            keyvalues=None,
+            retcols=("update_name", "depends_on"),
+        )
+        in_flight = set(
+            update["update_name"] for update in updates
+            if update["update_name"] not in self._background_updates_ended
+        )
+        for update in updates:
+            if update["update_name"] not in in_flight:
+                continue
+            if update["depends_on"] not in in_flight:
+                self._background_update_queue.append(update['update_name'])
+
+        self._background_update_queue.sort(
+            key=lambda name: -self._background_update_priorities.get(name, 0)
+        )
+
     @defer.inlineCallbacks
     def _do_background_update(self, update_name, desired_duration_ms):
         logger.info("Starting update batch on background update '%s'",
@@ -192,7 +269,8 @@ class BackgroundUpdateStore(SQLBaseStore):
 
         defer.returnValue(len(self._background_update_performance))
 
-    def register_background_update_handler(self, update_name, update_handler):
+    def register_background_update_handler(self, update_name, update_handler,
+                                           priority=0):
         """Register a handler for doing a background update.
 
         The handler should take two arguments:
@@ -206,8 +284,58 @@ class BackgroundUpdateStore(SQLBaseStore):
         Args:
             update_name(str): The name of the update that this code handles.
             update_handler(function): The function that does the update.
+            priority(int): Updates with a higher priority are run in
+                preference to those with a lower one.
         """
         self._background_update_handlers[update_name] = update_handler
+        self._background_update_priorities[update_name] = priority
+
+    @defer.inlineCallbacks
+    def get_background_updates_status(self):
+        """Get the status of the outstanding background updates
+
+        Returns:
+            Deferred[list[dict]]: one entry per outstanding update, with the
+                update's name, the update it depends on, its priority,
+                whether a batch is currently running, the stored progress,
+                the number of items updated since startup and the current and
+                overall rates in items/sec.
+        """
+        updates = yield self._simple_select_list(
+            "background_updates",
+            keyvalues=None,
+            retcols=("update_name", "depends_on", "progress_json"),
+            desc="get_background_updates_status",
+        )
+
+        def per_sec(items_per_ms):
+            if items_per_ms is None:
+                return None
+            return items_per_ms * 1000
+
+        results = []
+        for update in updates:
+            update_name = update["update_name"]
+            performance = self._background_update_performance.get(update_name)
+            results.append({
+                "update_name": update_name,
+                "depends_on": update["depends_on"],
+                "priority": self._background_update_priorities.get(update_name, 0),
+                "in_progress": update_name in self._background_updates_in_progress,
+                "progress": json.loads(update["progress_json"]),
+                "total_item_count": (
+                    performance.total_item_count if performance else 0
+                ),
+                "average_items_per_sec": per_sec(
+                    performance and performance.average_items_per_ms()
+                ),
+                "total_items_per_sec": per_sec(
+                    performance and performance.total_items_per_ms()
+                ),
+            })
+
+        results.sort(key=lambda update: -update["priority"])
+        defer.returnValue(results)
 
     def register_background_index_update(self, update_name, index_name,
                                          table, columns, where_clause=None,
@@ -321,6 +449,7 @@ class BackgroundUpdateStore(SQLBaseStore):
         # Clear the background update queue so that we will pick up the new
         # task on the next iteration of do_background_update.
         self._background_update_queue = []
+        self._background_updates_ended.discard(update_name)
         progress_json = json.dumps(progress)
 
         return self._simple_insert(
@@ -339,6 +468,7 @@ class BackgroundUpdateStore(SQLBaseStore):
         self._background_update_queue = [
             name for name in self._background_update_queue if name != update_name
         ]
+        self._background_updates_ended.add(update_name)
         return self._simple_delete_one(
             "background_updates", keyvalues={"update_name": update_name}
         )
@@ -39,6 +39,20 @@ class DeviceInboxStore(BackgroundUpdateStore):
             columns=["stream_id", "user_id"],
         )
 
+        # used by the retention policies for the federation inbox and outbox
+        self.register_background_index_update(
+            "device_federation_inbox_received_ts_index",
+            index_name="device_federation_inbox_received_ts",
+            table="device_federation_inbox",
+            columns=["received_ts"],
+        )
+        self.register_background_index_update(
+            "device_federation_outbox_queued_ts_index",
+            index_name="device_federation_outbox_queued_ts",
+            table="device_federation_outbox",
+            columns=["queued_ts"],
+        )
+
         self.register_background_update_handler(
             self.DEVICE_INBOX_STREAM_ID,
             self._background_drop_index_device_inbox,
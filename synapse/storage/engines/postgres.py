@@ -23,6 +23,7 @@ class PostgresEngine(object):
         self.module = database_module
         self.module.extensions.register_type(self.module.extensions.UNICODE)
         self.synchronous_commit = database_config.get("synchronous_commit", True)
+        self._version = None
 
     def check_database(self, txn):
         txn.execute("SHOW SERVER_ENCODING")
@@ -37,7 +38,17 @@ class PostgresEngine(object):
     def convert_param_style(self, sql):
         return sql.replace("?", "%s")
 
+    @property
+    def can_native_upsert(self):
+        """Whether the server supports INSERT ... ON CONFLICT, which was
+        added in postgres 9.5.
+        """
+        return self._version >= 90500
+
     def on_new_connection(self, db_conn):
+        # e.g. 90405 for 9.4.5
+        self._version = db_conn.server_version
+
         db_conn.set_isolation_level(
             self.module.extensions.ISOLATION_LEVEL_REPEATABLE_READ
         )
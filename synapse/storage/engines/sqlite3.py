@@ -20,6 +20,7 @@ import struct
 
 class Sqlite3Engine(object):
     single_threaded = True
+    can_native_upsert = True
 
     def __init__(self, database_module, database_config):
         self.module = database_module
@@ -127,6 +127,106 @@ class EventPushActionsStore(SQLBaseStore):
         )
         defer.returnValue(ret)
 
+    @defer.inlineCallbacks
+    def get_unread_event_push_actions_by_rooms_for_user(self, room_ids, user_id):
+        """Get the unread notification and highlight counts for a user in a
+        number of rooms at once.
+
+        Args:
+            room_ids (list[str])
+            user_id (str)
+
+        Returns:
+            Deferred[dict[str, dict]]: map from room_id to a dict with
+                `notify_count` and `highlight_count` keys, for each of the
+                rooms in which the user has a read receipt.
+        """
+        receipts = yield self.get_receipts_for_user(user_id, "m.read")
+
+        # Use the counts cached for individual rooms where we can, and fetch
+        # the rest in bulk.
+        cache = self.get_unread_event_push_actions_by_room_for_user.cache
+        results = {}
+        to_fetch = {}
+        for room_id in room_ids:
+            event_id = receipts.get(room_id)
+            if not event_id:
+                continue
+
+            counts = cache.get((room_id, user_id, event_id), None)
+            if counts is None or isinstance(counts, defer.Deferred):
+                to_fetch[room_id] = event_id
+            else:
+                results[room_id] = counts
+
+        if to_fetch:
+            sequence = cache.sequence
+            fetched = yield self.runInteraction(
+                "get_unread_event_push_actions_by_rooms",
+                self._get_unread_counts_by_rooms_txn,
+                list(to_fetch), user_id,
+            )
+            results.update(fetched)
+
+            # Only fill the cache if nothing has been invalidated in the
+            # meantime, as the receipts may have moved on.
+            if cache.sequence == sequence:
+                for room_id, counts in fetched.iteritems():
+                    cache.prefill((room_id, user_id, to_fetch[room_id]), counts)
+
+        defer.returnValue(results)
+
+    def _get_unread_counts_by_rooms_txn(self, txn, room_ids, user_id):
+        results = {
+            room_id: {"notify_count": 0, "highlight_count": 0}
+            for room_id in room_ids
+        }
+
+        # The events table gives us the position of each room's read receipt
+        receipt_join = (
+            " INNER JOIN receipts_linearized AS r"
+            " ON r.room_id = %(table)s.room_id AND r.user_id = %(table)s.user_id"
+            " AND r.receipt_type = 'm.read'"
+            " INNER JOIN events AS e"
+            " ON e.room_id = r.room_id AND e.event_id = r.event_id"
+        )
+
+        for i in range(0, len(room_ids), 100):
+            chunk = room_ids[i:i + 100]
+            args = [user_id] + chunk
+
+            # We don't need to put a notif=1 clause as all rows always have
+            # notif=1
+            sql = (
+                "SELECT ea.room_id, count(*), SUM(ea.highlight)"
+                " FROM event_push_actions AS ea"
+                + receipt_join % {"table": "ea"} +
+                " WHERE ea.user_id = ?"
+                " AND ea.room_id IN (%s)"
+                " AND (ea.topological_ordering > e.topological_ordering"
+                " OR (ea.topological_ordering = e.topological_ordering"
+                " AND ea.stream_ordering > e.stream_ordering))"
+                " GROUP BY ea.room_id"
+            ) % (",".join(["?"] * len(chunk)),)
+            txn.execute(sql, args)
+            for room_id, notify_count, highlight_count in txn:
+                results[room_id]["notify_count"] += notify_count
+                results[room_id]["highlight_count"] += highlight_count or 0
+
+            sql = (
+                "SELECT s.room_id, s.notif_count"
+                " FROM event_push_summary AS s"
+                + receipt_join % {"table": "s"} +
+                " WHERE s.user_id = ?"
+                " AND s.room_id IN (%s)"
+                " AND s.stream_ordering > e.stream_ordering"
+            ) % (",".join(["?"] * len(chunk)),)
+            txn.execute(sql, args)
+            for room_id, notif_count in txn:
+                results[room_id]["notify_count"] += notif_count
+
+        return results
+
     def _get_unread_counts_by_receipt_txn(self, txn, room_id, user_id,
                                           last_read_event_id):
         sql = (
@@ -52,6 +52,14 @@ persist_event_counter = metrics.register_counter("persisted_events")
 event_counter = metrics.register_counter(
     "persisted_events_sep", labels=["type", "origin_type", "origin_entity"]
 )
+# Time taken to persist each batch of events pulled off a room's persistence
+# queue, and the number of events in those batches.
+persist_batch_timer = metrics.register_distribution(
+    "persist_batch_time", labels=["backfilled"],
+)
+persist_batch_size = metrics.register_distribution(
+    "persist_batch_size", labels=["backfilled"],
+)
 
 
 def encode_json(json_object):
@@ -159,6 +167,19 @@ class _EventPeristenceQueue(object):
 
         preserve_fn(handle_queue_loop)()
 
+    def get_queue_lengths(self):
+        """Returns the number of events waiting to be persisted in each room
+        which currently has a non-empty queue.
+
+        Returns:
+            dict[str, int]: map from room_id to number of queued events
+        """
+        return {
+            room_id: sum(len(item.events_and_contexts) for item in queue)
+            for room_id, queue in self._event_persist_queues.iteritems()
+            if queue
+        }
+
     def _get_drainining_queue(self, room_id):
         queue = self._event_persist_queues.setdefault(room_id, deque())
 
@@ -197,6 +218,11 @@ class EventsStore(SQLBaseStore):
     EVENT_ORIGIN_SERVER_TS_NAME = "event_origin_server_ts"
     EVENT_FIELDS_SENDER_URL_UPDATE_NAME = "event_fields_sender_url"
 
+    # The number of outliers or backfilled events to persist in each
+    # transaction. This is bounded by the number of parameters SQLite allows in
+    # a query.
+    OUTLIER_PERSIST_CHUNK_SIZE = 500
+
     def __init__(self, db_conn, hs):
         super(EventsStore, self).__init__(db_conn, hs)
         self._clock = hs.get_clock()
@@ -228,8 +254,39 @@ class EventsStore(SQLBaseStore):
             psql_only=True,
         )
 
+        # an index of our own events, for get_latest_local_events_since. We
+        # don't bother on SQLite, which doesn't support partial indexes and
+        # will scan the stream_ordering range instead.
+        self.register_background_index_update(
+            "events_local_stream_ordering_index",
+            index_name="events_local_stream_ordering",
+            table="events",
+            columns=["stream_ordering"],
+            where_clause="outlier = false AND sender LIKE '%%:%s'" % (
+                hs.hostname.replace("'", "''"),
+            ),
+            psql_only=True,
+        )
+
         self._event_persist_queue = _EventPeristenceQueue()
 
+        # We don't label these by room, as the set of rooms with a backlog
+        # changes all the time.
+        metrics.register_callback(
+            "persist_queue_length",
+            lambda: sum(self._event_persist_queue.get_queue_lengths().values()),
+        )
+        metrics.register_callback(
+            "persist_queue_max_length",
+            lambda: max(
+                [0] + self._event_persist_queue.get_queue_lengths().values()
+            ),
+        )
+        metrics.register_callback(
+            "persist_queue_rooms",
+            lambda: len(self._event_persist_queue.get_queue_lengths()),
+        )
+
     def persist_events(self, events_and_contexts, backfilled=False):
         """
         Write events to the database
@@ -285,10 +342,16 @@ class EventsStore(SQLBaseStore):
     def _maybe_start_persisting(self, room_id):
         @defer.inlineCallbacks
         def persisting_queue(item):
+            start = self._clock.time_msec()
             yield self._persist_events(
                 item.events_and_contexts,
                 backfilled=item.backfilled,
             )
+            backfilled = str(bool(item.backfilled))
+            persist_batch_timer.inc_by(
+                self._clock.time_msec() - start, backfilled,
+            )
+            persist_batch_size.inc_by(len(item.events_and_contexts), backfilled)
 
         self._event_persist_queue.handle_queue(room_id, persisting_queue)
 
@@ -309,81 +372,97 @@ class EventsStore(SQLBaseStore):
         if not events_and_contexts:
             return
 
-        if backfilled:
-            stream_ordering_manager = self._backfill_id_gen.get_next_mult(
-                len(events_and_contexts)
-            )
+        # Outliers and backfilled events don't change the state or extremities
+        # of their rooms, so we can persist many more of them in each
+        # transaction. This makes a big difference when joining large rooms,
+        # and means each page of backfill is normally a single transaction.
+        all_outliers = all(
+            event.internal_metadata.is_outlier()
+            for event, _ in events_and_contexts
+        )
+        if all_outliers or backfilled:
+            chunk_size = self.OUTLIER_PERSIST_CHUNK_SIZE
         else:
-            stream_ordering_manager = self._stream_id_gen.get_next_mult(
-                len(events_and_contexts)
-            )
+            chunk_size = 100
 
-        with stream_ordering_manager as stream_orderings:
-            for (event, context), stream, in zip(
-                events_and_contexts, stream_orderings
-            ):
-                event.internal_metadata.stream_ordering = stream
+        chunks = [
+            events_and_contexts[x:x + chunk_size]
+            for x in xrange(0, len(events_and_contexts), chunk_size)
+        ]
 
-            chunks = [
-                events_and_contexts[x:x + 100]
-                for x in xrange(0, len(events_and_contexts), 100)
-            ]
+        for chunk in chunks:
+            # We can't easily parallelize these since different chunks
+            # might contain the same event. :(
+
+            # NB: Assumes that we are only persisting events for one room
+            # at a time.
+            new_forward_extremeties = {}
+            current_state_for_room = {}
+            if not backfilled and not all_outliers:
+                with Measure(self._clock, "_calculate_state_and_extrem"):
+                    # Work out the new "current state" for each room.
+                    # We do this by working out what the new extremities are and then
+                    # calculating the state from that.
+                    events_by_room = {}
+                    for event, context in chunk:
+                        events_by_room.setdefault(event.room_id, []).append(
+                            (event, context)
+                        )
 
-            for chunk in chunks:
-                # We can't easily parallelize these since different chunks
-                # might contain the same event. :(
-
-                # NB: Assumes that we are only persisting events for one room
-                # at a time.
-                new_forward_extremeties = {}
-                current_state_for_room = {}
-                if not backfilled:
-                    with Measure(self._clock, "_calculate_state_and_extrem"):
-                        # Work out the new "current state" for each room.
-                        # We do this by working out what the new extremities are and then
-                        # calculating the state from that.
-                        events_by_room = {}
-                        for event, context in chunk:
-                            events_by_room.setdefault(event.room_id, []).append(
-                                (event, context)
-                            )
+                    for room_id, ev_ctx_rm in events_by_room.iteritems():
+                        # Work out new extremities by recursively adding and removing
+                        # the new events.
+                        latest_event_ids = yield self.get_latest_event_ids_in_room(
+                            room_id
+                        )
+                        new_latest_event_ids = yield self._calculate_new_extremeties(
+                            room_id, ev_ctx_rm, latest_event_ids
+                        )
 
-                        for room_id, ev_ctx_rm in events_by_room.iteritems():
-                            # Work out new extremities by recursively adding and removing
-                            # the new events.
-                            latest_event_ids = yield self.get_latest_event_ids_in_room(
-                                room_id
-                            )
-                            new_latest_event_ids = yield self._calculate_new_extremeties(
-                                room_id, ev_ctx_rm, latest_event_ids
-                            )
+                        if new_latest_event_ids == set(latest_event_ids):
+                            # No change in extremities, so no change in state
+                            continue
+
+                        new_forward_extremeties[room_id] = new_latest_event_ids
 
-                            if new_latest_event_ids == set(latest_event_ids):
-                                # No change in extremities, so no change in state
+                        len_1 = (
+                            len(latest_event_ids) == 1
+                            and len(new_latest_event_ids) == 1
+                        )
+                        if len_1:
+                            all_single_prev_not_state = all(
+                                len(event.prev_events) == 1
+                                and not event.is_state()
+                                for event, ctx in ev_ctx_rm
+                            )
+                            # Don't bother calculating state if they're just
+                            # a long chain of single ancestor non-state events.
+                            if all_single_prev_not_state:
                                 continue
 
-                            new_forward_extremeties[room_id] = new_latest_event_ids
+                        state = yield self._calculate_state_delta(
+                            room_id, ev_ctx_rm, new_latest_event_ids
+                        )
+                        if state:
+                            current_state_for_room[room_id] = state
+
+            # We only allocate stream orderings once the (potentially slow)
+            # state calculation above has finished, and only for this chunk.
+            # Otherwise the allocated-but-unfinished ids would hold back the
+            # current token of the stream for every other room until this
+            # room's whole batch had been persisted.
+            if backfilled:
+                stream_ordering_manager = self._backfill_id_gen.get_next_mult(
+                    len(chunk)
+                )
+            else:
+                stream_ordering_manager = self._stream_id_gen.get_next_mult(
+                    len(chunk)
+                )
 
-                            len_1 = (
-                                len(latest_event_ids) == 1
-                                and len(new_latest_event_ids) == 1
-                            )
-                            if len_1:
-                                all_single_prev_not_state = all(
-                                    len(event.prev_events) == 1
-                                    and not event.is_state()
-                                    for event, ctx in ev_ctx_rm
-                                )
-                                # Don't bother calculating state if they're just
-                                # a long chain of single ancestor non-state events.
-                                if all_single_prev_not_state:
-                                    continue
-
-                            state = yield self._calculate_state_delta(
-                                room_id, ev_ctx_rm, new_latest_event_ids
-                            )
-                            if state:
-                                current_state_for_room[room_id] = state
+            with stream_ordering_manager as stream_orderings:
+                for (event, context), stream, in zip(chunk, stream_orderings):
+                    event.internal_metadata.stream_ordering = stream
 
                 yield self.runInteraction(
                     "persist_events",
@@ -684,8 +763,9 @@ class EventsStore(SQLBaseStore):
         )
 
         # _update_outliers_txn filters out any events which have already been
-        # persisted, and returns the filtered list.
-        events_and_contexts = self._update_outliers_txn(
+        # persisted, and returns the filtered list, along with the list of
+        # events whose state we need to store.
+        events_and_contexts, state_events_and_contexts = self._update_outliers_txn(
             txn,
             events_and_contexts=events_and_contexts,
         )
@@ -710,7 +790,7 @@ class EventsStore(SQLBaseStore):
 
         # Insert into the state_groups, state_groups_state, and
         # event_to_state_groups tables.
-        self._store_mult_state_groups_txn(txn, events_and_contexts)
+        self._store_mult_state_groups_txn(txn, state_events_and_contexts)
 
         # _store_rejected_events_txn filters out any events which were
         # rejected, and returns the filtered list.
@@ -728,6 +808,10 @@ class EventsStore(SQLBaseStore):
             backfilled=backfilled,
         )
 
+        # Now that the new events and their memberships have been stored we
+        # can update the summaries of the rooms whose state has changed.
+        self._update_room_summaries_txn(txn, current_state_for_room)
+
     def _update_current_state_txn(self, txn, state_delta_by_room, max_stream_order):
         for room_id, current_state_tuple in state_delta_by_room.iteritems():
                 to_delete, to_insert, _ = current_state_tuple
@@ -912,8 +996,11 @@ class EventsStore(SQLBaseStore):
                 we are persisting
 
         Returns:
-            list[(EventBase, EventContext)] new list, without events which
-            are already in the events table.
+            (list[(EventBase, EventContext)], list[(EventBase, EventContext)]):
+                new list, without events which are already in the events
+                table, and the new events and ex-outliers whose state needs
+                storing. The latter keeps the order we were given the events
+                in, as their state groups may be deltas against one another.
         """
         txn.execute(
             "SELECT event_id, outlier FROM events WHERE event_id in (%s)" % (
@@ -928,8 +1015,10 @@ class EventsStore(SQLBaseStore):
         }
 
         to_remove = set()
+        state_events_and_contexts = []
         for event, context in events_and_contexts:
             if event.event_id not in have_persisted:
+                state_events_and_contexts.append((event, context))
                 continue
 
             to_remove.add(event)
@@ -944,14 +1033,7 @@ class EventsStore(SQLBaseStore):
                 # We received a copy of an event that we had already stored as
                 # an outlier in the database. We now have some state at that
                 # so we need to update the state_groups table with that state.
-
-                # insert into the state_group, state_groups_state and
-                # event_to_state_groups tables.
-                try:
-                    self._store_mult_state_groups_txn(txn, ((event, context),))
-                except Exception:
-                    logger.exception("")
-                    raise
+                state_events_and_contexts.append((event, context))
 
                 metadata_json = encode_json(
                     event.internal_metadata.get_dict()
@@ -995,7 +1077,7 @@ class EventsStore(SQLBaseStore):
 
         return [
             ec for ec in events_and_contexts if ec[0] not in to_remove
-        ]
+        ], state_events_and_contexts
 
     @classmethod
     def _delete_existing_rows_txn(cls, txn, events_and_contexts):
@@ -2018,36 +2100,32 @@ class EventsStore(SQLBaseStore):
             )
         return self.runInteraction("get_all_new_events", get_all_new_events_txn)
 
-    def delete_old_state(self, room_id, topological_ordering):
-        return self.runInteraction(
-            "delete_old_state",
-            self._delete_old_state_txn, room_id, topological_ordering
-        )
+    def start_purge_history(self, purge_id, room_id, topological_ordering):
+        """Starts a job to purge the history of a room before the given
+        topological ordering.
 
-    def _delete_old_state_txn(self, txn, room_id, topological_ordering):
-        """Deletes old room state
-        """
+        This updates the backward extremities and min depth of the room so
+        that nothing before the cutoff will be paginated to or backfilled,
+        and records the job. The events themselves are then deleted in
+        batches by `purge_history_batch`.
 
-        # Tables that should be pruned:
-        #     event_auth
-        #     event_backward_extremities
-        #     event_content_hashes
-        #     event_destinations
-        #     event_edge_hashes
-        #     event_edges
-        #     event_forward_extremities
-        #     event_json
-        #     event_push_actions
-        #     event_reference_hashes
-        #     event_search
-        #     event_signatures
-        #     event_to_state_groups
-        #     events
-        #     rejections
-        #     room_depth
-        #     state_groups
-        #     state_groups_state
+        Args:
+            purge_id (str): unique ID for this purge job
+            room_id (str): room to purge
+            topological_ordering (int): events with a topological ordering
+                lower than this are purged
 
+        Returns:
+            Deferred[int]: the number of events to process
+        """
+        return self.runInteraction(
+            "start_purge_history",
+            self._start_purge_history_txn,
+            purge_id, room_id, topological_ordering,
+        )
+
+    def _start_purge_history_txn(self, txn, purge_id, room_id,
+                                 topological_ordering):
         # First ensure that we're not about to delete all the forward extremeties
         txn.execute(
             "SELECT e.event_id, e.depth FROM events as e "
@@ -2058,7 +2136,7 @@ class EventsStore(SQLBaseStore):
             (room_id,)
         )
         rows = txn.fetchall()
-        max_depth = max(row[0] for row in rows)
+        max_depth = max(row[1] for row in rows)
 
         if max_depth <= topological_ordering:
             # We need to ensure we don't delete all the events from the datanase
@@ -2068,26 +2146,17 @@ class EventsStore(SQLBaseStore):
                 400, "topological_ordering is greater than forward extremeties"
             )
 
-        logger.debug("[purge] looking for events to delete")
-
         txn.execute(
-            "SELECT event_id, state_key FROM events"
-            " LEFT JOIN state_events USING (room_id, event_id)"
+            "SELECT COUNT(*), MIN(stream_ordering) FROM events"
             " WHERE room_id = ? AND topological_ordering < ?",
             (room_id, topological_ordering,)
         )
-        event_rows = txn.fetchall()
+        events_total, min_stream_ordering = txn.fetchone()
 
-        to_delete = [
-            (event_id,) for event_id, state_key in event_rows
-            if state_key is None and not self.hs.is_mine_id(event_id)
-        ]
         logger.info(
-            "[purge] found %i events before cutoff, of which %i are remote"
-            " non-state events to delete", len(event_rows), len(to_delete))
-
-        for event_id, state_key in event_rows:
-            txn.call_after(self._get_state_group_for_event.invalidate, (event_id,))
+            "[purge] %s: found %i events before cutoff in %s",
+            purge_id, events_total, room_id,
+        )
 
         logger.debug("[purge] Finding new backward extremities")
 
@@ -2119,28 +2188,200 @@ class EventsStore(SQLBaseStore):
             ]
         )
 
-        logger.debug("[purge] finding redundant state groups")
+        logger.debug("[purge] updating room_depth")
+        txn.execute(
+            "UPDATE room_depth SET min_depth = ? WHERE room_id = ?",
+            (topological_ordering, room_id,)
+        )
+
+        self._simple_insert_txn(
+            txn,
+            table="purge_history",
+            values={
+                "purge_id": purge_id,
+                "room_id": room_id,
+                "topological_ordering": topological_ordering,
+                "last_stream_ordering": (
+                    min_stream_ordering - 1 if events_total else 0
+                ),
+                "events_total": events_total,
+                "events_processed": 0,
+                "status": "active" if events_total else "complete",
+                "start_ts": self._clock.time_msec(),
+            },
+        )
+
+        return events_total
+
+    def get_purge_history(self, purge_id):
+        """Get the progress of a purge job
+
+        Args:
+            purge_id (str)
+
+        Returns:
+            Deferred[dict|None]: the row from the purge_history table, or None
+                if there is no such job
+        """
+        return self._simple_select_one(
+            table="purge_history",
+            keyvalues={"purge_id": purge_id},
+            retcols=(
+                "purge_id", "room_id", "events_total", "events_processed",
+                "status", "start_ts",
+            ),
+            allow_none=True,
+            desc="get_purge_history",
+        )
+
+    def get_active_purge_history_ids(self):
+        """Get the IDs of purge jobs which have not yet finished, e.g. because
+        the server was restarted part way through.
+
+        Returns:
+            Deferred[list[str]]
+        """
+        return self._simple_select_onecol(
+            table="purge_history",
+            keyvalues={"status": "active"},
+            retcol="purge_id",
+            desc="get_active_purge_history_ids",
+        )
+
+    def set_purge_history_failed(self, purge_id):
+        return self._simple_update_one(
+            table="purge_history",
+            keyvalues={"purge_id": purge_id},
+            updatevalues={"status": "failed"},
+            desc="set_purge_history_failed",
+        )
+
+    def purge_history_batch(self, purge_id, batch_size):
+        """Purge the next batch of events for a purge job.
+
+        Args:
+            purge_id (str)
+            batch_size (int): max number of events to process
+
+        Returns:
+            Deferred[int]: the number of events processed. Zero once the job
+                has finished, at which point it is marked as complete.
+        """
+        return self.runInteraction(
+            "purge_history_batch",
+            self._purge_history_batch_txn, purge_id, batch_size,
+        )
+
+    def _purge_history_batch_txn(self, txn, purge_id, batch_size):
+        """Deletes a batch of old room events.
+
+        Remote non-state events are deleted; state events and our own events
+        are kept as outliers. State groups which are no longer referenced by
+        any event once this batch is deleted are removed, after de-delta-ing
+        any state groups which depend on them.
+        """
+
+        # Tables that should be pruned:
+        #     event_auth
+        #     event_backward_extremities
+        #     event_content_hashes
+        #     event_destinations
+        #     event_edge_hashes
+        #     event_edges
+        #     event_forward_extremities
+        #     event_json
+        #     event_push_actions
+        #     event_reference_hashes
+        #     event_search
+        #     event_signatures
+        #     event_to_state_groups
+        #     events
+        #     rejections
+        #     room_depth
+        #     state_groups
+        #     state_groups_state
+
+        job = self._simple_select_one_txn(
+            txn,
+            table="purge_history",
+            keyvalues={"purge_id": purge_id},
+            retcols=(
+                "room_id", "topological_ordering", "last_stream_ordering",
+                "events_processed", "status",
+            ),
+        )
+        if job["status"] != "active":
+            return 0
+
+        room_id = job["room_id"]
+        topological_ordering = job["topological_ordering"]
+
+        logger.debug("[purge] %s: looking for events to delete", purge_id)
 
-        # Get all state groups that are only referenced by events that are
-        # to be deleted.
         txn.execute(
-            "SELECT state_group FROM event_to_state_groups"
-            " INNER JOIN events USING (event_id)"
-            " WHERE state_group IN ("
-            "   SELECT DISTINCT state_group FROM events"
-            "   INNER JOIN event_to_state_groups USING (event_id)"
-            "   WHERE room_id = ? AND topological_ordering < ?"
-            " )"
-            " GROUP BY state_group HAVING MAX(topological_ordering) < ?",
-            (room_id, topological_ordering, topological_ordering)
+            "SELECT event_id, stream_ordering, state_key FROM events"
+            " LEFT JOIN state_events USING (room_id, event_id)"
+            " WHERE room_id = ? AND topological_ordering < ?"
+            " AND stream_ordering > ?"
+            " ORDER BY stream_ordering ASC LIMIT ?",
+            (room_id, topological_ordering, job["last_stream_ordering"], batch_size)
         )
+        event_rows = txn.fetchall()
 
-        state_rows = txn.fetchall()
-        logger.debug("[purge] found %i redundant state groups", len(state_rows))
+        if not event_rows:
+            logger.info("[purge] %s: done", purge_id)
+            self._simple_update_one_txn(
+                txn,
+                table="purge_history",
+                keyvalues={"purge_id": purge_id},
+                updatevalues={"status": "complete"},
+            )
+            return 0
+
+        to_delete = [
+            (event_id,) for event_id, _, state_key in event_rows
+            if state_key is None and not self.hs.is_mine_id(event_id)
+        ]
+        logger.info(
+            "[purge] %s: found %i events, of which %i are remote non-state"
+            " events to delete", purge_id, len(event_rows), len(to_delete))
+
+        for event_id, _, _ in event_rows:
+            txn.call_after(self._get_state_group_for_event.invalidate, (event_id,))
+
+        logger.debug("[purge] finding redundant state groups")
+
+        # Get all state groups of these events that are only referenced by
+        # events in this batch. Events from earlier batches no longer appear in
+        # event_to_state_groups, so a group that is also used by events in
+        # later batches (or after the cutoff) has an event with a higher
+        # stream ordering, and is left for the batch containing its last event.
+        max_stream_ordering = event_rows[-1][1]
+        state_rows = []
+        event_ids = [event_id for event_id, _, _ in event_rows]
+        for i in xrange(0, len(event_ids), 100):
+            chunk = event_ids[i:i + 100]
+            txn.execute(
+                "SELECT state_group FROM event_to_state_groups"
+                " INNER JOIN events USING (event_id)"
+                " WHERE state_group IN ("
+                "   SELECT DISTINCT state_group FROM event_to_state_groups"
+                "   WHERE event_id IN (%s)"
+                " )"
+                " GROUP BY state_group"
+                " HAVING MAX(topological_ordering) < ?"
+                " AND MAX(stream_ordering) <= ?" % (
+                    ",".join(["?"] * len(chunk)),
+                ),
+                chunk + [topological_ordering, max_stream_ordering]
+            )
+            state_rows.extend(txn.fetchall())
 
         # make a set of the redundant state groups, so that we can look them up
         # efficiently
         state_groups_to_delete = set([sg for sg, in state_rows])
+        state_rows = [(sg,) for sg in state_groups_to_delete]
+        logger.debug("[purge] found %i redundant state groups", len(state_rows))
 
         # Now we get all the state groups that rely on these state groups
         logger.debug("[purge] finding state groups which depend on redundant"
@@ -2220,13 +2461,7 @@ class EventsStore(SQLBaseStore):
         logger.debug("[purge] removing events from event_to_state_groups")
         txn.executemany(
             "DELETE FROM event_to_state_groups WHERE event_id = ?",
-            [(event_id,) for event_id, _ in event_rows]
-        )
-
-        logger.debug("[purge] updating room_depth")
-        txn.execute(
-            "UPDATE room_depth SET min_depth = ? WHERE room_id = ?",
-            (topological_ordering, room_id,)
+            [(event_id,) for event_id in event_ids]
         )
 
         # Delete all remote non-state events
@@ -2258,12 +2493,22 @@ class EventsStore(SQLBaseStore):
             "UPDATE events SET outlier = ?"
             " WHERE event_id = ?",
             [
-                (True, event_id,) for event_id, state_key in event_rows
+                (True, event_id,) for event_id, _, state_key in event_rows
                 if state_key is not None or self.hs.is_mine_id(event_id)
             ]
         )
 
-        logger.info("[purge] done")
+        self._simple_update_one_txn(
+            txn,
+            table="purge_history",
+            keyvalues={"purge_id": purge_id},
+            updatevalues={
+                "last_stream_ordering": max_stream_ordering,
+                "events_processed": job["events_processed"] + len(event_rows),
+            },
+        )
+
+        return len(event_rows)
 
     @defer.inlineCallbacks
     def is_event_after(self, event_id1, event_id2):
@@ -79,21 +79,21 @@ class KeyStore(SQLBaseStore):
 
     @cachedInlineCallbacks()
     def _get_server_verify_key(self, server_name, key_id):
-        verify_key_bytes = yield self._simple_select_one_onecol(
+        row = yield self._simple_select_one(
             table="server_signature_keys",
             keyvalues={
                 "server_name": server_name,
                 "key_id": key_id,
             },
-            retcol="verify_key",
+            retcols=("verify_key", "ts_valid_until_ms"),
             desc="_get_server_verify_key",
             allow_none=True,
         )
 
-        if verify_key_bytes:
-            defer.returnValue(decode_verify_key_bytes(
-                key_id, str(verify_key_bytes)
-            ))
+        if row and row["verify_key"]:
+            verify_key = decode_verify_key_bytes(key_id, str(row["verify_key"]))
+            verify_key.valid_until_ts = row["ts_valid_until_ms"]
+            defer.returnValue(verify_key)
 
     @defer.inlineCallbacks
     def get_server_verify_keys(self, server_name, key_ids):
@@ -104,7 +104,8 @@ class KeyStore(SQLBaseStore):
             key_ids (iterable[str]): key_ids to try and look up.
         Returns:
             Deferred: resolves to dict[str, VerifyKey]: map from
-               key_id to verification key.
+               key_id to verification key. Each key has a `valid_until_ts`
+               attribute, which is None if we don't know when it expires.
         """
         keys = {}
         for key_id in key_ids:
@@ -120,7 +121,9 @@ class KeyStore(SQLBaseStore):
             server_name (str): The name of the server.
             from_server (str): Where the verification key was looked up
             time_now_ms (int): The time now in milliseconds
-            verify_key (nacl.signing.VerifyKey): The NACL verify key.
+            verify_key (nacl.signing.VerifyKey): The NACL verify key. If it
+                has a `valid_until_ts` attribute, that is stored as the time
+                when the key needs to be refetched.
         """
         key_id = "%s:%s" % (verify_key.alg, verify_key.version)
 
@@ -136,11 +139,11 @@ class KeyStore(SQLBaseStore):
                     "from_server": from_server,
                     "ts_added_ms": time_now_ms,
                     "verify_key": buffer(verify_key.encode()),
+                    "ts_valid_until_ms": getattr(verify_key, "valid_until_ts", None),
                 },
             )
-            txn.call_after(
-                self._get_server_verify_key.invalidate,
-                (server_name, key_id)
+            self._invalidate_cache_and_stream(
+                txn, self._get_server_verify_key, (server_name, key_id),
             )
 
         return self.runInteraction("store_server_verify_key", _txn)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ._base import SQLBaseStore
+
+from twisted.internet import defer
+
+from synapse.util.async import sleep
+
+from collections import namedtuple
+
+import synapse.metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+metrics = synapse.metrics.get_metrics_for(__name__)
+rows_deleted_counter = metrics.register_counter("rows_deleted", labels=["table"])
+prune_timer = metrics.register_distribution("prune_time", labels=["table"])
+
+
+_PrunableTable = namedtuple("_PrunableTable", (
+    "column",  # indexed column used to find old rows
+    "is_stream_ordering",  # whether the column is an events stream ordering,
+                           # rather than a timestamp in ms
+    "extra_clause",  # extra condition on the rows to delete. Any placeholders
+                     # are bound to the cutoff.
+))
+
+PRUNABLE_TABLES = {
+    "received_transactions": _PrunableTable(
+        column="ts",
+        is_stream_ordering=False,
+        extra_clause=None,
+    ),
+    "stream_ordering_to_exterm": _PrunableTable(
+        column="stream_ordering",
+        is_stream_ordering=True,
+        # make sure we don't delete the only entries for a room.
+        extra_clause=(
+            "room_id IN ("
+            " SELECT room_id FROM stream_ordering_to_exterm"
+            " WHERE stream_ordering > ?"
+            ")"
+        ),
+    ),
+    "device_federation_inbox": _PrunableTable(
+        column="received_ts",
+        is_stream_ordering=False,
+        extra_clause=None,
+    ),
+    "device_federation_outbox": _PrunableTable(
+        column="queued_ts",
+        is_stream_ordering=False,
+        extra_clause=None,
+    ),
+    "event_push_actions": _PrunableTable(
+        column="stream_ordering",
+        is_stream_ordering=True,
+        # non-highlights get summarised and deleted by _rotate_notifs
+        extra_clause="highlight = 1",
+    ),
+    "user_ips": _PrunableTable(
+        column="last_seen",
+        is_stream_ordering=False,
+        extra_clause=None,
+    ),
+    "sync_snapshots": _PrunableTable(
+        column="ts",
+        is_stream_ordering=False,
+        extra_clause=None,
+    ),
+}
+
+
+class RetentionStore(SQLBaseStore):
+    """Periodically deletes old rows from tables that would otherwise grow
+    without bound, according to the configured retention policies.
+
+    Rows are deleted in batches of at most `retention_batch_size` rows (plus
+    any rows which share the same value of the indexed column as the last row
+    in the batch), each in its own transaction.
+    """
+
+    # How long to wait between batches, so that we don't hog the database
+    RETENTION_BATCH_INTERVAL_MS = 100
+
+    def __init__(self, db_conn, hs):
+        super(RetentionStore, self).__init__(db_conn, hs)
+
+        self._retention_policies = hs.config.retention_policies
+        self._retention_batch_size = hs.config.retention_batch_size
+        self._doing_retention = False
+
+        if self._retention_policies:
+            self._clock.looping_call(
+                self._prune_old_rows, hs.config.retention_interval_ms,
+            )
+
+    @defer.inlineCallbacks
+    def _prune_old_rows(self):
+        if self._doing_retention:
+            return
+        self._doing_retention = True
+
+        try:
+            for table, max_age in self._retention_policies.items():
+                try:
+                    yield self.prune_table(table, max_age)
+                except Exception:
+                    logger.exception("Failed to prune old rows from %s", table)
+        finally:
+            self._doing_retention = False
+
+    @defer.inlineCallbacks
+    def prune_table(self, table, max_age):
+        """Delete the rows in a table which are older than `max_age`.
+
+        Args:
+            table (str): one of the tables in PRUNABLE_TABLES
+            max_age (int): max age of the rows to keep, in ms
+
+        Returns:
+            Deferred[int]: the number of rows deleted
+        """
+        spec = PRUNABLE_TABLES[table]
+
+        cutoff = self._clock.time_msec() - max_age
+        if spec.is_stream_ordering:
+            cutoff = yield self.runInteraction(
+                "prune_table_find_stream_ordering",
+                self._find_first_stream_ordering_after_ts_txn,
+                cutoff,
+            )
+
+        logger.info("Pruning rows from %s before %s %d", table, spec.column, cutoff)
+
+        total = 0
+        while True:
+            start = self._clock.time_msec()
+            deleted, caught_up = yield self.runInteraction(
+                "prune_table",
+                self._prune_table_batch_txn,
+                table, cutoff, self._retention_batch_size,
+            )
+            prune_timer.inc_by(self._clock.time_msec() - start, table)
+            rows_deleted_counter.inc_by(deleted, table)
+            total += deleted
+
+            if caught_up:
+                break
+
+            yield sleep(self.RETENTION_BATCH_INTERVAL_MS / 1000.)
+
+        logger.info("Pruned %d rows from %s", total, table)
+        defer.returnValue(total)
+
+    def _prune_table_batch_txn(self, txn, table, cutoff, batch_size):
+        """Deletes a batch of rows whose indexed column is below `cutoff`.
+
+        Returns:
+            (int, bool): the number of rows deleted, and whether there are no
+                more rows to delete.
+        """
+        spec = PRUNABLE_TABLES[table]
+
+        clause = "%s < ?" % (spec.column,)
+        args = [cutoff]
+        if spec.extra_clause:
+            clause += " AND " + spec.extra_clause
+            args.extend([cutoff] * spec.extra_clause.count("?"))
+
+        # We find the value of the column at the end of the batch, so that we
+        # can delete by range using the index.
+        txn.execute(
+            "SELECT %(column)s FROM %(table)s WHERE %(clause)s"
+            " ORDER BY %(column)s ASC LIMIT 1 OFFSET ?" % {
+                "column": spec.column,
+                "table": table,
+                "clause": clause,
+            },
+            args + [batch_size - 1]
+        )
+        row = txn.fetchone()
+        if row:
+            clause += " AND %s <= ?" % (spec.column,)
+            args.append(row[0])
+            caught_up = False
+        else:
+            caught_up = True
+
+        txn.execute("DELETE FROM %s WHERE %s" % (table, clause), args)
+
+        return txn.rowcount, caught_up
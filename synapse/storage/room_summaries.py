@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .background_updates import BackgroundUpdateStore
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.storage.engines import PostgresEngine
+from synapse.util.caches.descriptors import cached
+
+import ujson as json
+
+
+_ROOM_SUMMARIES_UPDATE_NAME = "room_summaries"
+
+# The state events which are summarised, mapped to the column they are stored
+# in and the key of their content which is stored.
+_SUMMARY_STATE = {
+    (EventTypes.Name, ""): ("name", "name"),
+    (EventTypes.Topic, ""): ("topic", "topic"),
+    (EventTypes.CanonicalAlias, ""): ("canonical_alias", "alias"),
+    ("m.room.avatar", ""): ("avatar_url", "url"),
+    (EventTypes.JoinRules, ""): ("join_rule", "join_rule"),
+    (EventTypes.RoomHistoryVisibility, ""): (
+        "history_visibility", "history_visibility",
+    ),
+    (EventTypes.GuestAccess, ""): ("guest_access", "guest_access"),
+}
+
+_SUMMARY_COLUMNS = [column for column, _ in _SUMMARY_STATE.itervalues()] + [
+    "joined_members", "invited_members", "heroes",
+]
+
+# The number of joined or invited users to keep in each summary, so that rooms
+# without a name can be named after their members.
+MAX_HEROES = 5
+
+
+class RoomSummaryStore(BackgroundUpdateStore):
+    """Keeps a summary of the current state of each room: its name, topic and
+    so on, how many members it has, and the first few of those members.
+
+    The summaries are updated from the current state deltas as events are
+    persisted, so that they can be read without loading the room's state.
+    """
+
+    def __init__(self, db_conn, hs):
+        super(RoomSummaryStore, self).__init__(db_conn, hs)
+        # Until a room's summary has been populated, reading it means working
+        # it out from the room's current state, so we get this done before
+        # the other updates.
+        self.register_background_update_handler(
+            _ROOM_SUMMARIES_UPDATE_NAME, self._background_populate_room_summaries,
+            priority=10,
+        )
+
+    @cached(max_entries=100000)
+    def get_room_summary(self, room_id):
+        """Get the summary of the current state of a room.
+
+        Args:
+            room_id (str)
+
+        Returns:
+            Deferred[dict]: with keys `name`, `topic`, `canonical_alias`,
+                `avatar_url`, `join_rule`, `history_visibility` and
+                `guest_access`, which are None if not set in the room, the
+                number of `joined_members` and `invited_members`, and
+                `heroes`, the user IDs of the first few joined or invited
+                members.
+        """
+        return self.runInteraction(
+            "get_room_summary", self._get_room_summary_txn, room_id,
+        )
+
+    def _get_room_summary_txn(self, txn, room_id):
+        row = self._simple_select_one_txn(
+            txn,
+            table="room_summaries",
+            keyvalues={"room_id": room_id},
+            retcols=_SUMMARY_COLUMNS,
+            allow_none=True,
+        )
+
+        if row is None:
+            # The background update hasn't got to this room yet.
+            return self._compute_room_summary_txn(txn, room_id)
+
+        row["heroes"] = json.loads(row["heroes"])
+        return row
+
+    def _compute_room_summary_txn(self, txn, room_id):
+        """Works out the summary of a room from its current state.
+        """
+        summary = {column: None for column, _ in _SUMMARY_STATE.itervalues()}
+
+        sql = (
+            "SELECT c.type, json FROM current_state_events AS c"
+            " INNER JOIN event_json USING (event_id)"
+            " WHERE c.room_id = ? AND c.state_key = '' AND c.type IN (%s)"
+        ) % (",".join("?" for _ in _SUMMARY_STATE),)
+        txn.execute(sql, [room_id] + [etype for etype, _ in _SUMMARY_STATE])
+        for etype, event_json in txn:
+            column, content_key = _SUMMARY_STATE[(etype, "")]
+            summary[column] = _get_content_value(json.loads(event_json), content_key)
+
+        txn.execute(
+            "SELECT m.membership, COUNT(*) FROM current_state_events AS c"
+            " INNER JOIN room_memberships AS m USING (event_id)"
+            " WHERE c.room_id = ? AND c.type = ?"
+            " GROUP BY m.membership",
+            (room_id, EventTypes.Member),
+        )
+        counts = dict(txn)
+        summary["joined_members"] = counts.get(Membership.JOIN, 0)
+        summary["invited_members"] = counts.get(Membership.INVITE, 0)
+
+        summary["heroes"] = self._get_room_heroes_txn(txn, room_id)
+
+        return summary
+
+    def _get_room_heroes_txn(self, txn, room_id):
+        """Gets the first few users to have joined or been invited to the room
+        (by the stream ordering of their current membership event).
+        """
+        txn.execute(
+            "SELECT c.state_key FROM current_state_events AS c"
+            " INNER JOIN room_memberships AS m USING (event_id)"
+            " INNER JOIN events AS e USING (event_id)"
+            " WHERE c.room_id = ? AND c.type = ? AND m.membership IN (?, ?)"
+            " ORDER BY e.stream_ordering ASC LIMIT ?",
+            (
+                room_id, EventTypes.Member, Membership.JOIN, Membership.INVITE,
+                MAX_HEROES,
+            ),
+        )
+        return [row[0] for row in txn]
+
+    def _store_room_summary_txn(self, txn, room_id, summary, replace=True):
+        """Inserts the summary of a room, without locking the table where the
+        database supports it.
+
+        Args:
+            txn
+            room_id (str)
+            summary (dict): as returned by `_compute_room_summary_txn`
+            replace (bool): whether to overwrite an existing summary. The
+                background update doesn't, as a newer summary may have been
+                written by persisting an event since it read the room's state.
+        """
+        values = dict(summary)
+        values["heroes"] = json.dumps(summary["heroes"])
+        values["room_id"] = room_id
+
+        columns = values.keys()
+
+        if not self.database_engine.can_native_upsert:
+            # Older versions of postgres don't have INSERT ... ON CONFLICT, so
+            # we have to lock the table to avoid racing with other writers.
+            if replace:
+                del values["room_id"]
+                self._simple_upsert_txn(
+                    txn,
+                    table="room_summaries",
+                    keyvalues={"room_id": room_id},
+                    values=values,
+                )
+                return
+
+            self.database_engine.lock_table(txn, "room_summaries")
+            existing = self._simple_select_one_onecol_txn(
+                txn,
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                retcol="room_id",
+                allow_none=True,
+            )
+            if existing is None:
+                self._simple_insert_txn(txn, "room_summaries", values)
+            return
+
+        if isinstance(self.database_engine, PostgresEngine):
+            # Concurrent writes of the same row cause a serialization failure,
+            # and the transaction is retried.
+            if replace:
+                on_conflict = "UPDATE SET " + ", ".join(
+                    "%s = EXCLUDED.%s" % (col, col) for col in _SUMMARY_COLUMNS
+                )
+            else:
+                on_conflict = "NOTHING"
+            sql = (
+                "INSERT INTO room_summaries (%s) VALUES (%s)"
+                " ON CONFLICT (room_id) DO %s"
+            ) % (
+                ", ".join(columns),
+                ", ".join("?" for _ in columns),
+                on_conflict,
+            )
+        else:
+            # SQLite only allows one writer at a time, so there is nothing to
+            # race with.
+            sql = "INSERT OR %s INTO room_summaries (%s) VALUES (%s)" % (
+                "REPLACE" if replace else "IGNORE",
+                ", ".join(columns),
+                ", ".join("?" for _ in columns),
+            )
+
+        txn.execute(sql, [values[col] for col in columns])
+
+    def _update_room_summaries_txn(self, txn, state_delta_by_room):
+        """Updates the summaries of rooms whose current state has changed.
+
+        Must be called after the new events and their memberships have been
+        stored.
+
+        Args:
+            txn
+            state_delta_by_room (dict[str, tuple]): the current state delta
+                for each room, as passed to `_update_current_state_txn`.
+        """
+        for room_id, (to_delete, to_insert, _) in state_delta_by_room.iteritems():
+            changed_keys = set(to_delete)
+            changed_keys.update(to_insert)
+
+            summary_keys = [key for key in changed_keys if key in _SUMMARY_STATE]
+            member_keys = [
+                key for key in changed_keys if key[0] == EventTypes.Member
+            ]
+            if not summary_keys and not member_keys:
+                continue
+
+            # Workers invalidate their caches from the events stream.
+            txn.call_after(self.get_room_summary.invalidate, (room_id,))
+
+            row = self._simple_select_one_txn(
+                txn,
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                retcols=("heroes",),
+                allow_none=True,
+            )
+            if row is None:
+                # Either a new room, or one the background update hasn't got
+                # to yet.
+                summary = self._compute_room_summary_txn(txn, room_id)
+                self._store_room_summary_txn(txn, room_id, summary)
+                continue
+
+            values = {}
+
+            if summary_keys:
+                rows = self._simple_select_many_txn(
+                    txn,
+                    table="event_json",
+                    column="event_id",
+                    iterable=[to_insert[key] for key in summary_keys if key in to_insert],
+                    keyvalues={},
+                    retcols=("event_id", "json"),
+                )
+                event_jsons = {r["event_id"]: json.loads(r["json"]) for r in rows}
+
+                for key in summary_keys:
+                    column, content_key = _SUMMARY_STATE[key]
+                    event_json = event_jsons.get(to_insert.get(key))
+                    if event_json is None:
+                        values[column] = None
+                    else:
+                        values[column] = _get_content_value(event_json, content_key)
+
+            joined_delta = 0
+            invited_delta = 0
+
+            if member_keys:
+                event_ids = [to_delete[key] for key in member_keys if key in to_delete]
+                event_ids.extend(
+                    to_insert[key] for key in member_keys if key in to_insert
+                )
+                rows = self._simple_select_many_txn(
+                    txn,
+                    table="room_memberships",
+                    column="event_id",
+                    iterable=event_ids,
+                    keyvalues={},
+                    retcols=("event_id", "membership"),
+                )
+                memberships = {r["event_id"]: r["membership"] for r in rows}
+
+                heroes = json.loads(row["heroes"])
+                recalculate_heroes = False
+
+                for key in member_keys:
+                    old = memberships.get(to_delete.get(key))
+                    new = memberships.get(to_insert.get(key))
+
+                    joined_delta += (
+                        (new == Membership.JOIN) - (old == Membership.JOIN)
+                    )
+                    invited_delta += (
+                        (new == Membership.INVITE) - (old == Membership.INVITE)
+                    )
+
+                    user_id = key[1]
+                    if new in (Membership.JOIN, Membership.INVITE):
+                        if user_id not in heroes and len(heroes) < MAX_HEROES:
+                            heroes.append(user_id)
+                    elif user_id in heroes:
+                        recalculate_heroes = True
+
+                if recalculate_heroes:
+                    heroes = self._get_room_heroes_txn(txn, room_id)
+
+                values["heroes"] = json.dumps(heroes)
+
+            clauses = ["%s = ?" % (col,) for col in values]
+            clauses.append("joined_members = joined_members + ?")
+            clauses.append("invited_members = invited_members + ?")
+
+            txn.execute(
+                "UPDATE room_summaries SET %s WHERE room_id = ?" % (
+                    ", ".join(clauses),
+                ),
+                values.values() + [joined_delta, invited_delta, room_id],
+            )
+
+    @defer.inlineCallbacks
+    def _background_populate_room_summaries(self, progress, batch_size):
+        last_room_id = progress.get("last_room_id", "")
+
+        def populate_room_summaries_txn(txn):
+            txn.execute(
+                "SELECT room_id FROM rooms WHERE room_id > ?"
+                " ORDER BY room_id ASC LIMIT ?",
+                (last_room_id, batch_size),
+            )
+            room_ids = [row[0] for row in txn]
+
+            for room_id in room_ids:
+                summary = self._compute_room_summary_txn(txn, room_id)
+                self._store_room_summary_txn(
+                    txn, room_id, summary, replace=False,
+                )
+
+            if room_ids:
+                self._background_update_progress_txn(
+                    txn, _ROOM_SUMMARIES_UPDATE_NAME, {"last_room_id": room_ids[-1]},
+                )
+
+            return len(room_ids)
+
+        result = yield self.runInteraction(
+            _ROOM_SUMMARIES_UPDATE_NAME, populate_room_summaries_txn,
+        )
+
+        if not result:
+            yield self._end_background_update(_ROOM_SUMMARIES_UPDATE_NAME)
+
+        defer.returnValue(result)
+
+
+def _get_content_value(event_json, key):
+    """Gets a string value from the content of an event, or None if it isn't
+    there or isn't a string.
+    """
+    value = event_json.get("content", {}).get(key)
+    if isinstance(value, basestring):
+        return value
+    return None
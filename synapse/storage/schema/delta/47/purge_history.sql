@@ -0,0 +1,34 @@
+/* Copyright 2017 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Tracks purge_history jobs, which delete old events from a room in a series
+-- of small transactions so that they can be resumed after a restart.
+--
+-- Events in the room with a topological ordering lower than
+-- `topological_ordering` are processed in stream order; `last_stream_ordering`
+-- is the stream ordering of the last event that has been processed.
+CREATE TABLE purge_history (
+    purge_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    topological_ordering BIGINT NOT NULL,
+    last_stream_ordering BIGINT NOT NULL,
+    events_total BIGINT NOT NULL,
+    events_processed BIGINT NOT NULL,
+    status TEXT NOT NULL, -- one of 'active', 'complete' or 'failed'
+    start_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX purge_history_id ON purge_history(purge_id);
+CREATE INDEX purge_history_status ON purge_history(status);
@@ -0,0 +1,36 @@
+/* Copyright 2017 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- A summary of the current state of each room, which is kept up to date as
+-- the current state changes, so that it can be read without loading the
+-- room's whole state.
+CREATE TABLE room_summaries (
+    room_id TEXT NOT NULL,
+    name TEXT,
+    topic TEXT,
+    canonical_alias TEXT,
+    avatar_url TEXT,
+    join_rule TEXT,
+    history_visibility TEXT,
+    guest_access TEXT,
+    joined_members INTEGER NOT NULL,
+    invited_members INTEGER NOT NULL,
+    heroes TEXT NOT NULL -- JSON list of the first few joined or invited users
+);
+
+CREATE UNIQUE INDEX room_summaries_room_id ON room_summaries(room_id);
+
+INSERT into background_updates (update_name, progress_json)
+    VALUES ('room_summaries', '{}');
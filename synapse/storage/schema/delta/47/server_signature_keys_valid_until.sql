@@ -0,0 +1,19 @@
+/* Copyright 2017 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- When each verify key stops being valid, as given by the server which
+-- published it, so that we know when to refetch it. NULL for keys fetched
+-- with the v1 key API, which has no expiry.
+ALTER TABLE server_signature_keys ADD COLUMN ts_valid_until_ms BIGINT;
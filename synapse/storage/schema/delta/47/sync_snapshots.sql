@@ -0,0 +1,28 @@
+/* Copyright 2017 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The most recent initial sync response generated for each user and filter,
+-- which is used to answer later initial syncs. `stream_token` is the
+-- next_batch token of the response.
+CREATE TABLE sync_snapshots (
+    user_id TEXT NOT NULL,
+    filter_key TEXT NOT NULL, -- the filter ID or inline filter JSON, or ''
+    stream_token TEXT NOT NULL,
+    ts BIGINT NOT NULL, -- when the snapshot was generated
+    snapshot_json TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX sync_snapshots_user_id ON sync_snapshots(user_id, filter_key);
+CREATE INDEX sync_snapshots_ts ON sync_snapshots(ts);
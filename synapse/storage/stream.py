@@ -804,31 +804,119 @@ class StreamStore(SQLBaseStore):
             if len(rows) == limit:
                 upper_bound = rows[-1][0]
 
-            return upper_bound, [row[1] for row in rows]
+            return upper_bound, rows
 
-        upper_bound, event_ids = yield self.runInteraction(
+        upper_bound, rows = yield self.runInteraction(
             "get_all_new_events_stream", get_all_new_events_stream_txn,
         )
 
-        events = yield self._get_events(event_ids)
+        events = yield self._get_events_with_stream_orderings(rows)
 
         defer.returnValue((upper_bound, events))
 
-    def get_federation_out_pos(self, typ):
-        return self._simple_select_one_onecol(
-            table="federation_stream_position",
-            retcol="stream_id",
-            keyvalues={"type": typ},
-            desc="get_federation_out_pos"
+    @defer.inlineCallbacks
+    def get_latest_local_events_since(self, from_id):
+        """Get the most recent event sent by this server in each room which
+        has had such an event since the given stream position.
+
+        Args:
+            from_id (int): a position in the events stream
+
+        Returns:
+            Deferred[list[FrozenEvent]]
+        """
+        def get_latest_local_events_since_txn(txn):
+            sql = (
+                "SELECT stream_ordering, event_id FROM events"
+                " WHERE stream_ordering IN ("
+                " SELECT MAX(stream_ordering) FROM events"
+                " WHERE ? < stream_ordering AND outlier = ? AND sender LIKE ?"
+                " GROUP BY room_id"
+                ")"
+            )
+
+            txn.execute(sql, (from_id, False, "%:" + self.hs.hostname))
+            return txn.fetchall()
+
+        rows = yield self.runInteraction(
+            "get_latest_local_events_since", get_latest_local_events_since_txn,
+        )
+
+        events = yield self._get_events_with_stream_orderings(rows)
+
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def _get_events_with_stream_orderings(self, rows):
+        """Fetches events, and records their positions in the events stream
+        in their internal metadata.
+
+        Args:
+            rows (list[(int, str)]): stream orderings and event IDs
+
+        Returns:
+            Deferred[list[FrozenEvent]]
+        """
+        events = yield self._get_events([event_id for _, event_id in rows])
+
+        stream_orderings = {event_id: ordering for ordering, event_id in rows}
+        for event in events:
+            event.internal_metadata.stream_ordering = stream_orderings[event.event_id]
+
+        defer.returnValue(events)
+
+    def get_federation_out_pos(self, typ, instance=0):
+        """Get how far a federation sender has got through a stream.
+
+        Args:
+            typ (str): "events" or "federation"
+            instance (int): which federation sender. If it hasn't stored a
+                position yet, the position of the first sender is returned,
+                or if there isn't one either, the current position of the
+                stream.
+
+        Returns:
+            Deferred[int]
+        """
+        if typ == "events":
+            current_token = self.get_room_max_stream_ordering()
+        else:
+            current_token = -1
+
+        def get_federation_out_pos_txn(txn):
+            txn.execute(
+                "SELECT type, stream_id FROM federation_stream_position"
+                " WHERE type IN (?, ?)",
+                (typ, get_federation_pos_type(typ, instance)),
+            )
+            positions = dict(txn)
+            return positions.get(
+                get_federation_pos_type(typ, instance),
+                positions.get(typ, current_token),
+            )
+
+        return self.runInteraction(
+            "get_federation_out_pos", get_federation_out_pos_txn,
         )
 
-    def update_federation_out_pos(self, typ, stream_id):
-        return self._simple_update_one(
+    def update_federation_out_pos(self, typ, stream_id, instance=0):
+        return self._simple_upsert(
             table="federation_stream_position",
-            keyvalues={"type": typ},
-            updatevalues={"stream_id": stream_id},
+            keyvalues={"type": get_federation_pos_type(typ, instance)},
+            values={"stream_id": stream_id},
             desc="update_federation_out_pos",
+            lock=False,
         )
 
     def has_room_changed_since(self, room_id, stream_id):
         return self._events_stream_cache.has_entity_changed(room_id, stream_id)
+
+
+def get_federation_pos_type(typ, instance):
+    """The type under which a federation sender's position in a stream is
+    stored in federation_stream_position. The first sender uses the plain
+    stream name, so that its position carries over from an unsharded setup.
+    """
+    if instance == 0:
+        return typ
+    return "%s_%d" % (typ, instance)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ._base import SQLBaseStore
+
+from twisted.internet import defer
+
+import ujson as json
+
+
+class SyncSnapshotStore(SQLBaseStore):
+    """Stores a snapshot of the most recent initial sync response for each
+    user and filter, so that later initial syncs can be answered without
+    generating the whole response again.
+    """
+
+    @defer.inlineCallbacks
+    def get_sync_snapshot(self, user_id, filter_key):
+        """Get the stored sync snapshot for a user
+
+        Args:
+            user_id (str)
+            filter_key (str): the filter ID or inline filter JSON the sync was
+                made with, or '' for the default filter.
+
+        Returns:
+            Deferred[dict|None]: None if there is no snapshot, otherwise a
+                dict with the `stream_token` of the snapshot, when it was
+                generated (`ts`) and the `snapshot` itself.
+        """
+        row = yield self._simple_select_one(
+            table="sync_snapshots",
+            keyvalues={
+                "user_id": user_id,
+                "filter_key": filter_key,
+            },
+            retcols=("stream_token", "ts", "snapshot_json"),
+            allow_none=True,
+            desc="get_sync_snapshot",
+        )
+
+        if row is None:
+            defer.returnValue(None)
+
+        defer.returnValue({
+            "stream_token": row["stream_token"],
+            "ts": row["ts"],
+            "snapshot": json.loads(row["snapshot_json"]),
+        })
+
+    def store_sync_snapshot(self, user_id, filter_key, stream_token,
+                            snapshot_json):
+        """Replace the stored sync snapshot for a user
+
+        Args:
+            user_id (str)
+            filter_key (str): see get_sync_snapshot
+            stream_token (str): the next_batch token of the snapshot
+            snapshot_json (str): the JSON encoded sync response
+        """
+        return self._simple_upsert(
+            table="sync_snapshots",
+            keyvalues={
+                "user_id": user_id,
+                "filter_key": filter_key,
+            },
+            values={
+                "stream_token": stream_token,
+                "ts": self._clock.time_msec(),
+                "snapshot_json": snapshot_json,
+            },
+            desc="store_sync_snapshot",
+        )
@@ -46,11 +46,6 @@ class TransactionStore(SQLBaseStore):
     """A collection of queries for handling PDUs.
     """
 
-    def __init__(self, db_conn, hs):
-        super(TransactionStore, self).__init__(db_conn, hs)
-
-        self._clock.looping_call(self._cleanup_transactions, 30 * 60 * 1000)
-
     def get_received_txn_response(self, transaction_id, origin):
         """For an incoming transaction from a given origin, check if we have
         already responded to it. If so, return the response code and response
@@ -242,6 +237,44 @@ class TransactionStore(SQLBaseStore):
                 },
             )
 
+    def get_destination_last_sent_stream_ordering(self, destination):
+        """Gets the position in the events stream up to which we have sent a
+        destination all the events it should have, or None if we haven't sent
+        it any.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]
+        """
+        return self._simple_select_one_onecol(
+            table="destination_stream_positions",
+            keyvalues={"destination": destination},
+            retcol="stream_ordering",
+            allow_none=True,
+            desc="get_destination_last_sent_stream_ordering",
+        )
+
+    def set_destination_last_sent_stream_ordering(self, destination,
+                                                  stream_ordering):
+        """Records that a destination has been sent all the events it should
+        have up to the given position in the events stream.
+
+        Args:
+            destination (str)
+            stream_ordering (int)
+        """
+        # Only the federation sender for the destination writes its row, so
+        # we don't need to lock the table.
+        return self._simple_upsert(
+            table="destination_stream_positions",
+            keyvalues={"destination": destination},
+            values={"stream_ordering": stream_ordering},
+            desc="set_destination_last_sent_stream_ordering",
+            lock=False,
+        )
+
     def get_destinations_needing_retry(self):
         """Get all destinations which are due a retry for sending a transaction.
 
@@ -262,12 +295,3 @@ class TransactionStore(SQLBaseStore):
 
         txn.execute(query, (self._clock.time_msec(),))
         return self.cursor_to_dict(txn)
-
-    def _cleanup_transactions(self):
-        now = self._clock.time_msec()
-        month_ago = now - 30 * 24 * 60 * 60 * 1000
-
-        def _cleanup_transactions_txn(txn):
-            txn.execute("DELETE FROM received_transactions WHERE ts < ?", (month_ago,))
-
-        return self.runInteraction("_cleanup_transactions", _cleanup_transactions_txn)
@@ -22,6 +22,10 @@ class ResponseCache(object):
     returned from the cache. This means that if the client retries the request
     while the response is still being computed, that original response will be
     used rather than trying to compute a new response.
+
+    Successful responses are then kept for `timeout_ms`. Failures are dropped
+    straight away, so that the next request tries again rather than getting
+    the same error.
     """
 
     def __init__(self, hs, timeout_ms=0):
@@ -42,7 +46,7 @@ class ResponseCache(object):
         self.pending_result_cache[key] = result
 
         def remove(r):
-            if self.timeout_sec:
+            if self.timeout_sec and result.has_succeeded():
                 self.clock.call_later(
                     self.timeout_sec,
                     self.pending_result_cache.pop, key, None,
@@ -97,7 +97,8 @@ class RetryDestinationLimiter(object):
     def __init__(self, destination, clock, store, retry_interval,
                  min_retry_interval=10 * 60 * 1000,
                  max_retry_interval=24 * 60 * 60 * 1000,
-                 multiplier_retry_interval=5, backoff_on_404=False):
+                 multiplier_retry_interval=5, backoff_on_404=False,
+                 backoff_on_429=True):
         """Marks the destination as "down" if an exception is thrown in the
         context, except for CodeMessageException with code < 500.
 
@@ -117,6 +118,8 @@ class RetryDestinationLimiter(object):
             multiplier_retry_interval (int): The multiplier to use to increase
                 the retry interval after a failed request.
             backoff_on_404 (bool): Back off if we get a 404
+            backoff_on_429 (bool): Back off if we get a 429. Callers which
+                handle being rate limited themselves can turn this off.
         """
         self.clock = clock
         self.store = store
@@ -127,6 +130,7 @@ class RetryDestinationLimiter(object):
         self.max_retry_interval = max_retry_interval
         self.multiplier_retry_interval = multiplier_retry_interval
         self.backoff_on_404 = backoff_on_404
+        self.backoff_on_429 = backoff_on_429
 
     def __enter__(self):
         pass
@@ -150,6 +154,8 @@ class RetryDestinationLimiter(object):
             # ourselves.
             if exc_val.code == 404 and self.backoff_on_404:
                 valid_err_code = False
+            elif exc_val.code == 429 and not self.backoff_on_429:
+                valid_err_code = True
             elif exc_val.code in (401, 429):
                 valid_err_code = False
             elif exc_val.code < 500:
@@ -227,3 +227,75 @@ class KeyringTestCase(unittest.TestCase):
             yield defer
 
             self.assertIs(LoggingContext.current_context(), context_one)
+
+    @defer.inlineCallbacks
+    def test_verify_signed_json_on_threadpool(self):
+        self.hs.config.signature_verification_threads = 2
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        verify_key = signedjson.key.get_verify_key(key1)
+
+        deferreds = []
+        for i in range(5):
+            json_object = {"i": i}
+            signedjson.sign.sign_json(json_object, "server9", key1)
+            if i == 3:
+                json_object["i"] = 10
+            deferreds.append(
+                kr._verify_signed_json("server9", json_object, verify_key)
+            )
+
+        self.assertEquals(len(kr._pending_verifications), 5)
+        kr._start_pending_verifications()
+        self.addCleanup(kr._verify_threadpool.stop)
+
+        results = yield defer.DeferredList(deferreds, consumeErrors=True)
+        self.assertEquals(
+            [success for success, _ in results],
+            [True, True, True, False, True],
+        )
+
+    @defer.inlineCallbacks
+    def test_key_fetch_backoff(self):
+        kr = keyring.Keyring(self.hs)
+        kr.get_keys_from_perspectives = Mock(side_effect=lambda _: defer.succeed({}))
+        kr.get_keys_from_server = Mock(side_effect=lambda _: defer.succeed({}))
+
+        key1 = signedjson.key.generate_signing_key(1)
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server12", key1)
+
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server12", json1)
+        self.assertEquals(kr.get_keys_from_server.call_count, 1)
+
+        # we don't ask again straight away...
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server12", json1)
+        self.assertEquals(kr.get_keys_from_server.call_count, 1)
+
+        # ... but do once the backoff has passed
+        self.hs.get_clock().advance_time_msec(kr.MIN_KEY_FETCH_RETRY_INTERVAL_MS)
+        with self.assertRaises(SynapseError):
+            yield kr.verify_json_for_server("server12", json1)
+        self.assertEquals(kr.get_keys_from_server.call_count, 2)
+
+    @defer.inlineCallbacks
+    def test_expired_key_is_refetched(self):
+        kr = keyring.Keyring(self.hs)
+        kr.get_keys_from_perspectives = Mock(side_effect=lambda _: defer.succeed({}))
+        kr.get_keys_from_server = Mock(side_effect=lambda _: defer.succeed({}))
+
+        key1 = signedjson.key.generate_signing_key(1)
+        verify_key = signedjson.key.get_verify_key(key1)
+        verify_key.valid_until_ts = self.hs.get_clock().time_msec() - 1
+        yield self.hs.datastore.store_server_verify_key(
+            "server13", "", time.time() * 1000, verify_key,
+        )
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server13", key1)
+
+        # we try to fetch the key again, but fall back to the expired one
+        yield kr.verify_json_for_server("server13", json1)
+        self.assertEquals(kr.get_keys_from_server.call_count, 1)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.errors import SynapseError
+from synapse.federation.replication import ReplicationLayer
+from synapse.util.async import Limiter, run_on_reactor
+
+from tests import unittest
+from tests.utils import MockClock
+
+
+def make_pdu(event_id, room_id):
+    return {
+        "event_id": event_id,
+        "room_id": room_id,
+        "type": "m.room.message",
+        "sender": "@user:remote",
+        "origin": "remote",
+        "content": {},
+    }
+
+
+class IncomingTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seen_event_ids = set()
+
+        self.store = Mock()
+        self.store.get_received_txn_response.return_value = defer.succeed(None)
+        self.store.set_received_txn_response.return_value = defer.succeed(None)
+        self.store.have_events_in_timeline.side_effect = lambda event_ids: (
+            defer.succeed(self.seen_event_ids.intersection(event_ids))
+        )
+
+        hs = Mock()
+        hs.hostname = "test"
+        hs.get_datastore.return_value = self.store
+        hs.get_clock.return_value = MockClock()
+        hs.config.federation_inbound_room_concurrency = 10
+        hs.config.federation_inbound_transactions_per_room = 1
+        hs.config.federation_inbound_max_transactions_per_origin = 1
+
+        self.server = ReplicationLayer(hs, Mock())
+
+        self.received = []
+        self.pending = {}
+
+        def handle_received_pdu(origin, pdu):
+            self.received.append(pdu.event_id)
+            self.pending[pdu.event_id] = defer.Deferred()
+            return self.pending[pdu.event_id]
+
+        self.server._handle_received_pdu = handle_received_pdu
+
+    def send(self, txn_id, pdus, origin="remote"):
+        return self.server.on_incoming_transaction({
+            "transaction_id": txn_id,
+            "origin": origin,
+            "destination": "test",
+            "origin_server_ts": 0,
+            "pdus": pdus,
+        })
+
+    def test_retried_transaction(self):
+        d1 = self.send("1", [make_pdu("$a:remote", "!room:remote")])
+        d2 = self.send("1", [make_pdu("$a:remote", "!room:remote")])
+        self.assertEquals(self.received, ["$a:remote"])
+
+        self.pending["$a:remote"].callback(None)
+        self.assertEquals(
+            self.successResultOf(d1), (200, {"pdus": {"$a:remote": {}}}),
+        )
+        self.assertEquals(
+            self.successResultOf(d2), (200, {"pdus": {"$a:remote": {}}}),
+        )
+
+    def test_too_many_transactions(self):
+        d1 = self.send("1", [make_pdu("$a:remote", "!room:remote")])
+        d2 = self.send("2", [make_pdu("$b:remote", "!room:remote")])
+        self.assertEquals(self.failureResultOf(d2, SynapseError).value.code, 429)
+
+        # other servers aren't affected
+        self.send("3", [make_pdu("$c:other", "!room2:remote")], origin="other")
+        self.assertEquals(self.received, ["$a:remote", "$c:other"])
+
+        self.pending["$a:remote"].callback(None)
+        self.successResultOf(d1)
+
+    def test_already_seen_pdus(self):
+        self.seen_event_ids.add("$a:remote")
+
+        d = self.send("1", [
+            make_pdu("$a:remote", "!room:remote"),
+            make_pdu("$b:remote", "!room:remote"),
+        ])
+        self.assertEquals(self.received, ["$b:remote"])
+
+        self.pending["$b:remote"].callback(None)
+        self.assertEquals(
+            self.successResultOf(d),
+            (200, {"pdus": {"$a:remote": {}, "$b:remote": {}}}),
+        )
+
+    def test_no_room_concurrency_limit(self):
+        self.server._room_concurrency = 0
+
+        d = self.send("1", [
+            make_pdu("$a:remote", "!room:remote"),
+            make_pdu("$b:remote", "!room2:remote"),
+            make_pdu("$c:remote", "!room3:remote"),
+        ])
+        self.assertEquals(
+            sorted(self.received), ["$a:remote", "$b:remote", "$c:remote"],
+        )
+
+        for pending in self.pending.values():
+            pending.callback(None)
+        self.assertEquals(
+            self.successResultOf(d),
+            (200, {"pdus": {"$a:remote": {}, "$b:remote": {}, "$c:remote": {}}}),
+        )
+        self.assertEquals(self.server._pending_pdus, 0)
+
+    @defer.inlineCallbacks
+    def test_rooms_processed_in_order(self):
+        self.server._max_transactions_per_origin = 0
+
+        self.send("1", [make_pdu("$a:remote", "!room:remote")])
+        self.send("2", [
+            make_pdu("$b:remote", "!room:remote"),
+            make_pdu("$c:remote", "!room2:remote"),
+        ])
+        # $b waits for $a, as they are in the same room
+        self.assertEquals(self.received, ["$a:remote", "$c:remote"])
+
+        self.pending["$a:remote"].callback(None)
+        yield run_on_reactor()
+        self.assertEquals(self.received, ["$a:remote", "$c:remote", "$b:remote"])
+
+    def test_room_transaction_concurrency(self):
+        self.server._max_transactions_per_origin = 0
+        self.server._room_pdu_limiter = Limiter(2)
+
+        self.send("1", [make_pdu("$a:remote", "!room:remote")])
+        self.send("2", [make_pdu("$b:remote", "!room:remote")])
+        self.send("3", [make_pdu("$c:remote", "!room:remote")])
+
+        # a slow PDU for a room doesn't hold up the next transaction's
+        self.assertEquals(self.received, ["$a:remote", "$b:remote"])
+
+        self.pending["$b:remote"].callback(None)
+        self.assertEquals(self.received, ["$a:remote", "$b:remote", "$c:remote"])
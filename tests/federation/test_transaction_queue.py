@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from mock import Mock, patch
+
+from synapse.api.errors import HttpResponseException
+from synapse.events import FrozenEvent
+from synapse.federation.transaction_queue import (
+    TransactionQueue, get_destination_shard,
+)
+
+from tests import unittest
+from tests.utils import MockClock
+
+import json
+
+
+class NotifyNewEventsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.out_pos = 0
+
+        self.store = Mock()
+        self.store.get_federation_out_pos.side_effect = (
+            lambda typ, instance: defer.succeed(self.out_pos)
+        )
+        self.store.update_federation_out_pos.side_effect = self._update_out_pos
+        self.store.get_all_new_events_stream.side_effect = self._get_events
+
+        self.state = Mock()
+        self.state.get_current_hosts_in_room.side_effect = (
+            lambda room_id, latest_event_ids: defer.succeed(
+                ["remote1", "remote2", "test"]
+            )
+        )
+
+        hs = Mock()
+        hs.hostname = "test"
+        hs.get_datastore.return_value = self.store
+        hs.get_state_handler.return_value = self.state
+        hs.get_clock.return_value = MockClock()
+        hs.config.federation_sender_instances = 1
+        hs.config.worker_federation_sender_instance = 0
+        hs.is_mine_id = lambda string: string.split(":", 1)[1] == "test"
+
+        self.queue = TransactionQueue(hs)
+        self.queue.EVENTS_PAGE_SIZE = 3
+        self.queue._send_pdu = Mock()
+
+    def _update_out_pos(self, typ, stream_id, instance):
+        self.out_pos = stream_id
+        return defer.succeed(None)
+
+    def _get_events(self, from_id, current_id, limit):
+        rows = [
+            (pos, event) for pos, event in self.events
+            if from_id < pos <= current_id
+        ][:limit]
+        upper_bound = current_id
+        if len(rows) == limit:
+            upper_bound = rows[-1][0]
+        return defer.succeed((upper_bound, [event for _, event in rows]))
+
+    def _add_event(self, event_id, room_id, prev_event_ids):
+        event = FrozenEvent({
+            "event_id": event_id,
+            "room_id": room_id,
+            "type": "m.room.message",
+            "sender": "@user:test",
+            "content": {},
+            "prev_events": [(prev_id, {}) for prev_id in prev_event_ids],
+        })
+        self.events.append((len(self.events) + 1, event))
+
+    @defer.inlineCallbacks
+    def test_send_events_in_pages(self):
+        self._add_event("$1:test", "!a:test", ["$0:test"])
+        self._add_event("$2:test", "!b:test", ["$0:test"])
+        self._add_event("$3:test", "!a:test", ["$0:test"])
+        self._add_event("$4:remote1", "!a:test", ["$0:test"])
+        self._add_event("$5:test", "!a:test", ["$4:remote1"])
+
+        yield self.queue.notify_new_events(5)
+
+        # all the events from this server are sent, in order, to the other
+        # servers in the room
+        sent = [c[0][0].event_id for c in self.queue._send_pdu.call_args_list]
+        self.assertEquals(sent, ["$1:test", "$2:test", "$3:test", "$5:test"])
+        for c in self.queue._send_pdu.call_args_list:
+            self.assertEquals(c[0][1], set(["remote1", "remote2", "test"]))
+
+        # the hosts are looked up once for each room and prev events in a
+        # page
+        self.assertEquals(self.state.get_current_hosts_in_room.call_count, 3)
+
+        self.assertEquals(self.out_pos, 5)
+        self.assertEquals(self.queue._federation_out_pos, 5)
+
+    def test_host_lookups_bounded(self):
+        self.queue.HOSTS_LOOKUP_CONCURRENCY = 2
+        lookups = []
+
+        def get_current_hosts_in_room(room_id, latest_event_ids):
+            d = defer.Deferred()
+            lookups.append(d)
+            return d
+        self.state.get_current_hosts_in_room.side_effect = get_current_hosts_in_room
+
+        events = [
+            FrozenEvent({
+                "event_id": "$%d:test" % (i,),
+                "room_id": "!%d:test" % (i,),
+                "type": "m.room.message",
+                "sender": "@user:test",
+                "content": {},
+                "prev_events": [],
+            })
+            for i in range(5)
+        ]
+        d = self.queue._send_events(events)
+        self.assertEquals(len(lookups), 2)
+
+        while not d.called:
+            pending = [l for l in lookups if not l.called]
+            self.assertTrue(len(pending) <= 2)
+            pending[0].callback(["remote1"])
+
+        self.assertEquals(len(lookups), 5)
+        self.assertEquals(self.queue._send_pdu.call_count, 5)
+
+
+class DestinationShardTestCase(unittest.TestCase):
+    def test_shards(self):
+        destinations = ["server%d.example.com" % (i,) for i in range(1000)]
+
+        for shard_count in (1, 2, 5):
+            shards = [get_destination_shard(d, shard_count) for d in destinations]
+            self.assertEquals(set(shards), set(range(shard_count)))
+
+        # adding a shard only moves destinations to the new shard
+        for d in destinations:
+            old = get_destination_shard(d, 4)
+            new = get_destination_shard(d, 5)
+            self.assertIn(new, (old, 4))
+
+    def test_can_send_to(self):
+        queues = []
+        for shard in range(3):
+            hs = Mock()
+            hs.hostname = "test"
+            hs.get_clock.return_value = MockClock()
+            hs.config.federation_sender_instances = 3
+            hs.config.worker_federation_sender_instance = shard
+            queues.append(TransactionQueue(hs))
+
+        # each destination is sent to by exactly one of the senders
+        for i in range(20):
+            destination = "server%d.example.com" % (i,)
+            self.assertEquals(
+                sum(q.can_send_to(destination) for q in queues), 1,
+            )
+
+
+class TransactionBatchingTestCase(unittest.TestCase):
+    def setUp(self):
+        hs = Mock()
+        hs.hostname = "test"
+        hs.get_clock.return_value = MockClock()
+        hs.config.federation_sender_instances = 1
+        hs.config.worker_federation_sender_instance = 0
+
+        self.queue = TransactionQueue(hs)
+        # don't actually start any transactions
+        self.queue._attempt_new_transaction = Mock()
+
+    def _queue_pdus(self, count):
+        for i in range(count):
+            self.queue._send_pdu(
+                Mock(event_id="$%d:test" % (i,)), ["remote"],
+            )
+
+    def _queue_typing(self, count, typing=True):
+        for i in range(count):
+            self.queue.send_edu(
+                "remote", "m.typing", {"user_id": "@u%d:test" % (i,), "typing": typing},
+                key=("!room:test", "@u%d:test" % (i,)),
+            )
+
+    def test_pdus_first(self):
+        self.queue._transaction_size_by_dest["remote"] = 60
+        self._queue_typing(30)
+        self._queue_pdus(55)
+
+        pdus, edus, presence, failures = (
+            self.queue._pop_pending_for_transaction("remote")
+        )
+        self.assertEquals(len(pdus), 50)
+        self.assertEquals(len(edus), 10)
+
+        # the rest of the PDUs are left, and newer typing notifications
+        # replace the queued ones
+        self._queue_typing(30, typing=False)
+        self.assertEquals(self.queue._get_queue_depth("remote"), 5 + 30)
+
+        pdus, edus, presence, failures = (
+            self.queue._pop_pending_for_transaction("remote")
+        )
+        self.assertEquals(len(pdus), 5)
+        self.assertEquals(len(edus), 30)
+        self.assertFalse(any(edu.content["typing"] for edu in edus))
+        self.assertNotIn("remote", self.queue._queued_since_by_dest)
+
+    def test_adapt_transaction_size(self):
+        max_size = TransactionQueue.MAX_TRANSACTION_SIZE
+
+        self.queue._update_transaction_size("remote", 10000, True)
+        self.assertEquals(
+            self.queue._transaction_size_by_dest["remote"], max_size // 2,
+        )
+
+        self.queue._update_transaction_size("remote", 100, False)
+        self.assertEquals(
+            self.queue._transaction_size_by_dest["remote"], max_size // 4,
+        )
+
+        for _ in range(20):
+            self.queue._update_transaction_size("remote", 100, True)
+        self.assertNotIn("remote", self.queue._transaction_size_by_dest)
+
+
+class CatchUpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = Mock()
+        self.state = Mock()
+        self.state.get_current_hosts_in_room.side_effect = (
+            lambda room_id: defer.succeed(
+                ["remote"] if room_id == "!shared:test" else ["other"]
+            )
+        )
+
+        hs = Mock()
+        hs.hostname = "test"
+        hs.get_datastore.return_value = self.store
+        hs.get_state_handler.return_value = self.state
+        hs.get_clock.return_value = MockClock()
+        hs.config.federation_sender_instances = 1
+        hs.config.worker_federation_sender_instance = 0
+
+        self.queue = TransactionQueue(hs)
+        self.queue._attempt_new_transaction = Mock()
+
+    def _event(self, event_id, room_id, stream_ordering):
+        event = Mock(event_id=event_id, room_id=room_id)
+        event.internal_metadata.stream_ordering = stream_ordering
+        return event
+
+    @defer.inlineCallbacks
+    def test_catch_up(self):
+        self.queue._send_pdu(self._event("$1:test", "!shared:test", 10), ["remote"])
+        self.queue._send_pdu(self._event("$2:test", "!shared:test", 11), ["remote"])
+
+        # we fail to send the first, and drop the second
+        failed = self.queue.pending_pdus_by_dest["remote"][:1]
+        self.queue.pending_pdus_by_dest["remote"] = (
+            self.queue.pending_pdus_by_dest["remote"][1:]
+        )
+        self.queue._start_catch_up("remote", failed)
+        self.assertNotIn("remote", self.queue.pending_pdus_by_dest)
+        self.assertEquals(self.queue._catching_up_by_dest, {"remote": 9})
+
+        # new PDUs aren't queued while the destination is unreachable
+        self.queue._send_pdu(self._event("$3:test", "!shared:test", 12), ["remote"])
+        self.assertNotIn("remote", self.queue.pending_pdus_by_dest)
+        self.assertTrue(self.queue._attempt_new_transaction.called)
+
+        self.store.get_destination_last_sent_stream_ordering.return_value = (
+            defer.succeed(None)
+        )
+        self.store.get_latest_local_events_since.return_value = defer.succeed([
+            self._event("$4:test", "!other:test", 13),
+            self._event("$3:test", "!shared:test", 12),
+        ])
+        yield self.queue._queue_catch_up_pdus("remote")
+
+        self.store.get_latest_local_events_since.assert_called_once_with(9)
+        self.assertEquals(
+            [p.event_id for p, _ in self.queue.pending_pdus_by_dest["remote"]],
+            ["$3:test"],
+        )
+        self.assertNotIn("remote", self.queue._catching_up_by_dest)
+
+    @defer.inlineCallbacks
+    def test_catch_up_after_rejected_transaction(self):
+        self.queue._send_pdu(self._event("$1:test", "!shared:test", 10), ["remote"])
+
+        self.queue._get_new_device_messages = Mock(
+            return_value=defer.succeed(([], 0, 0)),
+        )
+        self.queue._send_new_transaction = Mock(return_value=defer.succeed(False))
+
+        with patch(
+            "synapse.federation.transaction_queue.get_retry_limiter",
+            return_value=defer.succeed(None),
+        ):
+            yield self.queue._transaction_transmission_loop("remote")
+
+        self.assertEquals(self.queue._send_new_transaction.call_count, 1)
+        self.assertNotIn("remote", self.queue.pending_pdus_by_dest)
+        self.assertEquals(self.queue._catching_up_by_dest, {"remote": 9})
+
+    def test_catch_up_without_dropped_pdus(self):
+        # nothing was queued when we failed, so we catch up from the first
+        # PDU we drop
+        self.queue._start_catch_up("remote", [])
+        self.assertEquals(self.queue._catching_up_by_dest, {"remote": None})
+
+        self.queue._send_pdu(self._event("$1:test", "!shared:test", 10), ["remote"])
+        self.queue._send_pdu(self._event("$2:test", "!shared:test", 11), ["remote"])
+        self.assertEquals(self.queue._catching_up_by_dest, {"remote": 9})
+
+        # or from where we've got to in the events stream, if we know
+        self.queue._catching_up_by_dest = {}
+        self.queue._federation_out_pos = 20
+        self.queue._start_catch_up("remote", [])
+        self.assertEquals(self.queue._catching_up_by_dest, {"remote": 20})
+
+    @defer.inlineCallbacks
+    def test_rate_limited(self):
+        self.queue._send_pdu(self._event("$1:test", "!shared:test", 10), ["remote"])
+        self.queue._attempt_new_transaction.reset_mock()
+
+        self.queue._get_new_device_messages = Mock(
+            return_value=defer.succeed(([], 0, 0)),
+        )
+        self.queue._send_new_transaction = Mock(
+            side_effect=HttpResponseException(
+                429, "Too Many Requests", json.dumps({"retry_after_ms": 2000}),
+            ),
+        )
+
+        with patch(
+            "synapse.federation.transaction_queue.get_retry_limiter",
+            return_value=defer.succeed(None),
+        ):
+            yield self.queue._transaction_transmission_loop("remote")
+
+        # the PDU stays queued, and we try again when we've been told to
+        self.assertEquals(
+            [p.event_id for p, _ in self.queue.pending_pdus_by_dest["remote"]],
+            ["$1:test"],
+        )
+        self.assertNotIn("remote", self.queue._catching_up_by_dest)
+
+        self.queue.clock.advance_time_msec(1000)
+        self.assertFalse(self.queue._attempt_new_transaction.called)
+        self.queue.clock.advance_time_msec(1000)
+        self.queue._attempt_new_transaction.assert_called_once_with("remote")
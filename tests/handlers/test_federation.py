@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.events import FrozenEvent
+from synapse.events.snapshot import EventContext
+from synapse.handlers.federation import _sorted_by_auth_events
+from synapse.util.logcontext import LoggingContext
+
+from tests import unittest
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+def make_event(event_id, auth_event_ids):
+    return FrozenEvent({
+        "event_id": event_id,
+        "room_id": "!room:test",
+        "type": "m.room.member",
+        "state_key": "@user:test",
+        "sender": "@user:test",
+        "content": {},
+        "auth_events": [(e_id, {}) for e_id in auth_event_ids],
+    })
+
+
+class SortedByAuthEventsTestCase(unittest.TestCase):
+    def test_sorted_by_auth_events(self):
+        events = [
+            make_event("$d:test", ["$a:test", "$c:test"]),
+            make_event("$c:test", ["$a:test", "$b:test"]),
+            make_event("$b:test", ["$a:test", "$missing:test"]),
+            make_event("$a:test", []),
+            make_event("$e:test", []),
+        ]
+
+        ordered = [e.event_id for e in _sorted_by_auth_events(events)]
+        self.assertEquals(
+            ordered, ["$a:test", "$e:test", "$b:test", "$c:test", "$d:test"],
+        )
+
+    def test_cycle(self):
+        events = [
+            make_event("$a:test", ["$b:test"]),
+            make_event("$b:test", ["$a:test"]),
+            make_event("$c:test", []),
+        ]
+
+        ordered = [e.event_id for e in _sorted_by_auth_events(events)]
+        self.assertEquals(ordered, ["$c:test", "$a:test", "$b:test"])
+
+
+def make_context(state_group, state_ids):
+    context = EventContext()
+    context.state_group = state_group
+    context.prev_state_ids = state_ids
+    context.current_state_ids = state_ids
+    return context
+
+
+def make_timeline_event(event_id, prev_event_ids, state_key=None):
+    event_dict = {
+        "event_id": event_id,
+        "room_id": "!room:test",
+        "type": "m.room.message",
+        "sender": "@user:test",
+        "content": {},
+        "prev_events": [(e_id, {}) for e_id in prev_event_ids],
+    }
+    if state_key is not None:
+        event_dict["type"] = "m.room.member"
+        event_dict["state_key"] = state_key
+    return FrozenEvent(event_dict)
+
+
+class ComputeContextFromPrevContextsTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            http_client=None,
+            resource_for_federation=Mock(),
+        )
+        self.handler = hs.get_handlers().federation_handler
+
+        self.state_ids = {("m.room.create", ""): "$create:test"}
+        self.prev_contexts = {
+            "$a:test": make_context(1, self.state_ids),
+            "$b:test": make_context(1, self.state_ids),
+            "$c:test": make_context(2, self.state_ids),
+        }
+
+    def test_message(self):
+        event = make_timeline_event("$d:test", ["$a:test", "$b:test"])
+        context = self.handler._compute_context_from_prev_contexts(
+            event, self.prev_contexts,
+        )
+
+        self.assertEquals(context.state_group, 1)
+        self.assertEquals(context.current_state_ids, self.state_ids)
+
+    def test_state_event(self):
+        event = make_timeline_event("$d:test", ["$a:test"], "@user:test")
+        context = self.handler._compute_context_from_prev_contexts(
+            event, self.prev_contexts,
+        )
+
+        self.assertNotEquals(context.state_group, 1)
+        self.assertEquals(context.prev_group, 1)
+        self.assertEquals(context.prev_state_ids, self.state_ids)
+        self.assertEquals(
+            context.delta_ids, {("m.room.member", "@user:test"): "$d:test"},
+        )
+        self.assertEquals(
+            context.current_state_ids[("m.room.member", "@user:test")], "$d:test",
+        )
+
+    def test_needs_persisted_prev_events(self):
+        self.prev_contexts["$b:test"].rejected = "auth_error"
+
+        for prev_event_ids in (["$missing:test"], ["$a:test", "$c:test"], ["$b:test"]):
+            event = make_timeline_event("$d:test", prev_event_ids)
+            context = self.handler._compute_context_from_prev_contexts(
+                event, self.prev_contexts,
+            )
+            self.assertIsNone(context)
+
+
+def make_room_event(event_id, depth, prev_event_ids, auth_event_ids, **kwargs):
+    event_dict = {
+        "event_id": event_id,
+        "room_id": "!room:remote",
+        "sender": "@user:remote",
+        "type": "m.room.message",
+        "content": {"body": event_id},
+        "depth": depth,
+        "origin": "remote",
+        "origin_server_ts": 0,
+        "hashes": {"sha256": "aaa"},
+        "signatures": {"remote": {"ed25519:1": "sig"}},
+        "prev_events": [(e_id, {}) for e_id in prev_event_ids],
+        "auth_events": [(e_id, {}) for e_id in auth_event_ids],
+    }
+    event_dict.update(kwargs)
+    return FrozenEvent(event_dict)
+
+
+class BackfillTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.replication_layer = Mock()
+        hs = yield setup_test_homeserver(
+            http_client=None,
+            resource_for_federation=Mock(),
+            replication_layer=self.replication_layer,
+        )
+        self.handler = hs.get_handlers().federation_handler
+        self.store = hs.get_datastore()
+
+        self.create = make_room_event(
+            "$create:remote", 1, [], [],
+            type="m.room.create", state_key="", prev_state=[],
+            content={"creator": "@user:remote"},
+        )
+        self.join = make_room_event(
+            "$join:remote", 2, ["$create:remote"], ["$create:remote"],
+            type="m.room.member", state_key="@user:remote", prev_state=[],
+            content={"membership": "join"},
+        )
+        auth_ids = ["$create:remote", "$join:remote"]
+        self.page = [
+            make_room_event("$m1:remote", 3, ["$join:remote"], auth_ids),
+            make_room_event("$m2:remote", 4, ["$m1:remote"], auth_ids),
+            make_room_event("$m3:remote", 5, ["$m2:remote"], auth_ids),
+        ]
+
+        self.replication_layer.get_state_for_room.return_value = defer.succeed(
+            ([self.create, self.join], [self.create, self.join]),
+        )
+
+    @defer.inlineCallbacks
+    def test_backfill(self):
+        self.replication_layer.backfill.return_value = defer.succeed(
+            list(reversed(self.page)),
+        )
+        persist_events = Mock(wraps=self.store.persist_events)
+        self.store.persist_events = persist_events
+
+        events = yield self.handler.backfill(
+            "remote", "!room:remote", 10, ["$m3:remote"],
+        )
+        self.assertEquals(len(events), 3)
+
+        # the state is fetched for the edge of the page only
+        self.replication_layer.get_state_for_room.assert_called_once_with(
+            destination="remote", room_id="!room:remote", event_id="$m1:remote",
+        )
+
+        # and everything is persisted at once
+        self.assertEquals(persist_events.call_count, 1)
+        persisted = [e.event_id for e, _ in persist_events.call_args[0][0]]
+        self.assertEquals(
+            set(persisted),
+            set(["$create:remote", "$join:remote"] + [e.event_id for e in self.page]),
+        )
+
+        for event in self.page:
+            state_ids = yield self.store.get_state_ids_for_event(event.event_id)
+            self.assertEquals(
+                state_ids,
+                {
+                    ("m.room.create", ""): "$create:remote",
+                    ("m.room.member", "@user:remote"): "$join:remote",
+                },
+            )
+
+    @defer.inlineCallbacks
+    def test_contexts_kept_after_persisting_part_of_page(self):
+        auth_ids = ["$create:remote", "$join:remote"]
+        self.page = [
+            self.page[0],
+            make_room_event(
+                "$topic:remote", 4, ["$m1:remote"], auth_ids,
+                type="m.room.topic", state_key="", prev_state=[],
+                content={"topic": "topic"},
+            ),
+            # the state at this event needs resolving, so the page so far is
+            # persisted first
+            make_room_event(
+                "$m2:remote", 5, ["$topic:remote", "$m1:remote"], auth_ids,
+            ),
+            # but the state at this one can still be worked out from the
+            # context of its prev event
+            make_room_event("$m3:remote", 5, ["$topic:remote"], auth_ids),
+        ]
+        self.replication_layer.backfill.return_value = defer.succeed(self.page)
+        persist_events = Mock(wraps=self.store.persist_events)
+        self.store.persist_events = persist_events
+
+        yield self.handler.backfill("remote", "!room:remote", 10, ["$m3:remote"])
+
+        self.assertEquals(persist_events.call_count, 2)
+        persisted = [e.event_id for e, _ in persist_events.call_args[0][0]]
+        self.assertEquals(persisted, ["$m2:remote", "$m3:remote"])
+
+        state_ids = yield self.store.get_state_ids_for_event("$m3:remote")
+        self.assertEquals(state_ids[("m.room.topic", "")], "$topic:remote")
+
+    @defer.inlineCallbacks
+    def test_pagination_waits_for_prefetch(self):
+        backfill_d = defer.Deferred()
+        self.store.get_oldest_events_with_depth_in_room = Mock(
+            return_value=defer.succeed({"$m1:remote": 3}),
+        )
+
+        backfill_contexts = []
+
+        def backfill(*args, **kwargs):
+            backfill_contexts.append(LoggingContext.current_context())
+            return backfill_d
+        self.replication_layer.backfill.side_effect = backfill
+
+        # the prefetch isn't run in the context of the request which started it
+        with LoggingContext("request") as request_context:
+            self.handler._prefetch_backfill("remote", "!room:remote")
+            self.assertIs(LoggingContext.current_context(), request_context)
+        self.assertEquals(backfill_contexts, [LoggingContext.sentinel])
+
+        d = self.handler.maybe_backfill("!room:remote", 100)
+        self.assertFalse(d.called)
+
+        backfill_d.callback([])
+        yield d
+        self.assertEquals(len(backfill_contexts), 1)
+        self.assertEquals(self.handler._backfill_prefetches, {})
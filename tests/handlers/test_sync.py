@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.filtering import FilterCollection
+from synapse.handlers.sync import (
+    RoomSyncResultBuilder, SyncConfig, TimelineBatch,
+)
+from synapse.types import StreamToken, UserID
+
+from tests import unittest
+from tests.utils import setup_test_homeserver
+
+
+class LazyLoadMembersTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+        self.sync_handler = hs.get_sync_handler()
+
+        self.room_id = "!abc123:test"
+        self.users = ["@alice:test", "@bob:test", "@carol:test"]
+
+        for user_id in self.users:
+            yield self.inject_event({
+                "type": EventTypes.Member,
+                "sender": user_id,
+                "state_key": user_id,
+                "content": {"membership": Membership.JOIN},
+            })
+
+    @defer.inlineCallbacks
+    def inject_event(self, event_dict):
+        event_dict["room_id"] = self.room_id
+        builder = self.event_builder_factory.new(event_dict)
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    def send_message(self, sender):
+        return self.inject_event({
+            "type": EventTypes.Message,
+            "sender": sender,
+            "content": {"body": "hello", "msgtype": "m.text"},
+        })
+
+    def compute_state_delta(self, events, limited, full_state, state_filter):
+        sync_config = SyncConfig(
+            user=UserID.from_string(self.users[0]),
+            filter_collection=FilterCollection({"room": {"state": state_filter}}),
+            is_guest=False,
+            request_key=None,
+            device_id="DEVICE",
+        )
+        batch = TimelineBatch(prev_batch=None, events=events, limited=limited)
+        return self.sync_handler.compute_state_delta(
+            self.room_id, batch, sync_config, None, None, full_state,
+        )
+
+    @defer.inlineCallbacks
+    def test_lazy_load_members(self):
+        alice, bob, carol = self.users
+        state_filter = {"lazy_load_members": True}
+
+        events = []
+        for sender in (alice, bob):
+            event = yield self.send_message(sender)
+            events.append(event)
+
+        state = yield self.compute_state_delta(
+            events, limited=True, full_state=True, state_filter=state_filter,
+        )
+        self.assertEquals(
+            set(state), set([(EventTypes.Member, alice), (EventTypes.Member, bob)]),
+        )
+
+        # an incremental sync only includes members we haven't already sent
+        events = []
+        for sender in (alice, carol):
+            event = yield self.send_message(sender)
+            events.append(event)
+
+        state = yield self.compute_state_delta(
+            events, limited=False, full_state=False, state_filter=state_filter,
+        )
+        self.assertEquals(set(state), set([(EventTypes.Member, carol)]))
+
+        state = yield self.compute_state_delta(
+            events, limited=False, full_state=False, state_filter=state_filter,
+        )
+        self.assertEquals(state, {})
+
+        # ... unless the client asks for them
+        state_filter["include_redundant_members"] = True
+        state = yield self.compute_state_delta(
+            events, limited=False, full_state=False, state_filter=state_filter,
+        )
+        self.assertEquals(
+            set(state),
+            set([(EventTypes.Member, alice), (EventTypes.Member, carol)]),
+        )
+
+    @defer.inlineCallbacks
+    def test_without_lazy_loading(self):
+        event = yield self.send_message(self.users[0])
+
+        state = yield self.compute_state_delta(
+            [event], limited=True, full_state=True, state_filter={},
+        )
+        self.assertEquals(
+            set(state),
+            set((EventTypes.Member, user_id) for user_id in self.users),
+        )
+
+
+class RoomEntryCostTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(http_client=None)
+        self.store = hs.get_datastore()
+        self.sync_handler = hs.get_sync_handler()
+
+    def room_entry(self, room_id, events, since_key, upto_key, newly_joined=False):
+        since_token = None
+        if since_key is not None:
+            since_token = StreamToken.START.copy_and_replace("room_key", since_key)
+        return RoomSyncResultBuilder(
+            room_id=room_id,
+            rtype="joined",
+            events=events,
+            newly_joined=newly_joined,
+            full_state=False,
+            since_token=since_token,
+            upto_token=StreamToken.START.copy_and_replace("room_key", upto_key),
+        )
+
+    def test_estimate_cost(self):
+        self.store.get_users_in_room.prefill(
+            ("!big:test",), ["@user%d:test" % (i,) for i in range(500)],
+        )
+
+        def cost(room_entry):
+            return self.sync_handler._estimate_room_entry_cost(room_entry, 10)
+
+        # a quiet room just costs its events
+        self.assertEquals(cost(self.room_entry("!big:test", [1, 2], "s5", "s7")), 2)
+
+        # gappy rooms cost the size of the gap, up to the size of the room
+        gappy = [1] * 11
+        self.assertEquals(
+            cost(self.room_entry("!big:test", gappy, "s5", "s25")), 11 + 20,
+        )
+        self.assertEquals(
+            cost(self.room_entry("!big:test", gappy, "s5", "s5000")), 11 + 500,
+        )
+
+        # rooms needing their full state cost their membership, which we
+        # guess if it isn't cached
+        self.assertEquals(
+            cost(self.room_entry("!big:test", None, None, "s5")), 10 + 500,
+        )
+        self.assertEquals(
+            cost(self.room_entry("!small:test", [1], "s5", "s7", True)), 1 + 100,
+        )
+
+
+class SharedSyncResultTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(http_client=None)
+        self.sync_handler = hs.get_sync_handler()
+
+        self.calls = []
+        orig = self.sync_handler._generate_shared_sync_result
+
+        def generate_shared_sync_result(*args, **kwargs):
+            self.calls.append(args)
+            return orig(*args, **kwargs)
+
+        self.sync_handler._generate_shared_sync_result = generate_shared_sync_result
+
+    def sync(self, device_id, filter_json={}):
+        sync_config = SyncConfig(
+            user=UserID.from_string("@alice:test"),
+            filter_collection=FilterCollection(filter_json),
+            is_guest=False,
+            request_key=None,
+            device_id=device_id,
+        )
+        return self.sync_handler.generate_sync_result(sync_config)
+
+    @defer.inlineCallbacks
+    def test_shared_between_devices(self):
+        result_a = yield self.sync("DEVICEA")
+        result_b = yield self.sync("DEVICEB")
+
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(result_a.next_batch, result_b.next_batch)
+        self.assertIs(result_a.joined, result_b.joined)
+
+    @defer.inlineCallbacks
+    def test_not_shared_when_lazy_loading(self):
+        filter_json = {"room": {"state": {"lazy_load_members": True}}}
+        yield self.sync("DEVICEA", filter_json)
+        yield self.sync("DEVICEB", filter_json)
+
+        self.assertEquals(len(self.calls), 2)
+
+    @defer.inlineCallbacks
+    def test_failures_not_shared(self):
+        generate = self.sync_handler._generate_shared_sync_result
+
+        def fail_first(*args, **kwargs):
+            d = generate(*args, **kwargs)
+            if len(self.calls) == 1:
+                return defer.fail(Exception("oops"))
+            return d
+
+        self.sync_handler._generate_shared_sync_result = fail_first
+
+        with self.assertRaises(Exception):
+            yield self.sync("DEVICEA")
+
+        # the next sync tries again rather than getting the same error
+        yield self.sync("DEVICEB")
+        self.assertEquals(len(self.calls), 2)
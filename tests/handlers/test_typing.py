@@ -193,6 +193,7 @@ class TypingNotificationsTestCase(unittest.TestCase):
                 json_data_callback=ANY,
                 long_retries=True,
                 backoff_on_404=True,
+                backoff_on_429=False,
             ),
             defer.succeed((200, "OK"))
         )
@@ -265,6 +266,7 @@ class TypingNotificationsTestCase(unittest.TestCase):
                 json_data_callback=ANY,
                 long_retries=True,
                 backoff_on_404=True,
+                backoff_on_429=False,
             ),
             defer.succeed((200, "OK"))
         )
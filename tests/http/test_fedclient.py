@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+from mock import MagicMock, Mock, patch
+
+from synapse.http.matrixfederationclient import MatrixFederationHttpClient
+
+from tests import unittest
+from tests.utils import MockClock
+
+
+class ConcurrencyLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        hs = Mock()
+        hs.hostname = "test"
+        hs.config.signing_key = [Mock()]
+        hs.config.federation_client_pool_size = 5
+        hs.config.federation_client_idle_timeout = 2 * 60 * 1000
+        hs.config.federation_client_max_concurrent_requests = 1
+        hs.get_clock.return_value = MockClock()
+        hs.version_string = "test"
+
+        self.client = MatrixFederationHttpClient(hs)
+        self.client.sign_request = Mock()
+        self.client.agent = Mock()
+
+        self.responses = []
+        self.client.agent.request.side_effect = self._request
+
+        self.bodies = []
+
+        def read_body(response):
+            d = defer.Deferred()
+            self.bodies.append(d)
+            return d
+
+        self.sleeps = []
+
+        def sleep(delay):
+            d = defer.Deferred()
+            self.sleeps.append(d)
+            return d
+
+        for target, value in (
+            (
+                "synapse.util.retryutils.get_retry_limiter",
+                lambda *args, **kwargs: defer.succeed(MagicMock()),
+            ),
+            ("synapse.http.matrixfederationclient.readBody", read_body),
+            ("synapse.http.matrixfederationclient.sleep", sleep),
+        ):
+            patcher = patch(target, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _request(self, method, url, headers, producer):
+        d = defer.Deferred()
+        self.responses.append(d)
+        return d
+
+    def _response(self):
+        return Mock(
+            code=200, phrase="OK",
+            headers=Headers({"Content-Type": ["application/json"]}),
+        )
+
+    def test_slot_held_until_body_read(self):
+        d1 = self.client.get_json("remote", "/a")
+        d2 = self.client.get_json("remote", "/b")
+        self.assertEquals(len(self.responses), 1)
+
+        # the second request waits until the first one's body has been read
+        self.responses[0].callback(self._response())
+        self.assertEquals(len(self.responses), 1)
+
+        self.bodies[0].callback("{}")
+        self.assertEquals(self.successResultOf(d1), {})
+        self.assertEquals(len(self.responses), 2)
+
+        self.responses[1].callback(self._response())
+        self.bodies[1].callback("{}")
+        self.assertEquals(self.successResultOf(d2), {})
+        self.assertEquals(self.client._request_semaphores, {})
+
+    def test_slot_released_while_waiting_to_retry(self):
+        self.client.get_json("remote", "/a")
+        self.responses[0].errback(Exception("connection refused"))
+
+        # the first request is now waiting to retry, so doesn't hold its slot
+        self.assertEquals(len(self.sleeps), 1)
+        d2 = self.client.get_json("remote", "/b")
+        self.assertEquals(len(self.responses), 2)
+
+        self.responses[1].callback(self._response())
+        self.bodies[0].callback("{}")
+        self.assertEquals(self.successResultOf(d2), {})
@@ -16,7 +16,8 @@
 from tests import unittest
 
 from synapse.metrics.metric import (
-    CounterMetric, CallbackMetric, DistributionMetric, CacheMetric
+    CounterMetric, CallbackMetric, DistributionMetric, HistogramMetric,
+    CacheMetric,
 )
 
 
@@ -130,6 +131,46 @@ class DistributionMetricTestCase(unittest.TestCase):
         ])
 
 
+class HistogramMetricTestCase(unittest.TestCase):
+
+    def test_scalar(self):
+        metric = HistogramMetric("fanout", buckets=[1, 10])
+
+        self.assertEquals(metric.render(), [
+            'fanout:bucket{le="1"} 0',
+            'fanout:bucket{le="10"} 0',
+            'fanout:bucket{le="+Inf"} 0',
+            'fanout:count 0',
+            'fanout:total 0',
+        ])
+
+        metric.observe(1)
+        metric.observe(5)
+        metric.observe(50)
+
+        self.assertEquals(metric.render(), [
+            'fanout:bucket{le="1"} 1',
+            'fanout:bucket{le="10"} 2',
+            'fanout:bucket{le="+Inf"} 3',
+            'fanout:count 3',
+            'fanout:total 56',
+        ])
+
+    def test_vector(self):
+        metric = HistogramMetric("fanout", buckets=[10], labels=["stream"])
+
+        self.assertEquals(metric.render(), [])
+
+        metric.observe(3, "typing")
+
+        self.assertEquals(metric.render(), [
+            'fanout:bucket{stream="typing",le="10"} 1',
+            'fanout:bucket{stream="typing",le="+Inf"} 1',
+            'fanout:count{stream="typing"} 1',
+            'fanout:total{stream="typing"} 3',
+        ])
+
+
 class CacheMetricTestCase(unittest.TestCase):
 
     def test_cache(self):
@@ -133,6 +133,45 @@ class SlavedEventStoreTestCase(BaseSlavedStoreTestCase):
             event.internal_metadata.stream_ordering
         )])
 
+    @defer.inlineCallbacks
+    def test_room_summary(self):
+        yield self.persist(type="m.room.create", key="", creator=USER_ID)
+        yield self.persist(type="m.room.member", key=USER_ID, membership="join")
+        yield self.persist(type="m.room.name", key="", name="blue room")
+        yield self.replicate()
+
+        summary = {
+            "name": "blue room",
+            "topic": None,
+            "canonical_alias": None,
+            "avatar_url": None,
+            "join_rule": None,
+            "history_visibility": None,
+            "guest_access": None,
+            "joined_members": 1,
+            "invited_members": 0,
+            "heroes": [USER_ID],
+        }
+        yield self.check("get_room_summary", (ROOM_ID,), summary)
+
+        yield self.persist(
+            type="m.room.member", key=USER_ID_2, membership="invite"
+        )
+        yield self.replicate()
+
+        summary["invited_members"] = 1
+        summary["heroes"] = [USER_ID, USER_ID_2]
+        yield self.check("get_room_summary", (ROOM_ID,), summary)
+
+        yield self.persist(type="m.room.member", key=USER_ID, membership="leave")
+        yield self.persist(type="m.room.name", key="", name="")
+        yield self.replicate()
+
+        summary["name"] = ""
+        summary["joined_members"] = 0
+        summary["heroes"] = [USER_ID_2]
+        yield self.check("get_room_summary", (ROOM_ID,), summary)
+
     @defer.inlineCallbacks
     def test_push_actions_for_user(self):
         yield self.persist(type="m.room.create", creator=USER_ID)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ._base import BaseSlavedStoreTestCase
+
+from synapse.replication.slave.storage.keys import SlavedKeyStore
+
+from mock import Mock
+from twisted.internet import defer, reactor, task
+
+import signedjson.key
+
+SERVER_NAME = "remote"
+
+
+class SlavedKeyStoreTestCase(BaseSlavedStoreTestCase):
+
+    STORE_TYPE = SlavedKeyStore
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(SlavedKeyStoreTestCase, self).setUp()
+        self.hs.get_tcp_replication = Mock(return_value=self.replication_handler)
+        self.master_store._invalidate_cache_and_stream = Mock(
+            wraps=self.master_store._invalidate_cache_and_stream,
+        )
+
+    @defer.inlineCallbacks
+    def test_store_server_verify_key(self):
+        key = signedjson.key.get_verify_key(
+            signedjson.key.generate_signing_key("ver1")
+        )
+        key_id = "%s:%s" % (key.alg, key.version)
+
+        # prime the caches on both sides
+        yield self.check("get_server_verify_keys", [SERVER_NAME, [key_id]], {})
+
+        yield self.slaved_store.store_server_verify_key(
+            SERVER_NAME, SERVER_NAME, 0, key,
+        )
+
+        # the worker's own cache is invalidated straight away ...
+        keys = yield self.slaved_store.get_server_verify_keys(
+            SERVER_NAME, [key_id],
+        )
+        self.assertEquals(keys.keys(), [key_id])
+
+        # ... and the master's once it has heard from the worker
+        for _ in range(100):
+            keys = yield self.master_store.get_server_verify_keys(
+                SERVER_NAME, [key_id],
+            )
+            if keys:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEquals(keys.keys(), [key_id])
+
+        # the master passes the invalidation on to the other workers
+        self.assertEquals(
+            self.master_store._invalidate_cache_and_stream.call_args[0][1:],
+            (self.master_store._get_server_verify_key, (SERVER_NAME, key_id)),
+        )
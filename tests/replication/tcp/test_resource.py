@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from synapse.replication.tcp.resource import (
+    FEDERATION_ACK_TIMEOUT_MS, ReplicationStreamer,
+)
+
+from tests import unittest
+from tests.utils import MockClock
+
+
+class FederationAckTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+        self.federation_sender = Mock()
+
+        hs = Mock()
+        hs.get_datastore.return_value.get_push_rules_stream_token.return_value = (
+            0, 0,
+        )
+        hs.get_clock.return_value = self.clock
+        hs.get_federation_sender.return_value = self.federation_sender
+        hs.config.send_federation = False
+        hs.config.federation_sender_instances = 2
+
+        self.streamer = ReplicationStreamer(hs)
+
+    def test_waits_for_all_senders(self):
+        self.streamer.federation_ack(10, 0)
+        self.assertFalse(self.federation_sender.federation_ack.called)
+
+        self.streamer.federation_ack(5, 1)
+        self.federation_sender.federation_ack.assert_called_once_with(5)
+
+    def test_stale_sender(self):
+        self.streamer.federation_ack(5, 1)
+        self.streamer.federation_ack(10, 0)
+        self.federation_sender.federation_ack.assert_called_once_with(5)
+
+        # instance 1 goes away, so we stop waiting for it.
+        self.clock.advance_time_msec(FEDERATION_ACK_TIMEOUT_MS)
+        self.streamer.federation_ack(20, 0)
+        self.federation_sender.federation_ack.assert_called_with(20)
+
+    def test_sender_never_connects(self):
+        self.streamer.federation_ack(10, 0)
+        self.assertFalse(self.federation_sender.federation_ack.called)
+
+        self.clock.advance_time_msec(FEDERATION_ACK_TIMEOUT_MS)
+        self.streamer.federation_ack(20, 0)
+        self.federation_sender.federation_ack.assert_called_once_with(20)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from canonicaljson import encode_canonical_json, encode_pretty_printed_json
+from mock import Mock
+
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
+from synapse.handlers.sync import (
+    ArchivedSyncResult, DeviceLists, GroupsSyncResult, JoinedSyncResult,
+    SyncResult, TimelineBatch,
+)
+from synapse.http.server import (
+    outgoing_responses_counter, request_accepts_gzip, respond_with_json_bytes,
+    respond_with_json_chunks,
+)
+from synapse.rest.client.v2_alpha.sync import (
+    SyncRestServlet, snapshot_lookups_counter,
+)
+from synapse.util.logcontext import LoggingContext
+
+from tests import unittest
+from tests.utils import MockClock
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+import json
+import zlib
+
+
+def make_sync_result():
+    timeline = TimelineBatch(
+        prev_batch=Mock(to_string=Mock(return_value="s1")),
+        events=[],
+        limited=False,
+    )
+    return SyncResult(
+        next_batch=Mock(to_string=Mock(return_value="s2")),
+        presence=[],
+        account_data=[],
+        joined=[
+            JoinedSyncResult(
+                room_id="!room%d:test" % (i,),
+                timeline=timeline,
+                state={},
+                ephemeral=[],
+                account_data=[],
+                unread_notifications={"notification_count": i},
+            )
+            for i in range(3)
+        ],
+        invited=[],
+        archived=[
+            ArchivedSyncResult(
+                room_id="!left:test",
+                timeline=timeline,
+                state={},
+                account_data=[],
+            )
+        ],
+        to_device=[],
+        device_lists=DeviceLists(changed=[], left=[]),
+        device_one_time_keys_count={},
+        groups=GroupsSyncResult(join={}, invite={}, leave={}),
+    )
+
+
+class EncodeResponseChunksTestCase(unittest.TestCase):
+    def test_matches_encode_response(self):
+        sync_result = make_sync_result()
+
+        chunks = SyncRestServlet.encode_response_chunks(
+            0, sync_result, None, DEFAULT_FILTER_COLLECTION,
+        )
+        expected = SyncRestServlet.encode_response(
+            0, sync_result, None, DEFAULT_FILTER_COLLECTION,
+        )
+        self.assertEquals(json.loads("".join(chunks)), expected)
+
+    def test_encoding_options(self):
+        sync_result = make_sync_result()
+        sync_result = sync_result._replace(
+            joined=list(reversed(sync_result.joined)),
+        )
+        expected = SyncRestServlet.encode_response(
+            0, sync_result, None, DEFAULT_FILTER_COLLECTION,
+        )
+
+        chunks = SyncRestServlet.encode_response_chunks(
+            0, sync_result, None, DEFAULT_FILTER_COLLECTION,
+            canonical_json=True,
+        )
+        self.assertEquals("".join(chunks), encode_canonical_json(expected))
+
+        chunks = SyncRestServlet.encode_response_chunks(
+            0, sync_result, None, DEFAULT_FILTER_COLLECTION,
+            canonical_json=False, pretty_print=True,
+        )
+        self.assertEquals(
+            "".join(chunks), encode_pretty_printed_json(expected) + "\n",
+        )
+
+    def test_chunks_written_when_requested(self):
+        request = Mock()
+        chunks = iter(["a" * 40000, "b" * 40000, "c"])
+
+        respond_with_json_chunks(request, 200, chunks)
+        self.assertEquals(request.registerProducer.call_count, 1)
+        producer = request.registerProducer.call_args[0][0]
+        self.assertFalse(request.write.called)
+
+        producer.resumeProducing()
+        request.write.assert_called_once_with("a" * 40000 + "b" * 40000)
+        self.assertFalse(request.finish.called)
+
+        request.write.reset_mock()
+        producer.resumeProducing()
+        request.write.assert_called_once_with("c")
+        self.assertTrue(request.unregisterProducer.called)
+        self.assertTrue(request.finish.called)
+
+    def test_gzipped_chunks(self):
+        request = Mock()
+        chunks = ["{\"a\":", "\"" + "x" * 100000 + "\"", "}"]
+
+        respond_with_json_chunks(request, 200, iter(chunks), gzip=True)
+        request.setHeader.assert_any_call(b"Content-Encoding", b"gzip")
+        producer = request.registerProducer.call_args[0][0]
+        while not request.finish.called:
+            producer.resumeProducing()
+
+        body = "".join(c[0][0] for c in request.write.call_args_list)
+        self.assertEquals(
+            zlib.decompress(body, 16 + zlib.MAX_WBITS), "".join(chunks),
+        )
+        self.assertTrue(len(body) < 1000)
+
+    def test_response_recorded(self):
+        request = Mock()
+        request.method = "GET"
+        counts = outgoing_responses_counter.counts
+        before = counts.get(("GET", "200"), 0)
+
+        def chunks():
+            contexts.append(LoggingContext.current_context())
+            yield "{}"
+
+        contexts = []
+        with LoggingContext("request") as request_context:
+            d = respond_with_json_chunks(request, 200, chunks())
+        self.assertEquals(counts[("GET", "200")], before + 1)
+
+        # the body is generated in the request's logcontext, and the
+        # deferred only resolves once it has all been sent
+        producer = request.registerProducer.call_args[0][0]
+        self.assertFalse(d.called)
+        producer.resumeProducing()
+        self.assertEquals(contexts, [request_context])
+        self.assertTrue(request.finish.called)
+        self.assertTrue(d.called)
+
+    def test_vary_without_gzip(self):
+        # a response which could have been gzipped tells caches that it
+        # depends on the Accept-Encoding, even if it wasn't
+        request = Mock()
+        respond_with_json_bytes(request, 200, b"{}", vary_on_encoding=True)
+        request.setHeader.assert_any_call(b"Vary", b"Accept-Encoding")
+        headers = [c[0][0] for c in request.setHeader.call_args_list]
+        self.assertNotIn(b"Content-Encoding", headers)
+
+        request = Mock()
+        respond_with_json_chunks(
+            request, 200, iter(["{}"]), vary_on_encoding=True,
+        )
+        request.setHeader.assert_any_call(b"Vary", b"Accept-Encoding")
+        headers = [c[0][0] for c in request.setHeader.call_args_list]
+        self.assertNotIn(b"Content-Encoding", headers)
+
+    def test_request_accepts_gzip(self):
+        def accepts(header):
+            request = Mock()
+            request.requestHeaders = Headers()
+            if header is not None:
+                request.requestHeaders.addRawHeader(b"Accept-Encoding", header)
+            return request_accepts_gzip(request)
+
+        self.assertFalse(accepts(None))
+        self.assertFalse(accepts(b"identity"))
+        self.assertTrue(accepts(b"gzip"))
+        self.assertTrue(accepts(b"deflate, GZIP;q=0.5"))
+        self.assertFalse(accepts(b"gzip;q=0"))
+
+
+class SyncSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+        self.hs = Mock(
+            config=Mock(
+                worker_app="synapse.app.synchrotron",
+                sync_snapshots_enabled=True,
+                sync_snapshot_refresh_interval_ms=60 * 1000,
+                sync_snapshot_max_age_ms=10 * 60 * 1000,
+                sync_snapshot_max_size=1024 * 1024,
+            ),
+        )
+        self.hs.get_clock.return_value = self.clock
+        self.store = self.hs.get_datastore.return_value
+
+    @defer.inlineCallbacks
+    def test_workers_keep_snapshots_in_memory(self):
+        servlet = SyncRestServlet(self.hs)
+
+        yield servlet._store_snapshot(
+            "@user:test", "", DEFAULT_FILTER_COLLECTION, make_sync_result(),
+        )
+        self.assertFalse(self.store.store_sync_snapshot.called)
+
+        self.clock.advance_time(10)
+        snapshot = yield servlet._get_snapshot("@user:test", "")
+        self.assertFalse(self.store.get_sync_snapshot.called)
+        self.assertEquals(snapshot["stream_token"], "s2")
+        self.assertEquals(snapshot["ts"], self.clock.time_msec() - 10000)
+        self.assertEquals(
+            len(snapshot["snapshot"]["rooms"]["join"]), 3,
+        )
+
+        # they are kept compressed
+        _, compressed = servlet._snapshot_cache[("@user:test", "")]
+        self.assertEquals(
+            json.loads(zlib.decompress(compressed))["next_batch"], "s2",
+        )
+
+        # snapshots expire after sync_snapshot_max_age
+        self.clock.advance_time(20 * 60)
+        snapshot = yield servlet._get_snapshot("@user:test", "")
+        self.assertIsNone(snapshot)
+
+    @defer.inlineCallbacks
+    def test_large_snapshots_not_stored(self):
+        self.hs.config.sync_snapshot_max_size = 100
+        servlet = SyncRestServlet(self.hs)
+
+        yield servlet._store_snapshot(
+            "@user:test", "", DEFAULT_FILTER_COLLECTION, make_sync_result(),
+        )
+        snapshot = yield servlet._get_snapshot("@user:test", "")
+        self.assertIsNone(snapshot)
+
+    @defer.inlineCallbacks
+    def test_lookups_counted(self):
+        servlet = SyncRestServlet(self.hs)
+        sync_config = Mock(device_id=None)
+        sync_config.user.to_string.return_value = "@user:test"
+
+        def count(result):
+            return snapshot_lookups_counter.counts.get((result,), 0)
+
+        misses = count("miss")
+        hits = count("hit")
+
+        response = yield servlet._get_response_from_snapshot(
+            sync_config, DEFAULT_FILTER_COLLECTION, "",
+        )
+        self.assertIsNone(response)
+        self.assertEquals(count("miss"), misses + 1)
+
+        yield servlet._store_snapshot(
+            "@user:test", "", DEFAULT_FILTER_COLLECTION, make_sync_result(),
+        )
+        response = yield servlet._get_response_from_snapshot(
+            sync_config, DEFAULT_FILTER_COLLECTION, "",
+        )
+        self.assertEquals(len(response["rooms"]["join"]), 3)
+        self.assertEquals(count("hit"), hits + 1)
@@ -38,6 +38,7 @@ class ApplicationServiceStoreTestCase(unittest.TestCase):
             app_service_config_files=self.as_yaml_files,
             event_cache_size=1,
             password_providers=[],
+            retention_policies={},
         )
         hs = yield setup_test_homeserver(
             config=config,
@@ -115,6 +116,7 @@ class ApplicationServiceTransactionStoreTestCase(unittest.TestCase):
             app_service_config_files=self.as_yaml_files,
             event_cache_size=1,
             password_providers=[],
+            retention_policies={},
         )
         hs = yield setup_test_homeserver(
             config=config,
@@ -82,3 +82,68 @@ class BackgroundUpdateTestCase(unittest.TestCase):
         )
         self.assertIsNone(result)
         self.assertFalse(self.update_handler.called)
+
+    @defer.inlineCallbacks
+    def test_priority_and_in_progress(self):
+        calls = []
+        started = defer.Deferred()
+        blocker = defer.Deferred()
+
+        def make_handler(name):
+            @defer.inlineCallbacks
+            def handler(progress, count):
+                calls.append(name)
+                if name == "high_update":
+                    started.callback(None)
+                    yield blocker
+                yield self.store._end_background_update(name)
+                defer.returnValue(count)
+            return handler
+
+        yield self.store.register_background_update_handler(
+            "low_update", make_handler("low_update"),
+        )
+        yield self.store.register_background_update_handler(
+            "high_update", make_handler("high_update"), priority=10,
+        )
+        yield self.store.start_background_update("low_update", {})
+        yield self.store.start_background_update("high_update", {})
+
+        # the high priority update goes first, and blocks.
+        d = self.store.do_next_background_update(1000)
+        yield started
+        self.assertEquals(calls, ["high_update"])
+
+        status = yield self.store.get_background_updates_status()
+        self.assertEquals(
+            [(u["update_name"], u["in_progress"]) for u in status],
+            [("high_update", True), ("low_update", False)],
+        )
+
+        # a second runner skips over it to the next update.
+        yield self.store.do_next_background_update(1000)
+        self.assertEquals(calls, ["high_update", "low_update"])
+
+        blocker.callback(None)
+        yield d
+
+        result = yield self.store.do_next_background_update(1000)
+        self.assertIsNone(result)
+
+    @defer.inlineCallbacks
+    def test_update_ended_while_refilling_queue(self):
+        self.update_handler.side_effect = lambda progress, count: defer.succeed(count)
+        yield self.store.start_background_update("test_update", {})
+
+        # another runner finishes the update while we are reading the list of
+        # updates to refill the queue.
+        select = defer.Deferred()
+        self.store._simple_select_list = Mock(return_value=select)
+        d = self.store.do_next_background_update(1000)
+        yield self.store._end_background_update("test_update")
+        select.callback([{"update_name": "test_update", "depends_on": None}])
+
+        result = yield d
+        self.assertIsNone(result)
+        self.assertFalse(self.update_handler.called)
+        self.assertEquals(self.store._background_update_queue, [])
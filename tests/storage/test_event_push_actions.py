@@ -125,3 +125,95 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield _assert_counts(1, 1)
         yield _rotate(10)
         yield _assert_counts(1, 1)
+
+    @defer.inlineCallbacks
+    def test_count_by_rooms(self):
+        user_id = "@user1235:example.com"
+        rooms = ["!room%d:example.com" % (i,) for i in range(3)]
+
+        @defer.inlineCallbacks
+        def _inject_event(room_id, stream, action=None):
+            event_id = "$%s_%d:example.com" % (room_id, stream)
+            yield self.store._simple_insert("events", {
+                "stream_ordering": stream,
+                "topological_ordering": stream,
+                "depth": stream,
+                "event_id": event_id,
+                "room_id": room_id,
+                "type": "m.room.message",
+                "content": "{}",
+                "unrecognized_keys": "",
+                "processed": True,
+                "outlier": False,
+            })
+
+            if action:
+                event = Mock()
+                event.room_id = room_id
+                event.event_id = event_id
+                event.internal_metadata.stream_ordering = stream
+                event.depth = stream
+
+                yield self.store.runInteraction(
+                    "", self.store._set_push_actions_for_event_and_users_txn,
+                    event, [(user_id, action)]
+                )
+            defer.returnValue(event_id)
+
+        @defer.inlineCallbacks
+        def _receipt(room_id, event_id):
+            yield self.store._simple_delete(
+                "receipts_linearized", {"room_id": room_id}, desc="",
+            )
+            yield self.store._simple_insert("receipts_linearized", {
+                "stream_id": 1,
+                "room_id": room_id,
+                "receipt_type": "m.read",
+                "user_id": user_id,
+                "event_id": event_id,
+                "data": "{}",
+            })
+            self.store.get_receipts_for_user.invalidate_all()
+
+        @defer.inlineCallbacks
+        def _assert_counts(expected):
+            counts = yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+                rooms, user_id,
+            )
+            self.assertEquals(counts, expected)
+
+            # check we agree with the counts for the individual rooms
+            for room_id, room_counts in counts.items():
+                event_id = yield self.store.get_last_receipt_event_id_for_user(
+                    user_id, room_id, "m.read",
+                )
+                single = yield self.store.runInteraction(
+                    "", self.store._get_unread_counts_by_receipt_txn,
+                    room_id, user_id, event_id,
+                )
+                self.assertEquals(room_counts, single)
+
+        read_0 = yield _inject_event(rooms[0], 1)
+        read_1 = yield _inject_event(rooms[1], 2)
+        yield _inject_event(rooms[0], 3, PlAIN_NOTIF)
+        yield _inject_event(rooms[0], 4, HIGHLIGHT)
+        yield _inject_event(rooms[1], 5, PlAIN_NOTIF)
+        yield _inject_event(rooms[2], 6, PlAIN_NOTIF)
+
+        yield _receipt(rooms[0], read_0)
+        yield _receipt(rooms[1], read_1)
+
+        # no receipt in the third room, so no counts for it
+        yield _assert_counts({
+            rooms[0]: {"notify_count": 2, "highlight_count": 1},
+            rooms[1]: {"notify_count": 1, "highlight_count": 0},
+        })
+
+        yield self.store.runInteraction(
+            "", self.store._rotate_notifs_before_txn, 7
+        )
+        self.store.get_unread_event_push_actions_by_room_for_user.invalidate_all()
+        yield _assert_counts({
+            rooms[0]: {"notify_count": 2, "highlight_count": 1},
+            rooms[1]: {"notify_count": 1, "highlight_count": 0},
+        })
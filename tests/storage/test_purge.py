@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.types import UserID, RoomID
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class PurgeHistoryTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.u_alice = UserID.from_string("@alice:test")
+        self.room1 = RoomID.from_string("!abc123:test")
+
+    @defer.inlineCallbacks
+    def inject_event(self, event_dict):
+        event_dict.update({
+            "sender": self.u_alice.to_string(),
+            "room_id": self.room1.to_string(),
+        })
+        builder = self.event_builder_factory.new(event_dict)
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def test_purge_in_batches(self):
+        yield self.inject_event({
+            "type": EventTypes.Member,
+            "state_key": self.u_alice.to_string(),
+            "content": {"membership": Membership.JOIN},
+        })
+
+        events = []
+        for i in range(6):
+            event = yield self.inject_event({
+                "type": EventTypes.Message,
+                "content": {"body": "message %d" % (i,), "msgtype": "m.text"},
+            })
+            events.append(event)
+
+        cutoff = events[4].depth
+        total = yield self.store.start_purge_history(
+            "purge1", self.room1.to_string(), cutoff,
+        )
+        self.assertEquals(total, 5)
+
+        job = yield self.store.get_purge_history("purge1")
+        self.assertEquals(job["status"], "active")
+        self.assertEquals(job["events_processed"], 0)
+
+        batches = 0
+        while True:
+            processed = yield self.store.purge_history_batch("purge1", 2)
+            if not processed:
+                break
+            self.assertTrue(processed <= 2)
+            batches += 1
+        self.assertEquals(batches, 3)
+
+        job = yield self.store.get_purge_history("purge1")
+        self.assertEquals(job["status"], "complete")
+        self.assertEquals(job["events_processed"], 5)
+
+        active = yield self.store.get_active_purge_history_ids()
+        self.assertEquals(active, [])
+
+        # our own events are kept, but as outliers
+        for event in events[:4]:
+            outlier = yield self.store._simple_select_one_onecol(
+                "events", {"event_id": event.event_id}, "outlier",
+            )
+            self.assertTrue(outlier)
+
+        for event in events[4:]:
+            outlier = yield self.store._simple_select_one_onecol(
+                "events", {"event_id": event.event_id}, "outlier",
+            )
+            self.assertFalse(outlier)
+
+    @defer.inlineCallbacks
+    def test_state_groups_kept_until_last_batch(self):
+        yield self.inject_event({
+            "type": EventTypes.Member,
+            "state_key": self.u_alice.to_string(),
+            "content": {"membership": Membership.JOIN},
+        })
+
+        events = []
+        for i in range(3):
+            event = yield self.inject_event({
+                "type": EventTypes.Message,
+                "content": {"body": "message %d" % (i,), "msgtype": "m.text"},
+            })
+            events.append(event)
+
+        cutoff_event = yield self.inject_event({
+            "type": EventTypes.Topic,
+            "state_key": "",
+            "content": {"topic": "new topic"},
+        })
+        yield self.inject_event({
+            "type": EventTypes.Message,
+            "content": {"body": "after", "msgtype": "m.text"},
+        })
+
+        state_group = yield self.store._get_state_group_for_event(
+            events[-1].event_id,
+        )
+
+        @defer.inlineCallbacks
+        def state_group_exists():
+            rows = yield self.store._simple_select_onecol(
+                "state_groups", {"id": state_group}, "id",
+            )
+            defer.returnValue(bool(rows))
+
+        yield self.store.start_purge_history(
+            "purge3", self.room1.to_string(), cutoff_event.depth,
+        )
+
+        # the first batch only has some of the events using the state group,
+        # so the group must be kept for the rest
+        processed = yield self.store.purge_history_batch("purge3", 2)
+        self.assertEquals(processed, 2)
+        self.assertTrue((yield state_group_exists()))
+
+        while (yield self.store.purge_history_batch("purge3", 2)):
+            pass
+
+        self.assertFalse((yield state_group_exists()))
+
+    @defer.inlineCallbacks
+    def test_purge_status(self):
+        yield self.inject_event({
+            "type": EventTypes.Member,
+            "state_key": self.u_alice.to_string(),
+            "content": {"membership": Membership.JOIN},
+        })
+        event = yield self.inject_event({
+            "type": EventTypes.Message,
+            "content": {"body": "hello", "msgtype": "m.text"},
+        })
+        yield self.inject_event({
+            "type": EventTypes.Message,
+            "content": {"body": "world", "msgtype": "m.text"},
+        })
+
+        yield self.store.start_purge_history(
+            "purge2", self.room1.to_string(), event.depth,
+        )
+        yield self.store.set_purge_history_failed("purge2")
+
+        status = yield self.message_handler.get_purge_status("purge2")
+        self.assertEquals(status["status"], "failed")
+        self.assertEquals(status["events_total"], 1)
+        self.assertEquals(status["events_processed"], 0)
+        self.assertNotIn("eta_ms", status)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+import tests.unittest
+import tests.utils
+
+
+class RetentionStoreTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield tests.utils.setup_test_homeserver()
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+
+    @defer.inlineCallbacks
+    def test_prune_table(self):
+        day = 24 * 60 * 60 * 1000
+        self.clock.advance_time_msec(30 * day)
+        now = self.clock.time_msec()
+
+        # five old transactions, two of which share a timestamp, and one new
+        # one.
+        for i, ts in enumerate([1, 2, 3, 3, 4, now - day]):
+            yield self.store._simple_insert(
+                "received_transactions",
+                {
+                    "transaction_id": "txn%d" % (i,),
+                    "origin": "example.com",
+                    "ts": ts,
+                    "response_code": 200,
+                    "response_json": "{}",
+                    "has_been_referenced": 0,
+                },
+            )
+
+        deleted, caught_up = yield self.store.runInteraction(
+            "prune_table",
+            self.store._prune_table_batch_txn,
+            "received_transactions", now - 7 * day, 3,
+        )
+        # the batch is extended to include both rows with ts 3
+        self.assertEquals(deleted, 4)
+        self.assertFalse(caught_up)
+
+        self.store._retention_batch_size = 2
+        deleted = yield self.store.prune_table("received_transactions", 7 * day)
+        self.assertEquals(deleted, 1)
+
+        remaining = yield self.store._simple_select_onecol(
+            "received_transactions", keyvalues={}, retcol="transaction_id",
+        )
+        self.assertEquals(remaining, ["txn5"])
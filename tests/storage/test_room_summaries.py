@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class RoomSummaryStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.room_id = "!abc123:test"
+
+    @defer.inlineCallbacks
+    def inject_event(self, event_dict):
+        event_dict["room_id"] = self.room_id
+        builder = self.event_builder_factory.new(event_dict)
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def inject_membership(self, user_id, membership):
+        yield self.inject_event({
+            "type": EventTypes.Member,
+            "sender": user_id,
+            "state_key": user_id,
+            "content": {"membership": membership},
+        })
+
+    @defer.inlineCallbacks
+    def test_summary(self):
+        for i in range(7):
+            yield self.inject_membership("@user%d:test" % (i,), Membership.JOIN)
+
+        yield self.inject_event({
+            "type": EventTypes.Topic,
+            "sender": "@user0:test",
+            "state_key": "",
+            "content": {"topic": "things"},
+        })
+        yield self.inject_membership("@user1:test", Membership.LEAVE)
+
+        summary = yield self.store.get_room_summary(self.room_id)
+        self.assertEquals(summary["topic"], "things")
+        self.assertIsNone(summary["name"])
+        self.assertEquals(summary["joined_members"], 6)
+        self.assertEquals(summary["invited_members"], 0)
+        self.assertEquals(summary["heroes"], [
+            "@user0:test", "@user2:test", "@user3:test", "@user4:test",
+            "@user5:test",
+        ])
+
+        # the background update recreates the same summary from scratch
+        yield self.store._simple_delete(
+            "room_summaries", {"room_id": self.room_id}, desc="test",
+        )
+        yield self.store._simple_insert("rooms", {
+            "room_id": self.room_id, "is_public": False, "creator": "@user0:test",
+        })
+        yield self.store._background_populate_room_summaries({}, 100)
+
+        joined_members = yield self.store._simple_select_one_onecol(
+            "room_summaries", {"room_id": self.room_id}, "joined_members",
+        )
+        self.assertEquals(joined_members, 6)
+
+        self.store.get_room_summary.invalidate_all()
+        repopulated = yield self.store.get_room_summary(self.room_id)
+        self.assertEquals(repopulated, summary)
+
+    @defer.inlineCallbacks
+    def test_background_update_keeps_existing_summary(self):
+        yield self.inject_membership("@user0:test", Membership.JOIN)
+        yield self.store._simple_insert("rooms", {
+            "room_id": self.room_id, "is_public": False, "creator": "@user0:test",
+        })
+
+        # a summary written by persisting an event after the background update
+        # read the room's state isn't overwritten by it.
+        yield self.store._simple_update_one(
+            "room_summaries", {"room_id": self.room_id}, {"topic": "newer"},
+        )
+        yield self.store._background_populate_room_summaries({}, 100)
+
+        topic = yield self.store._simple_select_one_onecol(
+            "room_summaries", {"room_id": self.room_id}, "topic",
+        )
+        self.assertEquals(topic, "newer")
+
+
+class RoomSummaryStoreLockingUpsertTestCase(RoomSummaryStoreTestCase):
+    """Runs the same tests as on databases without INSERT ... ON CONFLICT, such
+    as postgres 9.4.
+    """
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(RoomSummaryStoreLockingUpsertTestCase, self).setUp()
+        self.store.database_engine.can_native_upsert = False
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+
+import tests.unittest
+import tests.utils
+
+
+class FederationOutPosTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield tests.utils.setup_test_homeserver()
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def test_positions_per_instance(self):
+        yield self.store.update_federation_out_pos("events", 10)
+
+        # a new instance starts from the position of the first
+        pos = yield self.store.get_federation_out_pos("events", 1)
+        self.assertEquals(pos, 10)
+
+        yield self.store.update_federation_out_pos("events", 15, 1)
+        pos = yield self.store.get_federation_out_pos("events", 1)
+        self.assertEquals(pos, 15)
+
+        pos = yield self.store.get_federation_out_pos("events")
+        self.assertEquals(pos, 10)
+
+    @defer.inlineCallbacks
+    def test_no_stored_position(self):
+        yield self.store.runInteraction(
+            "test", lambda txn: txn.execute("DELETE FROM federation_stream_position"),
+        )
+
+        pos = yield self.store.get_federation_out_pos("events", 1)
+        self.assertEquals(pos, self.store.get_room_max_stream_ordering())
+
+        pos = yield self.store.get_federation_out_pos("federation", 1)
+        self.assertEquals(pos, -1)
+
+
+class LatestLocalEventsTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield tests.utils.setup_test_homeserver()
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+    @defer.inlineCallbacks
+    def inject_event(self, room_id, event_dict):
+        event_dict.update({
+            "sender": "@alice:test",
+            "room_id": room_id,
+        })
+        builder = self.event_builder_factory.new(event_dict)
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+        yield self.store.persist_event(event, context)
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def test_latest_local_events_since(self):
+        latest = {}
+        for room_id in ("!a:test", "!b:test"):
+            yield self.inject_event(room_id, {
+                "type": EventTypes.Member,
+                "state_key": "@alice:test",
+                "content": {"membership": Membership.JOIN},
+            })
+            for i in range(3):
+                latest[room_id] = yield self.inject_event(room_id, {
+                    "type": EventTypes.Message,
+                    "content": {"body": "message %d" % (i,), "msgtype": "m.text"},
+                })
+
+        events = yield self.store.get_latest_local_events_since(0)
+        self.assertEquals(
+            set(e.event_id for e in events),
+            set(e.event_id for e in latest.values()),
+        )
+
+        # nothing after the latest event
+        last = max(e.internal_metadata.stream_ordering for e in events)
+        events = yield self.store.get_latest_local_events_since(last)
+        self.assertEquals(events, [])
+
+    @defer.inlineCallbacks
+    def test_destination_positions(self):
+        pos = yield self.store.get_destination_last_sent_stream_ordering("remote")
+        self.assertIsNone(pos)
+
+        yield self.store.set_destination_last_sent_stream_ordering("remote", 5)
+        yield self.store.set_destination_last_sent_stream_ordering("remote", 7)
+        pos = yield self.store.get_destination_last_sent_stream_ordering("remote")
+        self.assertEquals(pos, 7)
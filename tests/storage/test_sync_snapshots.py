@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+import tests.unittest
+import tests.utils
+
+
+class SyncSnapshotStoreTestCase(tests.unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield tests.utils.setup_test_homeserver()
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+
+    @defer.inlineCallbacks
+    def test_store_and_get(self):
+        user_id = "@user:test"
+
+        snapshot = yield self.store.get_sync_snapshot(user_id, "")
+        self.assertIsNone(snapshot)
+
+        yield self.store.store_sync_snapshot(user_id, "", "s1_1", '{"a": 1}')
+        self.clock.advance_time_msec(1000)
+        yield self.store.store_sync_snapshot(user_id, "2", "s1_2", '{"b": 2}')
+
+        snapshot = yield self.store.get_sync_snapshot(user_id, "")
+        self.assertEquals(snapshot["stream_token"], "s1_1")
+        self.assertEquals(snapshot["snapshot"], {"a": 1})
+
+        # storing a new snapshot replaces the old one
+        yield self.store.store_sync_snapshot(user_id, "", "s2_1", '{"c": 3}')
+        snapshot = yield self.store.get_sync_snapshot(user_id, "")
+        self.assertEquals(snapshot["stream_token"], "s2_1")
+        self.assertEquals(snapshot["ts"], self.clock.time_msec())
+        self.assertEquals(snapshot["snapshot"], {"c": 3})
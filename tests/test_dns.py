@@ -154,10 +154,45 @@ class DnsTestCase(unittest.TestCase):
         service_name = "test_service.examle.com"
 
         cache = {}
+        negative_cache = {}
 
         servers = yield resolve_service(
-            service_name, dns_client=dns_client_mock, cache=cache
+            service_name, dns_client=dns_client_mock, cache=cache,
+            negative_cache=negative_cache,
         )
 
         self.assertEquals(len(servers), 0)
         self.assertEquals(len(cache), 0)
+
+        # the name error is cached
+        self.assertIn(service_name, negative_cache)
+        servers = yield resolve_service(
+            service_name, dns_client=dns_client_mock, cache=cache,
+            negative_cache=negative_cache,
+        )
+        self.assertEquals(len(servers), 0)
+        dns_client_mock.lookupService.assert_called_once_with(service_name)
+
+    @defer.inlineCallbacks
+    def test_name_error_soa_ttl(self):
+        clock = MockClock()
+
+        message = dns.Message()
+        message.authority = [dns.RRHeader(
+            type=dns.SOA, ttl=3600, payload=dns.Record_SOA(minimum=60),
+        )]
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = defer.fail(
+            error.DNSNameError(message),
+        )
+
+        service_name = "test_service.examle.com"
+        negative_cache = {}
+
+        yield resolve_service(
+            service_name, dns_client=dns_client_mock, cache={}, clock=clock,
+            negative_cache=negative_cache,
+        )
+
+        # the name error is cached for the SOA's minimum TTL
+        self.assertEquals(negative_cache[service_name], int(clock.time()) + 60)
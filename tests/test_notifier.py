@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright 2017 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+from twisted.internet import defer
+
+from synapse.api.errors import LimitExceededError
+from synapse.notifier import LONG_POLL_RETRY_AFTER_MS, _NotifierUserStream
+from synapse.types import StreamToken
+
+from tests import unittest
+from tests.utils import setup_test_homeserver
+
+
+class NotifierWakeTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(http_client=None)
+        self.clock = hs.get_clock()
+        self.notifier = hs.get_notifier()
+        self.notifier.WAKE_BATCH_SIZE = 2
+
+        self.streams = []
+        for i in range(5):
+            user_stream = _NotifierUserStream(
+                user_id="@user%d:test" % (i,),
+                rooms=["!room:test"],
+                current_token=StreamToken.START,
+                time_now_ms=self.clock.time_msec(),
+            )
+            self.notifier._register_with_keys(user_stream)
+            self.streams.append(user_stream)
+
+    def _listen(self):
+        return [
+            s.new_listener(StreamToken.START).deferred for s in self.streams
+        ]
+
+    def test_wakes_in_batches(self):
+        deferreds = self._listen()
+
+        self.notifier.on_new_event("room_key", 5, rooms=["!room:test"])
+
+        # all the tokens are advanced straight away ...
+        for s in self.streams:
+            self.assertEquals(s.current_token.room_key, 5)
+
+        # ... but the listeners are only woken up in later ticks, a batch at
+        # a time
+        self.assertEquals(sum(d.called for d in deferreds), 0)
+
+        ticks = 0
+        while self.notifier._streams_to_wake:
+            self.clock.advance_time(0)
+            ticks += 1
+            self.assertEquals(sum(d.called for d in deferreds), min(2 * ticks, 5))
+        self.assertEquals(ticks, 3)
+
+    def test_notifications_in_one_tick_wake_once(self):
+        deferreds = self._listen()
+        user_stream = self.streams[0]
+        user_stream.wake = Mock(wraps=user_stream.wake)
+
+        self.notifier.on_new_event("room_key", 5, rooms=["!room:test"])
+        self.notifier.on_new_event("room_key", 6, rooms=["!room:test"])
+        self.assertEquals(len(self.notifier._streams_to_wake), 5)
+
+        while self.notifier._streams_to_wake:
+            self.clock.advance_time(0)
+
+        self.assertEquals(user_stream.wake.call_count, 1)
+        self.assertEquals(self.successResultOf(deferreds[0]).room_key, 6)
+
+    def test_new_listener_sees_pending_token(self):
+        self._listen()
+        self.notifier.on_new_event("room_key", 5, rooms=["!room:test"])
+
+        # listeners registering before their stream is woken up still return
+        # straight away
+        deferreds = self._listen()
+        self.assertTrue(all(d.called for d in deferreds))
+
+
+class LongPollLimitTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(http_client=None)
+        self.clock = hs.get_clock()
+        self.notifier = hs.get_notifier()
+        self.notifier._max_concurrent_long_polls = 1
+
+        self.user_stream = _NotifierUserStream(
+            user_id="@user:test",
+            rooms=["!room:test"],
+            current_token=StreamToken.START,
+            time_now_ms=self.clock.time_msec(),
+        )
+        self.notifier._register_with_keys(self.user_stream)
+
+        self.callback_results = []
+
+    def _callback(self, prev_token, current_token):
+        self.callback_results.append(current_token)
+        if current_token == prev_token:
+            return defer.succeed(None)
+        return defer.succeed(current_token.room_key)
+
+    def test_rejected_over_limit(self):
+        d1 = self.notifier.wait_for_events(
+            "@user:test", 30000, self._callback, from_token=StreamToken.START,
+        )
+        self.assertFalse(d1.called)
+        self.assertEquals(self.notifier._waiting_long_polls, 1)
+
+        # the second request can't wait, so is told to come back later
+        d2 = self.notifier.wait_for_events(
+            "@user:test", 30000, self._callback, from_token=StreamToken.START,
+        )
+        e = self.failureResultOf(d2, LimitExceededError).value
+        self.assertEquals(e.code, 429)
+        self.assertTrue(e.retry_after_ms >= LONG_POLL_RETRY_AFTER_MS)
+        self.assertEquals(self.notifier._waiting_long_polls, 1)
+
+        self.notifier.on_new_event("room_key", 5, rooms=["!room:test"])
+        self.clock.advance_time(0)
+        self.assertTrue(d1.called)
+        self.assertEquals(self.notifier._waiting_long_polls, 0)
+        self.assertEquals(self.user_stream.last_notified_stream_key, "room_key")
+
+    def test_events_returned_over_limit(self):
+        d1 = self.notifier.wait_for_events(
+            "@user:test", 30000, self._callback, from_token=StreamToken.START,
+        )
+        self.assertFalse(d1.called)
+
+        # a request which already has events waiting gets them, rather than
+        # being told to come back later
+        self.user_stream.current_token = StreamToken.START.copy_and_replace(
+            "room_key", 5,
+        )
+        d2 = self.notifier.wait_for_events(
+            "@user:test", 30000, self._callback, from_token=StreamToken.START,
+        )
+        self.assertEquals(self.successResultOf(d2), 5)
+        self.assertEquals(self.notifier._waiting_long_polls, 1)
+
+    def test_estimate_size(self):
+        size = self.user_stream.estimate_size()
+        self.user_stream.new_listener(StreamToken.START)
+        self.assertTrue(self.user_stream.estimate_size() > size)
@@ -57,6 +57,21 @@ def setup_test_homeserver(name="test", datastore=None, config=None, **kargs):
         config.worker_app = None
         config.email_enable_notifs = False
         config.block_non_admin_invites = False
+        config.retention_policies = {}
+        config.retention_batch_size = 1000
+        config.sync_snapshots_enabled = False
+        config.sync_room_concurrency = 10
+        config.max_concurrent_long_polls = 0
+        config.federation_sender_instances = 1
+        config.worker_federation_sender_instance = 0
+        config.federation_client_pool_size = 5
+        config.federation_client_idle_timeout = 2 * 60 * 1000
+        config.federation_client_max_concurrent_requests = 0
+        config.federation_inbound_room_concurrency = 10
+        config.federation_inbound_transactions_per_room = 5
+        config.federation_inbound_max_transactions_per_origin = 10
+        config.gzip_responses = False
+        config.signature_verification_threads = 0
 
     config.use_frozen_dicts = True
     config.database_config = {"name": "sqlite3"}